@@ -15,6 +15,7 @@ import matplotlib.pyplot as plt
 
 from telegram_upload.caption_formatter import FileSize
 from telegram_upload.client import TelegramManagerClient
+from telegram_upload.client.concurrency import AdaptiveUploadWindow
 from telegram_upload.config import default_config
 from telegram_upload.upload_files import NoLargeFiles
 
@@ -115,7 +116,8 @@ def benchmark_file_size(client: TelegramManagerClient, size: int, repeats: int =
     parallel = cast(int, parallel or DEFAULT_PARALLEL)
     client.parallel_upload_blocks = parallel
     client.reconnecting_lock = asyncio.Lock()
-    client.upload_semaphore = asyncio.Semaphore(parallel)
+    # fixed window to measure every parallel value
+    client.upload_window = AdaptiveUploadWindow(parallel, minimum=parallel, maximum=parallel)
     # create file
     path = create_file(size)
     # benchmark upload
@@ -0,0 +1,236 @@
+"""Persistent cache of the media information and thumbnails of the uploaded files, and index of the uploads."""
+import hashlib
+import json
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+from typing import Optional, Tuple
+
+from telethon.tl.types import Document, InputDocument
+
+from telegram_upload.config import MEDIA_CACHE_FILE, THUMBNAILS_CACHE_DIRECTORY, UPLOAD_INDEX_FILE
+from telegram_upload.utils import get_environment_integer
+from telegram_upload.video import MediaProbe
+
+
+# Set to 0 to disable the cache
+MEDIA_CACHE = get_environment_integer('TELEGRAM_UPLOAD_MEDIA_CACHE', 1)
+
+_media_cache: Optional['MediaCache'] = None
+_media_cache_lock = threading.Lock()
+
+
+class MediaCache:
+    """Cache of the media probe and the thumbnail of the files. The entries are identified by the file path,
+    size, modification time and inode, so an entry is ignored when the file changes. There is one entry per
+    path: the entry of a changed file is replaced on the next upload.
+
+    The thumbnails are obtained in threads, so the cache can be used from several threads.
+    """
+    def __init__(self, path: str = MEDIA_CACHE_FILE, thumbnails_directory: str = THUMBNAILS_CACHE_DIRECTORY):
+        self.path = path
+        self.thumbnails_directory = thumbnails_directory
+        self._connection: Optional[sqlite3.Connection] = None
+        self._lock = threading.Lock()
+
+    @property
+    def connection(self) -> sqlite3.Connection:
+        if self._connection is None:
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            self._connection = sqlite3.connect(self.path, check_same_thread=False)
+            self._connection.execute(
+                'CREATE TABLE IF NOT EXISTS media (path TEXT PRIMARY KEY, size INTEGER, mtime INTEGER, '
+                'inode INTEGER, probe TEXT, thumbnail TEXT)'
+            )
+        return self._connection
+
+    @staticmethod
+    def file_key(path: str, stat: Optional[os.stat_result] = None) -> Optional[Tuple[str, int, int, int]]:
+        """Identity of the file: path, size, modification time and inode. None if the file does not exist.
+        The stat of the file can be given if it is already available.
+        """
+        try:
+            stat = stat or os.stat(path)
+        except OSError:
+            return None
+        return os.path.abspath(path), stat.st_size, stat.st_mtime_ns, stat.st_ino
+
+    def _get(self, path: str, column: str, stat: Optional[os.stat_result] = None) -> Optional[str]:
+        key = self.file_key(path, stat)
+        if key is None:
+            return None
+        try:
+            with self._lock:
+                row = self.connection.execute(
+                    'SELECT {} FROM media WHERE path = ? AND size = ? AND mtime = ? AND inode = ?'.format(column),
+                    key
+                ).fetchone()
+        except sqlite3.Error:
+            # The cache is optional. For example, the database can be locked by another process.
+            return None
+        return row[0] if row else None
+
+    def _set(self, path: str, column: str, value: str, stat: Optional[os.stat_result] = None):
+        key = self.file_key(path, stat)
+        if key is None:
+            return
+        try:
+            with self._lock, self.connection:
+                self._update(key, column, value)
+        except sqlite3.Error:
+            pass
+
+    def _update(self, key: Tuple[str, int, int, int], column: str, value: str):
+        row = self.connection.execute('SELECT size, mtime, inode, thumbnail FROM media WHERE path = ?',
+                                      key[:1]).fetchone()
+        if row and tuple(row[:3]) == key[1:]:
+            self.connection.execute('UPDATE media SET {} = ? WHERE path = ?'.format(column), (value, key[0]))
+            return
+        if row and row[3]:
+            # The file has changed. The previous thumbnail is no longer valid.
+            self._remove_thumbnail(row[3])
+        self.connection.execute(
+            'INSERT OR REPLACE INTO media (path, size, mtime, inode, {}) VALUES (?, ?, ?, ?, ?)'.format(column),
+            key + (value,)
+        )
+
+    def get_probe(self, path: str, stat: Optional[os.stat_result] = None) -> Optional[MediaProbe]:
+        """Cached media probe of the file. None if the file is not in the cache or it has changed."""
+        data = self._get(path, 'probe', stat)
+        if data is not None:
+            return MediaProbe(**json.loads(data))
+
+    def set_probe(self, path: str, probe: MediaProbe, stat: Optional[os.stat_result] = None):
+        self._set(path, 'probe', json.dumps(probe.as_dict()), stat)
+
+    def get_thumbnail(self, path: str, stat: Optional[os.stat_result] = None) -> Optional[str]:
+        """Copy of the cached thumbnail of the file in a temporary file. The copy can be removed after the
+        upload. None if the thumbnail is not in the cache or the file has changed.
+        """
+        thumbnail = self._get(path, 'thumbnail', stat)
+        if thumbnail is None or not os.path.lexists(thumbnail):
+            return None
+        output = tempfile.NamedTemporaryFile(suffix=os.path.splitext(thumbnail)[1], delete=False)
+        with output, open(thumbnail, 'rb') as file:
+            shutil.copyfileobj(file, output)
+        return output.name
+
+    def set_thumbnail(self, path: str, thumbnail: str, stat: Optional[os.stat_result] = None):
+        """Save a copy of the thumbnail generated for the file."""
+        key = self.file_key(path, stat)
+        if key is None:
+            return
+        name = hashlib.sha1(json.dumps(key).encode('utf-8')).hexdigest() + os.path.splitext(thumbnail)[1]
+        cached = os.path.join(self.thumbnails_directory, name)
+        try:
+            os.makedirs(self.thumbnails_directory, exist_ok=True)
+            shutil.copyfile(thumbnail, cached)
+        except OSError:
+            return
+        self._set(path, 'thumbnail', cached, stat)
+
+    @staticmethod
+    def _remove_thumbnail(thumbnail: str):
+        if os.path.lexists(thumbnail):
+            os.remove(thumbnail)
+
+    def close(self):
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+
+def get_media_cache() -> Optional[MediaCache]:
+    """Shared media cache. None if the cache is disabled or the cache file cannot be opened."""
+    global _media_cache
+    if not MEDIA_CACHE:
+        return None
+    with _media_cache_lock:
+        if _media_cache is None:
+            try:
+                _media_cache = MediaCache()
+                _media_cache.connection
+            except (OSError, sqlite3.Error):
+                _media_cache = None
+        return _media_cache
+
+
+class UploadIndex:
+    """Index of the files uploaded to each destination. A file is considered uploaded if its path, name (the
+    name of the part for split files), size and modification time have not changed since the upload. The
+    message id is saved to find the uploaded file.
+
+    The index also maps the content hash of the files to the documents uploaded, so the same content can be
+    sent again without uploading it (for example, to another chat or after renaming the file).
+    """
+    def __init__(self, path: str = UPLOAD_INDEX_FILE):
+        self.path = path
+        self._connection: Optional[sqlite3.Connection] = None
+
+    @property
+    def connection(self) -> sqlite3.Connection:
+        if self._connection is None:
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            self._connection = sqlite3.connect(self.path)
+            self._connection.execute(
+                'CREATE TABLE IF NOT EXISTS uploads (path TEXT, name TEXT, destination TEXT, size INTEGER, '
+                'mtime INTEGER, message_id INTEGER, hash TEXT, uploaded_at REAL, PRIMARY KEY (path, name, destination))'
+            )
+            self._connection.execute(
+                'CREATE TABLE IF NOT EXISTS documents (hash TEXT, size INTEGER, id INTEGER, access_hash INTEGER, '
+                'file_reference BLOB, uploaded_at REAL, PRIMARY KEY (hash, size))'
+            )
+        return self._connection
+
+    @staticmethod
+    def _key(path: str, name: str, destination) -> Tuple[str, str, str]:
+        return os.path.abspath(path), name, str(destination)
+
+    def is_uploaded(self, path: str, name: str, destination, stat: os.stat_result) -> bool:
+        """Returns if the file has been uploaded to the destination and it has not changed since then."""
+        row = self.connection.execute(
+            'SELECT size, mtime FROM uploads WHERE path = ? AND name = ? AND destination = ?',
+            self._key(path, name, destination)
+        ).fetchone()
+        return row is not None and tuple(row) == (stat.st_size, stat.st_mtime_ns)
+
+    def add(self, path: str, name: str, destination, stat: os.stat_result, message_id: int,
+            content_hash: Optional[str] = None):
+        """Save the upload of the file to the destination."""
+        with self.connection:
+            self.connection.execute(
+                'INSERT OR REPLACE INTO uploads (path, name, destination, size, mtime, message_id, hash, uploaded_at) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                self._key(path, name, destination) + (stat.st_size, stat.st_mtime_ns, message_id, content_hash,
+                                                      time.time())
+            )
+
+    def get_document(self, content_hash: str, size: int) -> Optional[InputDocument]:
+        """Document already uploaded with the same content. None if the content has not been uploaded."""
+        row = self.connection.execute(
+            'SELECT id, access_hash, file_reference FROM documents WHERE hash = ? AND size = ?', (content_hash, size)
+        ).fetchone()
+        if row is not None:
+            return InputDocument(row[0], row[1], bytes(row[2]))
+
+    def add_document(self, content_hash: str, size: int, document: Document):
+        """Save the document uploaded with the content. It can be sent again without uploading the content."""
+        with self.connection:
+            self.connection.execute(
+                'INSERT OR REPLACE INTO documents (hash, size, id, access_hash, file_reference, uploaded_at) '
+                'VALUES (?, ?, ?, ?, ?, ?)',
+                (content_hash, size, document.id, document.access_hash, document.file_reference, time.time())
+            )
+
+    def remove_document(self, content_hash: str, size: int):
+        """Remove a document that can no longer be sent."""
+        with self.connection:
+            self.connection.execute('DELETE FROM documents WHERE hash = ? AND size = ?', (content_hash, size))
+
+    def close(self):
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
@@ -185,14 +185,30 @@ class FileMedia:
         return self._get_metadata('producer')
 
 
+def calculate_hash(path: str, hash_calculator: Any, offset: int = 0, length: Optional[int] = None,
+                   chunk_size: int = CHUNK_SIZE) -> str:
+    """Calculate the hash of the file reading it in blocks. If length is given, only the bytes from offset
+    to offset + length are used (a part of a split file).
+    """
+    with open(path, "rb") as f:
+        if offset:
+            f.seek(offset)
+        remaining = length
+        # Read and update hash string value in blocks
+        while remaining is None or remaining > 0:
+            byte_block = f.read(chunk_size if remaining is None else min(chunk_size, remaining))
+            if not byte_block:
+                break
+            hash_calculator.update(byte_block)
+            if remaining is not None:
+                remaining -= len(byte_block)
+        return hash_calculator.hexdigest()
+
+
 class FileMixin:
 
     def _calculate_hash(self, hash_calculator: Any) -> str:
-        with open(str(self), "rb") as f:
-            # Read and update hash string value in blocks
-            for byte_block in iter(lambda: f.read(CHUNK_SIZE), b""):
-                hash_calculator.update(byte_block)
-            return hash_calculator.hexdigest()
+        return calculate_hash(str(self), hash_calculator)
 
     @property
     def md5(self) -> str:
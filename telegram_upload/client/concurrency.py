@@ -0,0 +1,193 @@
+import asyncio
+import random
+import time
+from typing import Coroutine, Dict, List, Optional, Set
+
+from telegram_upload.utils import get_environment_integer
+
+
+MAX_PARALLEL_UPLOAD_BLOCKS = get_environment_integer('TELEGRAM_UPLOAD_MAX_PARALLEL_UPLOAD_BLOCKS', 16)
+# A part slower than this factor over the fastest part is a sign of congestion
+LATENCY_TOLERANCE = 2
+
+
+def backoff_delay(retry: int, minimum: float, maximum: float) -> float:
+    """Exponential backoff with jitter for the retry number (starting at 0). The delay is between half and
+    the full exponential value, so the clients (or the parts) that failed together do not retry together.
+    """
+    delay = min(maximum, minimum * 2 ** retry)
+    return delay / 2 + random.uniform(0, delay / 2)
+
+
+class FloodWaitGate:
+    """Hold the requests to a DC after a flood wait error. Only the tasks using that DC wait, without blocking
+    the event loop, so the transfers to other DCs and the connection keepalives continue.
+    """
+    def __init__(self):
+        self._open_at: Dict[int, float] = {}
+
+    def close(self, dc_id: int, seconds: float) -> None:
+        """Close the gate of the DC for the given seconds. An earlier close is extended, never shortened."""
+        self._open_at[dc_id] = max(self._open_at.get(dc_id, 0), time.monotonic() + seconds)
+
+    def remaining(self, dc_id: int) -> float:
+        """Seconds until the gate of the DC opens."""
+        return max(0.0, self._open_at.get(dc_id, 0) - time.monotonic())
+
+    async def wait(self, dc_id: int) -> None:
+        """Wait until the gate of the DC is open."""
+        # The gate can be closed again while waiting
+        while self.remaining(dc_id):
+            await asyncio.sleep(self.remaining(dc_id))
+        self._open_at.pop(dc_id, None)
+
+
+class RateLimiter:
+    """Token bucket limiting the requests per second. Up to ``burst`` requests are sent without waiting,
+    then the requests are spread at ``rate`` requests per second.
+    """
+    def __init__(self, rate: float, burst: Optional[int] = None):
+        self.rate = max(rate, 0.001)
+        self.burst = max(1, burst or int(rate))
+        self.tokens = float(self.burst)
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    async def acquire(self) -> None:
+        """Wait until a request can be sent."""
+        # The waiters are served in order
+        async with self._lock:
+            self._refill()
+            while self.tokens < 1:
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+                self._refill()
+            self.tokens -= 1
+
+
+class AdaptiveUploadWindow:
+    """Limit the number of file parts uploading at the same time. The window is adjusted using AIMD
+    (additive increase, multiplicative decrease): every part uploaded without delay increases the window
+    by one part per round trip, and every congestion signal (flood wait, 429 errors, reconnects) halves it.
+    """
+    def __init__(self, initial: int, minimum: int = 1, maximum: int = MAX_PARALLEL_UPLOAD_BLOCKS):
+        self.minimum = minimum
+        self.maximum = max(minimum, maximum)
+        self.window = float(min(max(initial, self.minimum), self.maximum))
+        self.in_flight = 0
+        self.min_latency: Optional[float] = None
+        self._last_decrease = 0.0
+        self._waiters: List[asyncio.Future] = []
+
+    @property
+    def size(self) -> int:
+        """Current number of parts allowed in flight."""
+        return int(self.window)
+
+    async def acquire(self) -> None:
+        """Wait until there is room in the window for another part."""
+        while self.in_flight >= self.size:
+            waiter = asyncio.get_running_loop().create_future()
+            self._waiters.append(waiter)
+            try:
+                await waiter
+            finally:
+                if waiter in self._waiters:
+                    self._waiters.remove(waiter)
+        self.in_flight += 1
+
+    def release(self, latency: Optional[float] = None) -> None:
+        """Free the slot of a part. If the latency of the uploaded part is given and it is not delayed,
+        the window is increased.
+        """
+        self.in_flight = max(0, self.in_flight - 1)
+        if latency is not None:
+            self._on_latency(latency)
+        self._wake_up()
+
+    def _on_latency(self, latency: float) -> None:
+        if self.min_latency is None or latency < self.min_latency:
+            self.min_latency = latency
+        if latency <= self.min_latency * LATENCY_TOLERANCE:
+            # Additive increase: one part more after a full window of parts
+            self.window = min(self.maximum, self.window + 1 / self.window)
+
+    def decrease(self) -> None:
+        """Multiplicative decrease after a congestion signal. The parts in flight usually fail together,
+        so only one decrease is applied per round trip.
+        """
+        now = time.monotonic()
+        if now - self._last_decrease < (self.min_latency or 1):
+            return
+        self._last_decrease = now
+        self.window = max(self.minimum, self.window / 2)
+
+    def _wake_up(self) -> None:
+        for waiter in self._waiters[:max(0, self.size - self.in_flight)]:
+            if not waiter.done():
+                waiter.set_result(None)
+
+
+class UploadSession:
+    """Own the tasks of the parts of a single upload, like ``asyncio.TaskGroup`` (not available before
+    Python 3.11). Leaving the session waits for its tasks only, so several uploads can run at the same time.
+    The first part failure cancels the other parts and is raised when the session is left.
+
+    .. code-block:: python
+
+        async with UploadSession() as session:
+            for request in requests:
+                session.raise_for_error()
+                session.create_task(send(request))
+    """
+    def __init__(self):
+        self.tasks: Set[asyncio.Task] = set()
+        self.error: Optional[BaseException] = None
+
+    def create_task(self, coro: Coroutine, name: Optional[str] = None) -> asyncio.Task:
+        """Start a task owned by the session."""
+        task = asyncio.get_running_loop().create_task(coro)
+        if name is not None:
+            task.set_name(name)
+        self.tasks.add(task)
+        task.add_done_callback(self._on_task_done)
+        return task
+
+    def _on_task_done(self, task: asyncio.Task) -> None:
+        self.tasks.discard(task)
+        if task.cancelled() or task.exception() is None or self.error is not None:
+            return
+        self.error = task.exception()
+        self.cancel()
+
+    def raise_for_error(self) -> None:
+        """Raise the error of the first failed task, if any."""
+        if self.error is not None:
+            raise self.error
+
+    def cancel(self) -> None:
+        """Cancel the pending tasks."""
+        for task in self.tasks:
+            task.cancel()
+
+    async def wait(self) -> None:
+        """Wait for all the tasks. The error of the first failed task is raised."""
+        while self.tasks:
+            await asyncio.wait(set(self.tasks))
+        self.raise_for_error()
+
+    async def __aenter__(self) -> 'UploadSession':
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb) -> None:
+        if exc_type is not None:
+            self.cancel()
+            # Wait for the cancelled tasks, so they do not outlive the upload
+            while self.tasks:
+                await asyncio.wait(set(self.tasks))
+        else:
+            await self.wait()
@@ -0,0 +1,93 @@
+import asyncio
+import itertools
+from typing import List, Optional, TYPE_CHECKING
+
+from telethon.network import MTProtoSender
+from telethon.tl import functions
+from telethon.tl.alltlobjects import LAYER
+
+if TYPE_CHECKING:
+    from telethon import TelegramClient
+
+
+class SenderPool:
+    """Pool of extra MTProto senders (connections) to a Telegram DC. The requests are spread across the
+    connections using round-robin, so the throughput is not limited by a single TCP connection.
+
+    The senders to the DC of the session reuse its auth key. For other DCs, the authorization is exported
+    once and the auth key of the first sender is reused by the others.
+    """
+    def __init__(self, client: 'TelegramClient', dc_id: int, size: int):
+        self.client = client
+        self.dc_id = dc_id
+        self.size = size
+        self.senders: List[MTProtoSender] = []
+        self._cycle = None
+        self._auth_key = client.session.auth_key if dc_id == client.session.dc_id else None
+        self._lock = asyncio.Lock()
+
+    async def connect(self) -> 'SenderPool':
+        """Connect all the senders of the pool. Calling it again has no effect."""
+        async with self._lock:
+            while len(self.senders) < self.size:
+                self.senders.append(await self._create_sender())
+            self._cycle = itertools.cycle(self.senders)
+        return self
+
+    async def _create_sender(self) -> MTProtoSender:
+        dc = await self.client._get_dc(self.dc_id)
+        sender = MTProtoSender(self._auth_key, loggers=self.client._log)
+        await sender.connect(self.client._connection(
+            dc.ip_address,
+            dc.port,
+            dc.id,
+            loggers=self.client._log,
+            proxy=self.client._proxy,
+            local_addr=self.client._local_addr,
+        ))
+        if self._auth_key is None:
+            auth = await self.client(functions.auth.ExportAuthorizationRequest(self.dc_id))
+            self.client._init_request.query = functions.auth.ImportAuthorizationRequest(id=auth.id, bytes=auth.bytes)
+            await sender.send(functions.InvokeWithLayerRequest(LAYER, self.client._init_request))
+            self._auth_key = sender.auth_key
+        return sender
+
+    def get(self) -> Optional[MTProtoSender]:
+        """Get the next sender. Returns None if the pool is not connected."""
+        if self._cycle is None:
+            return None
+        return next(self._cycle)
+
+    async def send(self, request):
+        """Send the request using the next sender of the pool. If the sender has lost its connection (it
+        has given up reconnecting), it is replaced by a new one and the request is sent again.
+        """
+        sender = self.get()
+        try:
+            return await self.client._call(sender, request)
+        except ConnectionError:
+            sender = await self._replace_sender(sender)
+            return await self.client._call(sender, request)
+
+    async def _replace_sender(self, sender: MTProtoSender) -> MTProtoSender:
+        """Replace the disconnected sender by a new one. The sender is kept if the new one cannot be
+        connected, so it is replaced in the next request.
+        """
+        async with self._lock:
+            if sender not in self.senders:
+                # Replaced in another task or the pool has been disconnected
+                if self._cycle is None:
+                    raise ConnectionError('The sender pool is disconnected')
+                return next(self._cycle)
+            new_sender = await self._create_sender()
+            self.senders[self.senders.index(sender)] = new_sender
+            self._cycle = itertools.cycle(self.senders)
+        await sender.disconnect()
+        return new_sender
+
+    async def disconnect(self) -> None:
+        async with self._lock:
+            for sender in self.senders:
+                await sender.disconnect()
+            self.senders = []
+            self._cycle = None
@@ -1,31 +1,67 @@
 import asyncio
+import contextlib
+import functools
 import inspect
 import io
+import itertools
+import os
 import pathlib
-import sys
+from collections import deque
 from typing import Iterable
 
 import typing
 
-from more_itertools import grouper
 from telethon import TelegramClient, utils, helpers
-from telethon.client.downloads import MIN_CHUNK_SIZE
+from telethon.client.downloads import MIN_CHUNK_SIZE, TIMED_OUT_SLEEP
 from telethon.crypto import AES
+from telethon.errors import FileMigrateError, FilerefUpgradeNeededError, FileReferenceExpiredError, TimedOutError
+from telethon.tl import types, functions
 
 from telegram_upload.client.progress_bar import get_progress_bar
-from telegram_upload.download_files import DownloadFile
-from telegram_upload.exceptions import TelegramUploadNoSpaceError
-from telegram_upload.utils import free_disk_usage, sizeof_fmt, get_environment_integer
+from telegram_upload.client.senders import SenderPool
+from telegram_upload.download_files import DownloadFile, JoinedDownloadFile
+from telegram_upload.exceptions import TelegramUploadNoSpaceError, TelegramUploadIncompleteDownloadError, \
+    TelegramUploadError
+from telegram_upload.resume import DownloadBitmap, PARTIAL_DOWNLOAD_SUFFIX, DOWNLOAD_BITMAP_SUFFIX
+from telegram_upload.utils import free_disk_usage, sizeof_fmt, get_environment_integer, preallocate_file, \
+    async_to_sync, TransferBudget
 
 
-if sys.version_info < (3, 10):
-    from telegram_upload._compat import anext
+if typing.TYPE_CHECKING:
+    from telethon import hints
 
 
 PARALLEL_DOWNLOAD_BLOCKS = get_environment_integer('TELEGRAM_UPLOAD_PARALLEL_DOWNLOAD_BLOCKS', 10)
+# Maximum bytes held by the chunks downloaded but not written yet (in-flight chunks included)
+DOWNLOAD_BUFFER_SIZE = get_environment_integer('TELEGRAM_UPLOAD_DOWNLOAD_BUFFER_SIZE', 16 * 1024 * 1024)
+# Number of parts of a split file downloaded at the same time
+PARALLEL_DOWNLOAD_PARTS = get_environment_integer('TELEGRAM_UPLOAD_PARALLEL_DOWNLOAD_PARTS', 2)
+# Download the parts of a split file into the joined file. With 0 the parts are downloaded and joined after.
+DOWNLOAD_JOIN_IN_PLACE = get_environment_integer('TELEGRAM_UPLOAD_DOWNLOAD_JOIN_IN_PLACE', 1)
+# Number of files downloaded at the same time and the maximum size of these files
+PARALLEL_DOWNLOAD_FILES = get_environment_integer('TELEGRAM_UPLOAD_PARALLEL_DOWNLOAD_FILES', 1)
+PARALLEL_DOWNLOAD_FILES_SIZE = get_environment_integer('TELEGRAM_UPLOAD_PARALLEL_DOWNLOAD_FILES_SIZE',
+                                                       64 * 1024 * 1024)
+# Maximum messages deleted in a single request
+DELETE_MESSAGES_BATCH = 100
+# Number of connections to each DC to download the chunks. With 1 the main connection is used for its DC.
+DOWNLOAD_CONNECTIONS = get_environment_integer('TELEGRAM_UPLOAD_DOWNLOAD_CONNECTIONS', 1)
+# Number of chunk requests in flight to each DC, for all the files downloading at the same time
+PARALLEL_DOWNLOAD_DC_REQUESTS = get_environment_integer('TELEGRAM_UPLOAD_PARALLEL_DOWNLOAD_DC_REQUESTS', 16)
 
 
 class TelegramDownloadClient(TelegramClient):
+    def __init__(self, *args, **kwargs):
+        # The connections to each DC are kept for all the files. The authorization is exported only once per DC.
+        self.download_sender_pools: typing.Dict[int, SenderPool] = {}
+        self.download_dc_semaphores: typing.Dict[int, asyncio.Semaphore] = {}
+        # DC of the documents, learned from the messages and from the file migrate errors
+        self.document_dc_ids: typing.Dict[int, int] = {}
+        self.download_sender_pools_lock = asyncio.Lock()
+        # File names of the downloads in progress. Two downloads at the same time cannot use the same file.
+        self.downloading_file_names: typing.Set[str] = set()
+        super().__init__(*args, **kwargs)
+
     def find_files(self, entity):
         for message in self.iter_messages(entity):
             if message.document:
@@ -39,24 +75,285 @@ class TelegramDownloadClient(TelegramClient):
                 yield message
 
     def download_files(self, entity, download_files: Iterable[DownloadFile], delete_on_success: bool = False):
-        for download_file in download_files:
-            if download_file.size > free_disk_usage():
-                raise TelegramUploadNoSpaceError(
-                    'There is no disk space to download "{}". Space required: {}'.format(
-                        download_file.file_name, sizeof_fmt(download_file.size - free_disk_usage())
-                    )
+        if PARALLEL_DOWNLOAD_FILES > 1:
+            return async_to_sync(self._download_files_concurrently(entity, download_files, delete_on_success))
+        # The messages of the downloaded files are deleted in batches
+        delete_messages = []
+        try:
+            for download_file in download_files:
+                self._check_free_disk_usage(download_file)
+                progress, bar = get_progress_bar('Downloading', download_file.file_name, download_file.size)
+                file_name = download_file.file_name
+                try:
+                    self._add_document_dc_ids(download_file)
+                    if isinstance(download_file, JoinedDownloadFile):
+                        file_name = async_to_sync(self._download_joined_file(download_file,
+                                                                             progress_callback=progress))
+                    else:
+                        file_name = self.download_media(download_file.message, progress_callback=progress)
+                    download_file.set_download_file_name(file_name)
+                finally:
+                    bar.label = f'Downloaded  "{file_name}"'
+                    bar.update(1, 1)
+                    bar.render_finish()
+                if delete_on_success:
+                    delete_messages.extend(self._get_download_file_messages(download_file))
+                if len(delete_messages) >= DELETE_MESSAGES_BATCH:
+                    self.delete_messages(entity, delete_messages)
+                    delete_messages = []
+        finally:
+            # The files downloaded before an error are deleted too
+            if delete_messages:
+                self.delete_messages(entity, delete_messages)
+
+    @staticmethod
+    def _check_free_disk_usage(download_file: DownloadFile):
+        if download_file.size > free_disk_usage():
+            raise TelegramUploadNoSpaceError(
+                'There is no disk space to download "{}". Space required: {}'.format(
+                    download_file.file_name, sizeof_fmt(download_file.size - free_disk_usage())
                 )
-            progress, bar = get_progress_bar('Downloading', download_file.file_name, download_file.size)
-            file_name = download_file.file_name
-            try:
-                file_name = self.download_media(download_file.message, progress_callback=progress)
-                download_file.set_download_file_name(file_name)
-            finally:
-                bar.label = f'Downloaded  "{file_name}"'
-                bar.update(1, 1)
-                bar.render_finish()
-            if delete_on_success:
-                self.delete_messages(entity, [download_file.message])
+            )
+
+    def _add_document_dc_ids(self, download_file: DownloadFile):
+        """Remember the DC of the documents, so their chunks are requested to the right DC."""
+        download_files = download_file.download_files if isinstance(download_file, JoinedDownloadFile) \
+            else [download_file]
+        for part in download_files:
+            if isinstance(part.document, types.Document):
+                self.document_dc_ids[part.document.id] = part.document.dc_id
+
+    @staticmethod
+    def _get_download_file_messages(download_file: DownloadFile) -> list:
+        if isinstance(download_file, JoinedDownloadFile):
+            return download_file.messages
+        return [download_file.message]
+
+    async def _download_files_concurrently(self, entity, download_files: Iterable[DownloadFile],
+                                           delete_on_success: bool = False):
+        """Download up to ``PARALLEL_DOWNLOAD_FILES`` files at the same time. The files downloading at the same
+        time cannot exceed ``PARALLEL_DOWNLOAD_FILES_SIZE`` bytes, so the small files are downloaded together and
+        the large files, which already download their chunks in parallel, are downloaded one after another. The
+        messages of the downloaded files are deleted in batches. The progress bars are not available in this mode.
+
+        :param entity: Chat of the messages. Used to delete the messages.
+        :param download_files: Files to download.
+        :param delete_on_success: Delete the messages after downloading the files.
+        :return: None
+        """
+        budget = TransferBudget(PARALLEL_DOWNLOAD_FILES_SIZE, PARALLEL_DOWNLOAD_FILES)
+        downloads = set()
+        errors = []
+        delete_messages = []
+
+        async def delete_downloaded_messages(batch_size: int):
+            nonlocal delete_messages
+            if delete_on_success and len(delete_messages) >= batch_size:
+                messages, delete_messages = delete_messages, []
+                await self.delete_messages(entity, messages)
+
+        def on_download_done(download: asyncio.Future):
+            downloads.discard(download)
+            if download.cancelled():
+                return
+            elif download.exception() is not None:
+                errors.append(download.exception())
+            else:
+                delete_messages.extend(self._get_download_file_messages(download.result()))
+
+        try:
+            for download_file in download_files:
+                self._check_free_disk_usage(download_file)
+                await budget.acquire(download_file.size)
+                if errors:
+                    raise errors[0]
+                download = asyncio.ensure_future(self._download_file_in_budget(download_file, budget))
+                download.add_done_callback(on_download_done)
+                downloads.add(download)
+                await delete_downloaded_messages(DELETE_MESSAGES_BATCH)
+            while downloads and not errors:
+                await asyncio.wait(set(downloads), return_when=asyncio.FIRST_COMPLETED)
+            if errors:
+                raise errors[0]
+        finally:
+            for download in downloads:
+                download.cancel()
+            # The files downloaded before an error are deleted too
+            await delete_downloaded_messages(1)
+
+    async def _download_file_in_budget(self, download_file: DownloadFile, budget: TransferBudget) -> DownloadFile:
+        """Download the file and return the size to the budget. Returns the download file."""
+        try:
+            self._add_document_dc_ids(download_file)
+            if isinstance(download_file, JoinedDownloadFile):
+                file_name = await self._download_joined_file(download_file)
+            else:
+                file_name = await self._download_file_media(download_file)
+            download_file.set_download_file_name(file_name)
+        finally:
+            await budget.release(download_file.size)
+        return download_file
+
+    async def _download_file_media(self, download_file: DownloadFile,
+                                   progress_callback: 'hints.ProgressCallback' = None) -> str:
+        """Download the document of the file to a file name not used by the other downloads in progress."""
+        with self._reserve_download_file_name(self._get_download_file_name(download_file)) as file_name:
+            return await self.download_media(download_file.message, file=file_name,
+                                             progress_callback=progress_callback)
+
+    def _get_download_file_name(self, download_file: DownloadFile) -> str:
+        """Get the file name of the document in the current directory, as Telethon does by default."""
+        document = download_file.document
+        if download_file.filename_attr:
+            file_name = os.path.basename(download_file.file_name)
+            if not os.path.splitext(file_name)[1]:
+                file_name += utils.get_extension(document)
+            return file_name
+        kind, possible_names = self._get_kind_and_names(document.attributes)
+        return self._get_proper_filename(None, kind, utils.get_extension(document),
+                                         date=download_file.message.date, possible_names=possible_names)
+
+    @contextlib.contextmanager
+    def _reserve_download_file_name(self, file_name: str) -> typing.Iterator[str]:
+        """Reserve a file name not used by an existing file or by another download in progress. As in Telethon,
+        a number is added to the name if it is used. The name is released on exit.
+        """
+        name, extension = os.path.splitext(file_name)
+        index = 1
+        while file_name in self.downloading_file_names or os.path.isfile(file_name):
+            file_name = f'{name} ({index}){extension}'
+            index += 1
+        self.downloading_file_names.add(file_name)
+        try:
+            yield file_name
+        finally:
+            self.downloading_file_names.discard(file_name)
+
+    async def _download_joined_file(self, joined_file: JoinedDownloadFile,
+                                    progress_callback: 'hints.ProgressCallback' = None) -> str:
+        """Download the parts of a split file at the same time, up to ``PARALLEL_DOWNLOAD_PARTS`` parts. Every
+        part is written at its offset in the joined file, so the parts are not joined after the download. Each
+        part has its own bitmap, so the download can be resumed. If the parts cannot be written at their offsets
+        (``DOWNLOAD_JOIN_IN_PLACE`` disabled or ``os.pwrite`` not available), they are downloaded to separate
+        files and joined after the download.
+
+        :param joined_file: File joined from the split parts.
+        :param progress_callback: Callback with the bytes written of all the parts. Optional.
+        :return: File name of the joined file.
+        """
+        with self._reserve_download_file_name(joined_file.file_name) as file_name:
+            if not DOWNLOAD_JOIN_IN_PLACE or not hasattr(os, 'pwrite'):
+                return await self._download_and_join_parts(joined_file, file_name, progress_callback)
+            return await self._download_parts_in_place(joined_file, file_name, progress_callback)
+
+    async def _download_parts_in_place(self, joined_file: JoinedDownloadFile, file_name: str,
+                                       progress_callback: 'hints.ProgressCallback' = None) -> str:
+        """Download the parts of a split file at their offsets in the joined file. See
+        :meth:`_download_joined_file`.
+        """
+        partial_file_name = file_name + PARTIAL_DOWNLOAD_SUFFIX
+        helpers.ensure_parent_dir_exists(file_name)
+        semaphore = asyncio.Semaphore(max(1, PARALLEL_DOWNLOAD_PARTS))
+        on_part_progress = self._get_parts_progress_callback(joined_file, progress_callback)
+        bitmaps = [self._get_part_bitmap(partial_file_name, download_file)
+                   for download_file in joined_file.download_files]
+        # The partial file is reused if any of the parts can be resumed
+        fd = os.open(partial_file_name, os.O_WRONLY | os.O_CREAT, 0o644)
+        try:
+            self._prepare_partial_file(fd, joined_file.size, any(bitmap.is_resumable() for bitmap in bitmaps))
+            await asyncio.gather(*[
+                self._download_part_at_offset(fd, download_file, offset, bitmap, semaphore,
+                                              functools.partial(on_part_progress, index))
+                for index, ((download_file, offset), bitmap) in enumerate(zip(joined_file.parts, bitmaps))
+            ])
+        finally:
+            os.close(fd)
+        for bitmap in bitmaps:
+            self._check_download_complete(bitmap, file_name)
+        os.replace(partial_file_name, file_name)
+        for bitmap in bitmaps:
+            bitmap.remove()
+        return file_name
+
+    async def _download_and_join_parts(self, joined_file: JoinedDownloadFile, file_name: str,
+                                       progress_callback: 'hints.ProgressCallback' = None) -> str:
+        """Download the parts of a split file to separate files, up to ``PARALLEL_DOWNLOAD_PARTS`` parts at the
+        same time, and join them after the download. The parts are joined in a thread, by the kernel if possible.
+        """
+        semaphore = asyncio.Semaphore(max(1, PARALLEL_DOWNLOAD_PARTS))
+        on_part_progress = self._get_parts_progress_callback(joined_file, progress_callback)
+
+        async def download_part(index: int, download_file: DownloadFile):
+            async with semaphore:
+                part_file_name = await self._download_file_media(
+                    download_file, functools.partial(on_part_progress, index)
+                )
+            download_file.set_download_file_name(part_file_name)
+
+        await asyncio.gather(*[download_part(index, download_file)
+                               for index, download_file in enumerate(joined_file.download_files)])
+        return await asyncio.get_running_loop().run_in_executor(None, joined_file.join_download_files, file_name)
+
+    @staticmethod
+    def _get_parts_progress_callback(joined_file: JoinedDownloadFile,
+                                     progress_callback: 'hints.ProgressCallback' = None) -> typing.Callable:
+        """Get a callback with the part index for the parts, which calls the progress callback of the joined
+        file with the bytes downloaded of all the parts.
+        """
+        written = {}
+
+        def on_part_progress(index: int, current: int, total: int):
+            written[index] = current
+            if progress_callback:
+                return progress_callback(sum(written.values()), joined_file.size)
+        return on_part_progress
+
+    @staticmethod
+    def _get_part_bitmap(partial_file_name: str, download_file: DownloadFile) -> DownloadBitmap:
+        """Get the bitmap of a part of a split file downloaded into the joined file."""
+        document = download_file.document
+        part_size = int(utils.get_appropriated_part_size(document.size) * 1024)
+        return DownloadBitmap(f'{partial_file_name}.{download_file.file_name_extension}{DOWNLOAD_BITMAP_SUFFIX}',
+                              document.id, document.size, part_size)
+
+    async def _download_part_at_offset(self, fd: int, download_file: DownloadFile, offset: int,
+                                       bitmap: DownloadBitmap, semaphore: asyncio.Semaphore,
+                                       progress_callback: 'hints.ProgressCallback' = None) -> None:
+        """Download a part of a split file at its offset in the joined file, marking its chunks in the bitmap."""
+        document = download_file.document
+        input_location = types.InputDocumentFileLocation(
+            id=document.id, access_hash=document.access_hash, file_reference=document.file_reference,
+            thumb_size='',
+        )
+        msg_data = (download_file.message.input_chat, download_file.message.id)
+        async with semaphore:
+            with bitmap:
+                offsets = list(bitmap.missing_offsets())
+                chunk_tasks = self._iter_download_chunk_tasks(input_location, bitmap.part_size, document.dc_id,
+                                                              msg_data, document.size, offsets)
+                await self._write_download_chunks_at_offsets(
+                    fd, zip(offsets, chunk_tasks), bitmap.part_size, document.size, progress_callback, bitmap,
+                    base_offset=offset,
+                )
+
+    @staticmethod
+    def _check_download_complete(bitmap: DownloadBitmap, file_name: str):
+        """Raise an error if there are chunks not written. The partial file and the bitmap are kept, so the
+        download can be resumed.
+        """
+        missing = len(list(bitmap.missing_offsets()))
+        if missing:
+            raise TelegramUploadIncompleteDownloadError(
+                '{} chunks of "{}" were not downloaded. Retry to resume the download.'.format(missing, file_name)
+            )
+
+    @staticmethod
+    def _prepare_partial_file(fd: int, file_size: int, resumed: bool):
+        """Set the partial file to the download size and reserve its disk space. The bytes of a bigger partial
+        file left by another download are removed, and all the data is discarded if it cannot be resumed.
+        """
+        os.ftruncate(fd, file_size if resumed else 0)
+        preallocate_file(fd, file_size)
 
     async def _download_file(
             self: 'TelegramClient',
@@ -85,8 +382,16 @@ class TelegramDownloadClient(TelegramClient):
             file = str(file.absolute())
 
         in_memory = file is None or file is bytes
+        # The chunks can be written at their offsets as they arrive if the file is on disk. The encrypted
+        # downloads are decrypted in order, so they are always written sequentially.
+        positional = isinstance(file, str) and file_size and not (key and iv) and hasattr(os, 'pwrite')
         if in_memory:
             f = io.BytesIO()
+        elif positional:
+            # Ensure that we'll be able to download the media
+            helpers.ensure_parent_dir_exists(file)
+            # The partial file is opened without truncating it, so the chunks already downloaded can be reused
+            f = os.fdopen(os.open(file + PARTIAL_DOWNLOAD_SUFFIX, os.O_WRONLY | os.O_CREAT, 0o644), 'wb')
         elif isinstance(file, str):
             # Ensure that we'll be able to download the media
             helpers.ensure_parent_dir_exists(file)
@@ -95,28 +400,28 @@ class TelegramDownloadClient(TelegramClient):
             f = file
 
         try:
-            # The speed of this code can be improved. 10 requests are made in parallel, but it waits for all 10 to
-            # finish before launching another 10.
-            for tasks in grouper(self._iter_download_chunk_tasks(input_location, part_size, dc_id, msg_data, file_size),
-                                 PARALLEL_DOWNLOAD_BLOCKS):
-                tasks = list(filter(bool, tasks))
-                await asyncio.wait(tasks)
-                chunk = b''.join(filter(bool, [task.result() for task in tasks]))
-                if not chunk:
-                    break
-                if iv and key:
-                    chunk = AES.decrypt_ige(chunk, key, iv)
-                r = f.write(chunk)
-                if inspect.isawaitable(r):
-                    await r
-
-                if progress_callback:
-                    r = progress_callback(f.tell(), file_size)
-                    if inspect.isawaitable(r):
-                        await r
+            if positional:
+                bitmap = DownloadBitmap(file + PARTIAL_DOWNLOAD_SUFFIX + DOWNLOAD_BITMAP_SUFFIX,
+                                        getattr(input_location, 'id', 0), file_size, part_size)
+                with bitmap:
+                    self._prepare_partial_file(f.fileno(), file_size, bitmap.resumed)
+                    offsets = list(bitmap.missing_offsets())
+                    chunk_tasks = self._iter_download_chunk_tasks(input_location, part_size, dc_id, msg_data,
+                                                                  file_size, offsets)
+                    await self._write_download_chunks_at_offsets(
+                        f.fileno(), zip(offsets, chunk_tasks), part_size, file_size, progress_callback, bitmap
+                    )
+                f.close()
+                self._check_download_complete(bitmap, file)
+                os.replace(file + PARTIAL_DOWNLOAD_SUFFIX, file)
+                bitmap.remove()
+            else:
+                chunk_tasks = self._iter_download_chunk_tasks(input_location, part_size, dc_id, msg_data,
+                                                              file_size)
+                await self._write_download_chunks(f, chunk_tasks, part_size, file_size, progress_callback, key, iv)
 
             # Not all IO objects have flush (see #1227)
-            if callable(getattr(f, 'flush', None)):
+            if callable(getattr(f, 'flush', None)) and not f.closed:
                 f.flush()
 
             if in_memory:
@@ -125,9 +430,211 @@ class TelegramDownloadClient(TelegramClient):
             if isinstance(file, str) or in_memory:
                 f.close()
 
-    def _iter_download_chunk_tasks(self, input_location, part_size, dc_id, msg_data, file_size):
-        for i in range(0, file_size, part_size):
+    async def _write_download_chunks(self, f, chunk_tasks: typing.Iterator[asyncio.Task], part_size: int,
+                                     file_size: int, progress_callback: 'hints.ProgressCallback' = None,
+                                     key: bytes = None, iv: bytes = None) -> None:
+        """Write the chunks in order using a sliding window. The window keeps up to ``PARALLEL_DOWNLOAD_BLOCKS``
+        requests in flight and a new request is launched as soon as the oldest chunk is written. The chunks
+        completed out of order wait in the window (the reorder buffer), so its size is also limited by
+        ``DOWNLOAD_BUFFER_SIZE``.
+
+        :param f: File object opened for writing.
+        :param chunk_tasks: Iterator of tasks sorted by offset. A new task is started on each iteration.
+        :param part_size: Size of each chunk. Used to calculate the window size.
+        :param file_size: Total file size. Used for progress bar.
+        :param progress_callback: Callback to use after writing every chunk. Optional.
+        :param key: Key to decrypt the chunks. Optional.
+        :param iv: IV to decrypt the chunks. Optional.
+        :return: None
+        """
+        window_size = self._get_download_window_size(part_size)
+        window = deque()
+        try:
+            for task in chunk_tasks:
+                window.append(task)
+                if len(window) < window_size:
+                    continue
+                if not await self._write_download_chunk(f, window.popleft(), file_size, progress_callback,
+                                                        key, iv):
+                    break
+            while window:
+                if not await self._write_download_chunk(f, window.popleft(), file_size, progress_callback,
+                                                        key, iv):
+                    break
+        finally:
+            # Pending requests are not required after an error or the end of the file
+            for task in window:
+                task.cancel()
+
+    async def _write_download_chunks_at_offsets(self, fd: int,
+                                                chunk_tasks: typing.Iterator[typing.Tuple[int, asyncio.Task]],
+                                                part_size: int, file_size: int,
+                                                progress_callback: 'hints.ProgressCallback' = None,
+                                                bitmap: typing.Optional[DownloadBitmap] = None,
+                                                base_offset: int = 0) -> None:
+        """Write every chunk at its offset as soon as it arrives. The file must be preallocated. Unlike
+        ``_write_download_chunks`` there is no reorder buffer, so a slow chunk does not hold back the others.
+
+        :param fd: File descriptor opened for writing.
+        :param chunk_tasks: Iterator of (offset, task) tuples. A new task is started on each iteration.
+        :param part_size: Size of each chunk. Used to calculate the window size.
+        :param file_size: Total file size. Used for progress bar.
+        :param progress_callback: Callback to use after writing the chunks. Optional.
+        :param bitmap: Bitmap to mark the written chunks, so the download can be resumed. Optional.
+        :param base_offset: Position of the downloaded file in the file descriptor. Used by the split files.
+        :return: None
+        """
+        window_size = self._get_download_window_size(part_size)
+        pending = {}
+        written = bitmap.completed_size if bitmap else 0
+        try:
+            while True:
+                for offset, task in itertools.islice(chunk_tasks, window_size - len(pending)):
+                    pending[task] = offset
+                if not pending:
+                    break
+                done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    offset = pending.pop(task)
+                    chunk = task.result()
+                    if chunk:
+                        os.pwrite(fd, chunk, base_offset + offset)
+                        written += len(chunk)
+                    if chunk and bitmap:
+                        bitmap.set(offset // part_size)
+                if progress_callback:
+                    r = progress_callback(written, file_size)
+                    if inspect.isawaitable(r):
+                        await r
+        finally:
+            for task in pending:
+                task.cancel()
+
+    @staticmethod
+    def _get_download_window_size(part_size: int) -> int:
+        """Number of chunk requests in flight. It is limited by the memory used by the chunks."""
+        return max(1, min(PARALLEL_DOWNLOAD_BLOCKS, DOWNLOAD_BUFFER_SIZE // part_size))
+
+    async def _write_download_chunk(self, f, task: asyncio.Task, file_size: int,
+                                    progress_callback: 'hints.ProgressCallback' = None,
+                                    key: bytes = None, iv: bytes = None) -> bool:
+        """Wait for the chunk task and write it. Returns False if the chunk is empty (end of file)."""
+        await asyncio.wait([task])
+        chunk = task.result()
+        if not chunk:
+            return False
+        if iv and key:
+            chunk = AES.decrypt_ige(chunk, key, iv)
+        r = f.write(chunk)
+        if inspect.isawaitable(r):
+            await r
+
+        if progress_callback:
+            r = progress_callback(f.tell(), file_size)
+            if inspect.isawaitable(r):
+                await r
+        return True
+
+    def _iter_download_chunk_tasks(self, input_location, part_size, dc_id, msg_data, file_size,
+                                   offsets: typing.Optional[Iterable[int]] = None):
+        if offsets is None:
+            offsets = range(0, file_size, part_size)
+        for i in offsets:
             yield self.loop.create_task(
-                anext(self._iter_download(input_location, offset=i, request_size=part_size, dc_id=dc_id,
-                                          msg_data=msg_data))
+                self._download_chunk(input_location, i, part_size, dc_id, msg_data)
             )
+
+    async def _download_chunk(self, input_location, offset: int, part_size: int, dc_id: typing.Optional[int],
+                              msg_data: typing.Optional[tuple]) -> bytes:
+        """Download a chunk of the file from the DC of the file, using the connections kept for the DC and
+        without exceeding ``PARALLEL_DOWNLOAD_DC_REQUESTS`` requests in flight to the DC.
+
+        :param input_location: Location of the file.
+        :param offset: Offset of the chunk.
+        :param part_size: Size of the chunk.
+        :param dc_id: DC of the file. If None, the DC learned for the document or the DC of the session is used.
+        :param msg_data: Chat and message id of the file. Used to refresh the file reference. Optional.
+        :return: Chunk data. It is shorter than the part size at the end of the file.
+        """
+        document_id = getattr(input_location, 'id', None)
+        dc_id = dc_id or self.document_dc_ids.get(document_id) or self.session.dc_id
+        request = functions.upload.GetFileRequest(input_location, offset=offset, limit=part_size)
+        file_reference_refreshed = False
+        timed_out = False
+        while True:
+            try:
+                async with self._get_download_dc_semaphore(dc_id):
+                    pool = await self._get_download_sender_pool(dc_id)
+                    result = await (pool.send(request) if pool is not None else self(request))
+            except FileMigrateError as e:
+                # The document lives in another DC. The next chunks of the document are requested to that DC.
+                dc_id = e.new_dc
+                if document_id is not None:
+                    self.document_dc_ids[document_id] = dc_id
+                continue
+            except (FilerefUpgradeNeededError, FileReferenceExpiredError):
+                if file_reference_refreshed or not await self._refresh_file_reference(request, msg_data):
+                    raise
+                file_reference_refreshed = True
+                continue
+            except TimedOutError:
+                # Retry once like Telethon
+                if timed_out:
+                    self._log[__name__].warning('Got two timeouts in a row while downloading file')
+                    raise
+                timed_out = True
+                self._log[__name__].info('Got timeout while downloading file, retrying once')
+                await asyncio.sleep(TIMED_OUT_SLEEP)
+                continue
+            if isinstance(result, types.upload.FileCdnRedirect):
+                # The CDN is not requested (cdn_supported is not set), so Telegram should not redirect to it
+                raise TelegramUploadError('The file is served from the CDN data center {}, which is not '
+                                          'supported.'.format(result.dc_id))
+            return result.bytes
+
+    async def _refresh_file_reference(self, request: functions.upload.GetFileRequest,
+                                      msg_data: typing.Optional[tuple]) -> bool:
+        """Get the message again to update the expired file reference of the request. Returns False if the
+        reference cannot be updated.
+        """
+        location = request.location
+        if not msg_data or not isinstance(location, types.InputDocumentFileLocation) or location.thumb_size != '':
+            return False
+        chat, msg_id = msg_data
+        message = await self.get_messages(chat, ids=msg_id)
+        if not isinstance(getattr(message, 'media', None), types.MessageMediaDocument) or \
+                message.media.document.id != location.id:
+            return False
+        location.file_reference = message.media.document.file_reference
+        return True
+
+    def _get_download_dc_semaphore(self, dc_id: int) -> asyncio.Semaphore:
+        if dc_id not in self.download_dc_semaphores:
+            self.download_dc_semaphores[dc_id] = asyncio.Semaphore(max(1, PARALLEL_DOWNLOAD_DC_REQUESTS))
+        return self.download_dc_semaphores[dc_id]
+
+    async def _get_download_sender_pool(self, dc_id: int) -> typing.Optional[SenderPool]:
+        """Get the connections to download from the DC. They are connected the first time and kept for the next
+        files. Returns None to use the main connection, for the DC of the session with ``DOWNLOAD_CONNECTIONS``
+        set to 1.
+        """
+        if dc_id == self.session.dc_id and DOWNLOAD_CONNECTIONS <= 1:
+            return None
+        if dc_id in self.download_sender_pools:
+            return self.download_sender_pools[dc_id]
+        async with self.download_sender_pools_lock:
+            if dc_id not in self.download_sender_pools:
+                pool = SenderPool(self, dc_id, max(1, DOWNLOAD_CONNECTIONS))
+                try:
+                    await pool.connect()
+                except BaseException:
+                    await pool.disconnect()
+                    raise
+                self.download_sender_pools[dc_id] = pool
+        return self.download_sender_pools[dc_id]
+
+    async def _disconnect_coro(self):
+        for pool in self.download_sender_pools.values():
+            await pool.disconnect()
+        self.download_sender_pools = {}
+        await super()._disconnect_coro()
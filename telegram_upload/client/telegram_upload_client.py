@@ -1,8 +1,12 @@
 import asyncio
 import hashlib
+import io
 import os
+import pathlib
 import time
-from typing import Iterable, Optional
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterable, Optional, AsyncIterator, Set, Tuple, Iterator, Dict, List, Union
 
 import click
 from telethon import TelegramClient, utils, helpers, custom
@@ -11,10 +15,15 @@ from telethon.errors import RPCError, FloodWaitError, InvalidBufferError
 from telethon.tl import types, functions, TLRequest
 from telethon.utils import pack_bot_file_id
 
+from telegram_upload.client.concurrency import AdaptiveUploadWindow, UploadSession, FloodWaitGate, \
+    RateLimiter, backoff_delay
+from telegram_upload.cache import UploadIndex
 from telegram_upload.client.progress_bar import get_progress_bar
+from telegram_upload.client.senders import SenderPool
 from telegram_upload.exceptions import TelegramUploadDataLoss, MissingFileError
+from telegram_upload.resume import UploadJournal
 from telegram_upload.upload_files import File
-from telegram_upload.utils import grouper, async_to_sync, get_environment_integer
+from telegram_upload.utils import grouper, async_to_sync, get_environment_integer, TransferBudget
 
 PARALLEL_UPLOAD_BLOCKS = get_environment_integer('TELEGRAM_UPLOAD_PARALLEL_UPLOAD_BLOCKS', 4)
 ALBUM_FILES = 10
@@ -22,6 +31,20 @@ RETRIES = 3
 MAX_RECONNECT_RETRIES = get_environment_integer('TELEGRAM_UPLOAD_MAX_RECONNECT_RETRIES', 10)
 RECONNECT_TIMEOUT = get_environment_integer('TELEGRAM_UPLOAD_RECONNECT_TIMEOUT', 5)
 MIN_RECONNECT_WAIT = get_environment_integer('TELEGRAM_UPLOAD_MIN_RECONNECT_WAIT', 2)
+MAX_RECONNECT_WAIT = get_environment_integer('TELEGRAM_UPLOAD_MAX_RECONNECT_WAIT', 60)
+# Number of extra connections to upload the file parts. With 1 the main connection is used.
+UPLOAD_CONNECTIONS = get_environment_integer('TELEGRAM_UPLOAD_UPLOAD_CONNECTIONS', 1)
+# Number of file parts read ahead of the upload
+UPLOAD_PREFETCH_PARTS = get_environment_integer('TELEGRAM_UPLOAD_PREFETCH_PARTS', 4)
+# Number of files probed and thumbnailed in threads ahead of the file uploading
+PREPARE_FILES_AHEAD = get_environment_integer('TELEGRAM_UPLOAD_PREPARE_FILES_AHEAD', 2)
+# Number of files uploaded at the same time and the maximum size of these files
+PARALLEL_UPLOAD_FILES = get_environment_integer('TELEGRAM_UPLOAD_PARALLEL_UPLOAD_FILES', 1)
+PARALLEL_UPLOAD_FILES_SIZE = get_environment_integer('TELEGRAM_UPLOAD_PARALLEL_UPLOAD_FILES_SIZE', 64 * 1024 * 1024)
+# Number of destinations forwarded at the same time, forward requests per second and messages per forward request
+FORWARD_CONCURRENCY = get_environment_integer('TELEGRAM_UPLOAD_FORWARD_CONCURRENCY', 4)
+FORWARD_RATE = get_environment_integer('TELEGRAM_UPLOAD_FORWARD_RATE', 5)
+FORWARD_BATCH_MESSAGES = get_environment_integer('TELEGRAM_UPLOAD_FORWARD_BATCH_MESSAGES', 10)
 
 
 class TelegramUploadClient(TelegramClient):
@@ -29,12 +52,55 @@ class TelegramUploadClient(TelegramClient):
 
     def __init__(self, *args, **kwargs):
         self.reconnecting_lock = asyncio.Lock()
-        self.upload_semaphore = asyncio.Semaphore(self.parallel_upload_blocks)
+        self.upload_window = AdaptiveUploadWindow(self.parallel_upload_blocks)
+        self.upload_sender_pool: Optional[SenderPool] = None
+        self.upload_sender_pool_lock = asyncio.Lock()
+        self.flood_wait_gate = FloodWaitGate()
+        self.upload_index: Optional[UploadIndex] = None
+        self.document_index: Optional[UploadIndex] = None
+        self.forward_rate_limiter = RateLimiter(FORWARD_RATE)
         super().__init__(*args, **kwargs)
 
-    def forward_to(self, message, destinations):
-        for destination in destinations:
-            self.forward_messages(destination, [message])
+    def forward_to(self, messages, destinations) -> Dict[str, Union[list, Exception]]:
+        """Forward the messages to the destinations. See :meth:`_forward_to`."""
+        return async_to_sync(self._forward_to(messages, destinations))
+
+    async def _forward_to(self, messages, destinations) -> Dict[str, Union[list, Exception]]:
+        """Forward the messages to all the destinations at the same time, up to ``FORWARD_CONCURRENCY``
+        destinations and ``FORWARD_RATE`` requests per second. The messages are forwarded to each destination
+        using a single request. A failed destination does not stop the others.
+
+        :param messages: message or list of messages to forward.
+        :param destinations: destinations of the messages.
+        :return: forwarded messages or the error of each destination.
+        """
+        if not isinstance(messages, (list, tuple)):
+            messages = [messages]
+        destinations = list(destinations)
+        if not messages or not destinations:
+            return {}
+        semaphore = asyncio.Semaphore(max(1, FORWARD_CONCURRENCY))
+        results = await asyncio.gather(*[
+            self._forward_messages_to(destination, list(messages), semaphore) for destination in destinations
+        ], return_exceptions=True)
+        for destination, result in zip(destinations, results):
+            if isinstance(result, Exception):
+                self._log[__name__].warning('Failed to forward %d messages to %s: %s',
+                                            len(messages), destination, result)
+        return dict(zip(destinations, results))
+
+    async def _forward_messages_to(self, destination, messages: list, semaphore: asyncio.Semaphore) -> list:
+        async with semaphore:
+            for retry in range(RETRIES):
+                await self.flood_wait_gate.wait(self.session.dc_id)
+                await self.forward_rate_limiter.acquire()
+                try:
+                    return await self.forward_messages(destination, messages)
+                except FloodWaitError as e:
+                    if retry + 1 >= RETRIES:
+                        raise
+                    # Hold the other destinations too. They would get the same error.
+                    self.flood_wait_gate.close(self.session.dc_id, e.seconds)
 
     async def _send_album_media(self, entity, media):
         entity = await self.get_input_entity(entity)
@@ -48,9 +114,81 @@ class TelegramUploadClient(TelegramClient):
 
     def send_files_as_album(self, entity, vif, no_bar, files, delete_on_success=False, print_file_id=False,
                             forward=()):
-        for files_group in grouper(ALBUM_FILES, files):
-            media = self.send_files(entity, vif, no_bar, files_group, delete_on_success, print_file_id, forward, send_as_media=True)
-            async_to_sync(self._send_album_media(entity, media))
+        files = self._iter_not_uploaded_files(entity, files)
+        return async_to_sync(self._send_albums(entity, files, delete_on_success, forward))
+
+    async def _send_albums(self, entity, files: Iterable[File], delete_on_success=False, forward=()) -> list:
+        """Send the files in albums of ``ALBUM_FILES`` files. The members of an album are uploaded at the same
+        time, and the next album is uploaded while the current album is sent. The albums are sent in order.
+        The progress bars are not available in this mode.
+
+        :param entity: destination of the albums.
+        :param files: files to send.
+        :param delete_on_success: delete the files after sending them.
+        :param forward: destinations to forward the albums.
+        :return: messages sent.
+        """
+        messages = []
+        sending = None
+        uploads = []
+        try:
+            for files_group in grouper(ALBUM_FILES, files):
+                uploads = [asyncio.ensure_future(self._upload_album_media(entity, file)) for file in files_group]
+                media = await asyncio.gather(*uploads)
+                uploads = []
+                if sending is not None:
+                    messages.extend(await sending)
+                group = [(file, file_media) for file, file_media in zip(files_group, media) if file_media is not None]
+                sending = asyncio.ensure_future(self._send_album_group(entity, group, delete_on_success, forward))
+            if sending is not None:
+                messages.extend(await sending)
+        finally:
+            # After an error, the other members are cancelled and the album already uploaded is sent
+            for upload in uploads:
+                upload.cancel()
+            await asyncio.gather(*uploads, *filter(None, [sending]), return_exceptions=True)
+        return messages
+
+    async def _upload_album_media(self, entity, file: File, retries=RETRIES) -> Optional[types.InputSingleMedia]:
+        """Upload a member of an album. Returns None if the file could not be uploaded."""
+        while True:
+            try:
+                await self.flood_wait_gate.wait(self.session.dc_id)
+                return await self._send_media(entity, file, None)
+            except FloodWaitError as e:
+                self.flood_wait_gate.close(self.session.dc_id, e.seconds)
+            except RPCError as e:
+                # The saved parts may have expired. Upload the whole file again.
+                file.remove_upload_journal()
+                if retries <= 0:
+                    self._log[__name__].warning('The file "%s" could not be uploaded: %s', file.file_name, e)
+                    return None
+                retries -= 1
+            except RuntimeError as e:
+                self._log[__name__].warning('The file "%s" could not be uploaded: %s', file.file_name, e)
+                return None
+
+    async def _send_album_group(self, entity, group: List[Tuple[File, types.InputSingleMedia]],
+                                delete_on_success=False, forward=()) -> list:
+        """Send the uploaded members of an album in a single message group."""
+        if not group:
+            return []
+        while True:
+            try:
+                await self.flood_wait_gate.wait(self.session.dc_id)
+                messages = await self._send_album_media(entity, [media for _, media in group])
+                break
+            except FloodWaitError as e:
+                self.flood_wait_gate.close(self.session.dc_id, e.seconds)
+        sent = []
+        for (file, _), message in zip(group, messages):
+            if message:
+                self._add_to_upload_index(entity, file, message)
+                self._on_file_sent(file, delete_on_success)
+                sent.append(message)
+        # The whole album is forwarded to each destination in a single request
+        await self._forward_to(sent, forward)
+        return sent
 
     def _send_file_message(self, entity, vif, no_bar, file, thumb, progress):
         # if ('-' in entity or '+' in entity) and (entity[1].isdigit() == True):
@@ -58,17 +196,53 @@ class TelegramUploadClient(TelegramClient):
         if no_bar:
             progress = None
         if vif:
-            filenamehz = file.name.split('.')[-1]
-            file.name = file.name.replace(".{}".format(filenamehz),'.mp4')
-        message = self.send_file(entity=entity, file=file, thumb=thumb,
-                                 file_size=file.file_size if isinstance(file, File) else None,
-                                 caption=file.file_caption, force_document=file.force_file,
-                                 progress_callback=progress, attributes=file.file_attributes ,supports_streaming=True)
+            self._set_video_file_name(file)
+        message = self._send_uploaded_document(entity, file)
+        if message is None:
+            message = self.send_file(entity=entity, file=file, thumb=thumb,
+                                     file_size=file.file_size if isinstance(file, File) else None,
+                                     caption=file.file_caption, force_document=file.force_file,
+                                     progress_callback=progress, attributes=file.file_attributes,
+                                     supports_streaming=True)
+        # The reused documents are saved again with the file reference of the new message
+        self._add_to_document_index(file, message)
+        self._check_data_loss(file, message)
+        return message
+
+    def _send_uploaded_document(self, entity, file: File):
+        """Send the document uploaded previously with the same content, if any. Returns None if the content
+        has not been uploaded or the document can no longer be sent.
+        """
+        if self.document_index is None:
+            return None
+        document = self.document_index.get_document(file.content_hash, file.file_size)
+        if document is None:
+            return None
+        try:
+            return self.send_file(entity, document, caption=file.file_caption, force_document=file.force_file)
+        except FloodWaitError:
+            raise
+        except RPCError:
+            # The document has been deleted or its file reference has expired. Upload the file again.
+            self.document_index.remove_document(file.content_hash, file.file_size)
+            return None
+
+    def _add_to_document_index(self, file: File, message):
+        document = getattr(message.media, 'document', None)
+        if self.document_index is not None and isinstance(document, types.Document):
+            self.document_index.add_document(file.content_hash, file.file_size, document)
+
+    @staticmethod
+    def _set_video_file_name(file):
+        filenamehz = file.name.split('.')[-1]
+        file.name = file.name.replace(".{}".format(filenamehz),'.mp4')
+
+    @staticmethod
+    def _check_data_loss(file, message):
         if hasattr(message.media, 'document') and file.file_size != message.media.document.size:
             raise TelegramUploadDataLoss(
                 'Remote document size: {} bytes (local file size: {} bytes)'.format(
                     message.media.document.size, file.file_size))
-        return message
 
     async def _send_media(self, entity, file: File, progress):
         entity = await self.get_input_entity(entity)
@@ -117,9 +291,13 @@ class TelegramUploadClient(TelegramClient):
                     bar.render_finish()
         except FloodWaitError as e:
             # click.echo(f'{e}. Waiting for {e.seconds} seconds.', err=True)
-            time.sleep(e.seconds)
+            # The event loop keeps running while waiting, so the connection is kept alive
+            self.flood_wait_gate.close(self.session.dc_id, e.seconds)
+            async_to_sync(self.flood_wait_gate.wait(self.session.dc_id))
             message = self.send_one_file(entity, vif, no_bar, file, send_as_media, thumb, retries)
         except RPCError as e:
+            # The saved parts may have expired. Upload the whole file again.
+            file.remove_upload_journal()
             if retries > 0:
                 # click.echo(f'The file "{file.file_name}" could not be uploaded: {e}. Retrying...', err=True)
                 message = self.send_one_file(entity, vif, no_bar, file, send_as_media, thumb, retries - 1)
@@ -130,34 +308,248 @@ class TelegramUploadClient(TelegramClient):
 
     def send_files(self, entity, vif, no_bar, files: Iterable[File], delete_on_success=False, print_file_id=False,
                    forward=(), send_as_media: bool = False):
+        files = self._iter_not_uploaded_files(entity, files)
+        if PARALLEL_UPLOAD_FILES > 1 and not send_as_media:
+            return async_to_sync(self._send_files_concurrently(entity, vif, files, delete_on_success, forward))
         has_files = False
         messages = []
-        for file in files:
-            has_files = True
-            thumb = file.get_thumbnail()
-            try:
-                message = self.send_one_file(entity=entity, vif=vif, no_bar=no_bar, file=file, send_as_media=send_as_media, thumb=thumb)
-            finally:
-                if thumb and not file.is_custom_thumbnail and os.path.lexists(thumb):
-                    os.remove(thumb)
-            if message is None:
-                pass
-                # click.echo('Failed to upload file "{}"'.format(file.file_name), err=True)
-            if message and print_file_id:
-                pass
-                # click.echo('Uploaded successfully "{}" (file_id {})'.format(file.file_name,
-                #                                                             pack_bot_file_id(message.media)))
-            if message and delete_on_success:
-                # click.echo('Deleting "{}"'.format(file))
-                os.remove(file.path)
-            if message:
-                self.forward_to(message, forward)
-                messages.append(message)
+        # The messages are forwarded in batches of FORWARD_BATCH_MESSAGES
+        pending_forward = []
+        try:
+            for file, thumb in self._iter_prepared_files(files):
+                has_files = True
+                try:
+                    message = self.send_one_file(entity=entity, vif=vif, no_bar=no_bar, file=file, send_as_media=send_as_media, thumb=thumb)
+                finally:
+                    self._remove_thumbnail(file, thumb)
+                if message is None:
+                    pass
+                    # click.echo('Failed to upload file "{}"'.format(file.file_name), err=True)
+                if message and print_file_id:
+                    pass
+                    # click.echo('Uploaded successfully "{}" (file_id {})'.format(file.file_name,
+                    #                                                             pack_bot_file_id(message.media)))
+                if message and not send_as_media:
+                    self._add_to_upload_index(entity, file, message)
+                if message:
+                    self._on_file_sent(file, delete_on_success)
+                    messages.append(message)
+                    pending_forward.append(message)
+                if forward and len(pending_forward) >= FORWARD_BATCH_MESSAGES:
+                    self.forward_to(pending_forward, forward)
+                    pending_forward = []
+        finally:
+            # The messages already sent are forwarded even if a later upload fails
+            if forward and pending_forward:
+                self.forward_to(pending_forward, forward)
         if not has_files:
             pass
             # raise MissingFileError('Files do not exist.')
         return messages
 
+    def _iter_not_uploaded_files(self, entity, files: Iterable[File]) -> Iterator[File]:
+        """Skip the files already uploaded to the entity if the upload index is enabled."""
+        for file in files:
+            if self.upload_index is not None and \
+                    self.upload_index.is_uploaded(file.path, file.file_name, entity, file.stat):
+                # click.echo('Skipping "{}". It is already uploaded.'.format(file.file_name))
+                continue
+            yield file
+
+    def _add_to_upload_index(self, entity, file: File, message):
+        if self.upload_index is not None:
+            self.upload_index.add(file.path, file.file_name, entity, file.stat, message.id)
+
+    def _iter_prepared_files(self, files: Iterable[File]) -> Iterator[Tuple[File, Optional[str]]]:
+        """Prepare the next ``PREPARE_FILES_AHEAD`` files in a thread pool while the current file is uploaded,
+        so the network is not idle while ffmpeg runs. The files are returned in order with their thumbnails.
+        """
+        pending = deque()
+        with ThreadPoolExecutor(max(1, PREPARE_FILES_AHEAD), thread_name_prefix='telegram-upload-prepare') as executor:
+            try:
+                for file in files:
+                    pending.append((file, executor.submit(file.prepare)))
+                    if len(pending) > PREPARE_FILES_AHEAD:
+                        file, future = pending.popleft()
+                        yield file, future.result()
+                while pending:
+                    file, future = pending.popleft()
+                    yield file, future.result()
+            finally:
+                # The upload has been interrupted. Remove the thumbnails of the files prepared but not uploaded.
+                for file, future in pending:
+                    if not future.cancel() and future.exception() is None:
+                        self._remove_thumbnail(file, future.result())
+
+    @staticmethod
+    def _remove_thumbnail(file: File, thumb: Optional[str]):
+        if thumb and not file.is_custom_thumbnail and os.path.lexists(thumb):
+            os.remove(thumb)
+
+    @staticmethod
+    def _on_file_sent(file: File, delete_on_success: bool):
+        file.remove_upload_journal()
+        if delete_on_success:
+            # click.echo('Deleting "{}"'.format(file))
+            os.remove(file.path)
+
+    async def _send_files_concurrently(self, entity, vif, files: Iterable[File], delete_on_success=False,
+                                       forward=()):
+        """Upload up to ``PARALLEL_UPLOAD_FILES`` files at the same time and send the messages in the original
+        order. The files uploading at the same time cannot exceed ``PARALLEL_UPLOAD_FILES_SIZE`` bytes, so the
+        small files are uploaded together and the large files, which already upload their parts in parallel,
+        are uploaded one after another. The progress bars are not available in this mode.
+        """
+        budget = TransferBudget(PARALLEL_UPLOAD_FILES_SIZE, PARALLEL_UPLOAD_FILES)
+        uploads = asyncio.Queue(PARALLEL_UPLOAD_FILES)
+        scheduler = asyncio.ensure_future(self._schedule_file_uploads(vif, files, budget, uploads))
+        messages = []
+        pending_forward = []
+        try:
+            while True:
+                item = await uploads.get()
+                if item is None:
+                    break
+                file, upload = item
+                message = await self._send_uploaded_file(entity, vif, file, upload)
+                if message:
+                    self._add_to_upload_index(entity, file, message)
+                    self._add_to_document_index(file, message)
+                    self._on_file_sent(file, delete_on_success)
+                    messages.append(message)
+                    pending_forward.append(message)
+                if forward and len(pending_forward) >= FORWARD_BATCH_MESSAGES:
+                    await self._forward_to(pending_forward, forward)
+                    pending_forward = []
+            # Raise the scheduler errors
+            await scheduler
+        finally:
+            await self._cancel_file_uploads(scheduler, uploads)
+            if forward and pending_forward:
+                await self._forward_to(pending_forward, forward)
+        return messages
+
+    async def _schedule_file_uploads(self, vif, files: Iterable[File], budget: TransferBudget,
+                                     uploads: asyncio.Queue):
+        """Start the file uploads in order when there is room in the budget."""
+        try:
+            for file in files:
+                await budget.acquire(file.file_size)
+                upload = asyncio.ensure_future(self._upload_file_in_budget(vif, file, budget))
+                try:
+                    await uploads.put((file, upload))
+                except BaseException:
+                    # The upload is not in the queue, so nobody else can cancel it
+                    upload.cancel()
+                    raise
+        finally:
+            await uploads.put(None)
+
+    async def _cancel_file_uploads(self, scheduler: asyncio.Future, uploads: asyncio.Queue):
+        """Stop the scheduler and cancel the uploads started but not sent after an error. The thumbnails of
+        the files uploaded but not sent are removed.
+        """
+        pending = self._drain_queue(uploads)
+        # The queue has room for the last item of the scheduler
+        scheduler.cancel()
+        await asyncio.gather(scheduler, return_exceptions=True)
+        pending.extend(self._drain_queue(uploads))
+        for _, upload in pending:
+            upload.cancel()
+        results = await asyncio.gather(*[upload for _, upload in pending], return_exceptions=True)
+        for (file, _), result in zip(pending, results):
+            if isinstance(result, tuple):
+                self._remove_thumbnail(file, result[0])
+
+    @staticmethod
+    def _drain_queue(uploads: asyncio.Queue) -> List[Tuple[File, asyncio.Future]]:
+        """Get the uploads in the queue without waiting. The end of the queue (None) is discarded."""
+        items = []
+        while not uploads.empty():
+            item = uploads.get_nowait()
+            if item is not None:
+                items.append(item)
+        return items
+
+    async def _upload_file_in_budget(self, vif, file: File, budget: TransferBudget):
+        """Upload the file and return its size to the budget. If the same content has been uploaded before,
+        the document is returned instead of uploading the file again. Returns None if the upload fails.
+        """
+        try:
+            document = await self._get_uploaded_document(file)
+            if document is not None:
+                return None, None, document
+            return await self._prepare_and_upload_file(vif, file)
+        finally:
+            await budget.release(file.file_size)
+
+    async def _get_uploaded_document(self, file: File) -> Optional[types.InputDocument]:
+        """Get the document uploaded before with the same content, if the document index is enabled. The file
+        is hashed in a thread.
+        """
+        if self.document_index is None:
+            return None
+        content_hash = await asyncio.get_running_loop().run_in_executor(None, lambda: file.content_hash)
+        return self.document_index.get_document(content_hash, file.file_size)
+
+    async def _prepare_and_upload_file(self, vif, file: File):
+        """Prepare the thumbnail and attributes of the file and upload it. Returns None if the upload fails."""
+        loop = asyncio.get_running_loop()
+        thumb = None
+        try:
+            # ffmpeg is used to get the thumbnail and the attributes, so they are obtained in a thread
+            thumb = await loop.run_in_executor(None, file.get_thumbnail)
+            attributes = await loop.run_in_executor(None, lambda: file.file_attributes)
+            if vif:
+                self._set_video_file_name(file)
+            input_file = await self.upload_file(file, file_size=file.file_size)
+        except (RPCError, RuntimeError) as e:
+            self._log[__name__].warning('The file "%s" could not be uploaded: %s', file.file_name, e)
+            self._remove_thumbnail(file, thumb)
+            file.remove_upload_journal()
+            return None
+        except BaseException:
+            # Cancelled or other error. The file is not going to be sent.
+            self._remove_thumbnail(file, thumb)
+            raise
+        return thumb, attributes, input_file
+
+    async def _send_uploaded_file(self, entity, vif, file: File, upload: asyncio.Future, retries=RETRIES):
+        """Send the message with the uploaded file, or with the document uploaded before with the same content.
+        Returns None if the file could not be sent.
+        """
+        uploaded = await upload
+        if uploaded is None:
+            return None
+        thumb, attributes, input_file = uploaded
+        try:
+            while True:
+                try:
+                    await self.flood_wait_gate.wait(self.session.dc_id)
+                    message = await self.send_file(entity, input_file, thumb=thumb, caption=file.file_caption,
+                                                   force_document=file.force_file, attributes=attributes,
+                                                   supports_streaming=True)
+                except FloodWaitError as e:
+                    self.flood_wait_gate.close(self.session.dc_id, e.seconds)
+                except RPCError as e:
+                    if isinstance(input_file, types.InputDocument):
+                        # The document has been deleted or its file reference has expired. Upload the file again.
+                        self.document_index.remove_document(file.content_hash, file.file_size)
+                        uploaded = await self._prepare_and_upload_file(vif, file)
+                        if uploaded is None:
+                            return None
+                        thumb, attributes, input_file = uploaded
+                        continue
+                    if retries <= 0:
+                        self._log[__name__].warning('The file "%s" could not be sent: %s', file.file_name, e)
+                        return None
+                    retries -= 1
+                else:
+                    self._check_data_loss(file, message)
+                    return message
+        finally:
+            self._remove_thumbnail(file, thumb)
+
     async def upload_file(
             self: 'TelegramClient',
             file: 'hints.FileLike',
@@ -284,56 +676,44 @@ class TelegramUploadClient(TelegramClient):
             is_big = file_size > 10 * 1024 * 1024
             hash_md5 = hashlib.md5()
 
+            # The parts of big files saved in a previous attempt can be reused using the same file_id
+            journal = self._open_upload_journal(file, file_size, part_size) if is_big else None
+            if journal:
+                file_id = journal.file_id
+
             part_count = (file_size + part_size - 1) // part_size
             self._log[__name__].info('Uploading file of %d bytes in %d chunks of %d',
                                     file_size, part_count, part_size)
 
-            pos = 0
-            for part_index in range(part_count):
-                # Read the file by in chunks of size part_size
-                part = await helpers._maybe_await(stream.read(part_size))
-
-                if not isinstance(part, bytes):
-                    raise TypeError(
-                        'file descriptor returned {}, not bytes (you must '
-                        'open the file in bytes mode)'.format(type(part)))
-
-                # `file_size` could be wrong in which case `part` may not be
-                # `part_size` before reaching the end.
-                if len(part) != part_size and part_index < part_count - 1:
-                    raise ValueError(
-                        'read less than {} before reaching the end; either '
-                        '`file_size` or `read` are wrong'.format(part_size))
-
-                pos += len(part)
-
-                # Encryption part if needed
-                if key and iv:
-                    part = AES.encrypt_ige(part, key, iv)
-
-                if not is_big:
-                    # Bit odd that MD5 is only needed for small files and not
-                    # big ones with more chance for corruption, but that's
-                    # what Telegram wants.
-                    hash_md5.update(part)
-
-                # The SavePartRequest is different depending on whether
-                # the file is too large or not (over or less than 10MB)
-                if is_big:
-                    request = functions.upload.SaveBigFilePartRequest(
-                        file_id, part_index, part_count, part)
-                else:
-                    request = functions.upload.SaveFilePartRequest(
-                        file_id, part_index, part)
-                await self.upload_semaphore.acquire()
-                self.loop.create_task(
-                    self._send_file_part(request, part_index, part_count, pos, file_size, progress_callback),
-                    name=f"telegram-upload-file-{part_index}"
-                )
-            # Wait for all tasks to finish
-            await asyncio.wait([
-                task for task in asyncio.all_tasks() if task.get_name().startswith(f"telegram-upload-file-")
-            ])
+            try:
+                await self._connect_upload_sender_pool()
+                # The local files are read, encrypted and hashed in a thread ahead of the upload
+                threaded = isinstance(file, (str, pathlib.Path, bytes, io.IOBase))
+                parts = self._iter_upload_parts(stream, threaded, part_size, part_count, file_size,
+                                                journal.parts if journal else set(), key, iv,
+                                                None if is_big else hash_md5)
+                async with UploadSession() as session:
+                    async for part_index, pos, part in parts:
+                        # The SavePartRequest is different depending on whether
+                        # the file is too large or not (over or less than 10MB)
+                        if is_big:
+                            request = functions.upload.SaveBigFilePartRequest(
+                                file_id, part_index, part_count, part)
+                        else:
+                            request = functions.upload.SaveFilePartRequest(
+                                file_id, part_index, part)
+                        # Stop reading the file if a part has failed
+                        session.raise_for_error()
+                        await self.upload_window.acquire()
+                        session.create_task(
+                            self._send_file_part(request, part_index, part_count, pos, file_size,
+                                                 progress_callback, journal=journal),
+                            name=f"telegram-upload-file-{part_index}"
+                        )
+            finally:
+                # The journal is kept on disk to resume the upload after an error
+                if journal:
+                    journal.close()
         if is_big:
             return types.InputFileBig(file_id, part_count, file_name)
         else:
@@ -343,11 +723,112 @@ class TelegramUploadClient(TelegramClient):
 
     # endregion
 
+    async def _iter_upload_parts(self, stream, threaded: bool, part_size: int, part_count: int, file_size: int,
+                                 skip_parts: Set[int], key: Optional[bytes] = None, iv: Optional[bytes] = None,
+                                 hash_md5=None) -> AsyncIterator[Tuple[int, int, bytes]]:
+        """
+        Read the file parts ahead of the upload. Up to ``UPLOAD_PREFETCH_PARTS`` parts are kept ready in a queue,
+        so sending the parts does not wait for the disk. If threaded is True, the parts are read, encrypted and
+        hashed in a thread instead of blocking the event loop.
+
+        :param stream: File stream to read.
+        :param threaded: Read the stream in a thread. The stream read method must not be async.
+        :param part_size: Size of each part.
+        :param part_count: Total parts count.
+        :param file_size: Total file size.
+        :param skip_parts: Part indexes already uploaded. These parts are skipped without reading them.
+        :param key: Key to encrypt the parts. Optional.
+        :param iv: IV to encrypt the parts. Optional.
+        :param hash_md5: MD5 hash object to update with every part. Optional.
+        :return: Async iterator with (part index, position after the part, part) tuples.
+        """
+        loop = asyncio.get_running_loop()
+        queue = asyncio.Queue(UPLOAD_PREFETCH_PARTS)
+
+        def prepare_part(part_index: int, part) -> bytes:
+            if not isinstance(part, bytes):
+                raise TypeError(
+                    'file descriptor returned {}, not bytes (you must '
+                    'open the file in bytes mode)'.format(type(part)))
+
+            # `file_size` could be wrong in which case `part` may not be
+            # `part_size` before reaching the end.
+            if len(part) != part_size and part_index < part_count - 1:
+                raise ValueError(
+                    'read less than {} before reaching the end; either '
+                    '`file_size` or `read` are wrong'.format(part_size))
+
+            # Encryption part if needed
+            if key and iv:
+                part = AES.encrypt_ige(part, key, iv)
+
+            if hash_md5 is not None:
+                # Bit odd that MD5 is only needed for small files and not
+                # big ones with more chance for corruption, but that's
+                # what Telegram wants.
+                hash_md5.update(part)
+            return part
+
+        def read_part(part_index: int) -> bytes:
+            return prepare_part(part_index, stream.read(part_size))
+
+        def skip_part():
+            stream.seek(stream.tell() + part_size)
+
+        async def produce():
+            try:
+                pos = 0
+                for part_index in range(part_count):
+                    pos += min(part_size, file_size - pos)
+                    if part_index in skip_parts:
+                        # Already uploaded. Skip the part without reading it.
+                        if threaded:
+                            await loop.run_in_executor(None, skip_part)
+                        else:
+                            await helpers._maybe_await(
+                                stream.seek(await helpers._maybe_await(stream.tell()) + part_size)
+                            )
+                        continue
+                    if threaded:
+                        part = await loop.run_in_executor(None, read_part, part_index)
+                    else:
+                        part = prepare_part(part_index, await helpers._maybe_await(stream.read(part_size)))
+                    await queue.put((part_index, pos, part))
+                await queue.put(None)
+            except Exception as e:
+                await queue.put(e)
+
+        producer = asyncio.ensure_future(produce())
+        try:
+            while True:
+                item = await queue.get()
+                if item is None:
+                    break
+                elif isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            producer.cancel()
+
+    @staticmethod
+    def _open_upload_journal(file, file_size: int, part_size: int) -> Optional[UploadJournal]:
+        """Open the upload journal of a local file. The journal is also set in the file to remove it
+        after sending the message. Returns None if the file is not a local file.
+        """
+        if not isinstance(file, File):
+            return None
+        journal = UploadJournal(file.path, file_size, os.stat(file.path).st_mtime_ns, part_size, file.file_name)
+        journal.open(helpers.generate_random_long())
+        file.upload_journal = journal
+        return journal
+
     async def _send_file_part(self, request: TLRequest, part_index: int, part_count: int, pos: int, file_size: int,
-                              progress_callback: Optional['hints.ProgressCallback'] = None, retry: int = 0) -> None:
+                              progress_callback: Optional['hints.ProgressCallback'] = None, retry: int = 0,
+                              journal: Optional[UploadJournal] = None) -> None:
         """
         Submit the file request part to Telegram. This method waits for the request to be executed, logs the upload,
-        and releases the semaphore to allow further uploading.
+        and releases the upload window slot to allow further uploading. The request latency and the errors are
+        used to adjust the upload window.
 
         :param request: SaveBigFilePartRequest or SaveFilePartRequest. This request will be awaited.
         :param part_index: Part index as integer. Used in logging.
@@ -355,53 +836,89 @@ class TelegramUploadClient(TelegramClient):
         :param pos: Number of part as integer. Used for progress bar.
         :param file_size: Total file size. Used for progress bar.
         :param progress_callback: Callback to use after submit the request. Optional.
+        :param retry: Number of the current retry.
+        :param journal: Journal to record the part after submit the request. Optional.
         :return: None
         """
         result = None
+        dc_id = self.upload_sender_pool.dc_id if self.upload_sender_pool is not None else self.session.dc_id
         try:
-            result = await self(request)
+            # The part waits here if the DC has asked to wait after a flood error
+            await self.flood_wait_gate.wait(dc_id)
+            start = time.monotonic()
+            if self.upload_sender_pool is not None:
+                result = await self.upload_sender_pool.send(request)
+            else:
+                result = await self(request)
         except FloodWaitError as e:
-            time.sleep(10)
+            self.upload_window.decrease()
+            self.flood_wait_gate.close(dc_id, e.seconds)
         except InvalidBufferError as e:
             if e.code == 429:
                 # Too many connections
-                pass
+                self.upload_window.decrease()
                 # click.echo(f'Too many connections to Telegram servers.', err=True)
             else:
                 pass
                 # raise
+        except asyncio.CancelledError:
+            # Another part of the file has failed
+            self.upload_window.release()
+            raise
         except ConnectionError:
             # Retry to send the file part
             pass
             # click.echo(f'Detected connection error. Retrying...', err=True)
         except Exception as e:
-            time.sleep(10)
+            # Retried after a backoff
+            pass
         else:
-            self.upload_semaphore.release()
+            self.upload_window.release(time.monotonic() - start)
         if result is None and retry < MAX_RECONNECT_RETRIES:
             # An error occurred, retry
-            await asyncio.sleep(max(MIN_RECONNECT_WAIT, retry * MIN_RECONNECT_WAIT))
-            await self.reconnect()
+            try:
+                await asyncio.sleep(backoff_delay(retry, MIN_RECONNECT_WAIT, MAX_RECONNECT_WAIT))
+                await self.reconnect()
+            except asyncio.CancelledError:
+                self.upload_window.release()
+                raise
             await self._send_file_part(
-                request, part_index, part_count, pos, file_size, progress_callback, retry + 1
+                request, part_index, part_count, pos, file_size, progress_callback, retry + 1, journal
             )
         elif result:
             self._log[__name__].debug('Uploaded %d/%d',
                                       part_index + 1, part_count)
+            if journal:
+                journal.add(part_index)
             if progress_callback:
                 await helpers._maybe_await(progress_callback(pos, file_size))
         else:
+            self.upload_window.release()
             raise RuntimeError(
                 'Failed to upload file part {}.'.format(part_index))
 
-    def decrease_upload_semaphore(self):
+    async def _connect_upload_sender_pool(self) -> None:
+        """Connect the extra connections to upload the file parts if ``UPLOAD_CONNECTIONS`` is greater than 1.
+        The parts are sent using the main connection if the pool cannot be connected.
         """
-        Decreases the upload semaphore by one. This method is used to reduce the number of parallel uploads.
-        :return:
-        """
-        if self.parallel_upload_blocks > 1:
-            self.parallel_upload_blocks -= 1
-            self.loop.create_task(self.upload_semaphore.acquire())
+        if UPLOAD_CONNECTIONS <= 1 or self.upload_sender_pool is not None:
+            return
+        # The files uploaded at the same time share the pool
+        async with self.upload_sender_pool_lock:
+            if self.upload_sender_pool is not None:
+                return
+            pool = SenderPool(self, self.session.dc_id, UPLOAD_CONNECTIONS)
+            try:
+                self.upload_sender_pool = await pool.connect()
+            except (ConnectionError, RPCError, asyncio.TimeoutError) as e:
+                self._log[__name__].warning('Extra upload connections are not available: %s', e)
+                await pool.disconnect()
+
+    async def _disconnect_coro(self):
+        if self.upload_sender_pool is not None:
+            await self.upload_sender_pool.disconnect()
+            self.upload_sender_pool = None
+        await super()._disconnect_coro()
 
     async def reconnect(self):
         """
@@ -414,7 +931,7 @@ class TelegramUploadClient(TelegramClient):
             # Reconnected in another task
             self.reconnecting_lock.release()
             return
-        self.decrease_upload_semaphore()
+        self.upload_window.decrease()
         try:
             # click.echo(f'Reconnecting to Telegram servers...')
             await asyncio.wait_for(self.connect(), RECONNECT_TIMEOUT)
@@ -6,6 +6,10 @@ import click
 CONFIG_DIRECTORY = os.environ.get('TELEGRAM_UPLOAD_CONFIG_DIRECTORY', '~/.config')
 CONFIG_FILE = os.path.expanduser('{}/telegram-upload.json'.format(CONFIG_DIRECTORY))
 SESSION_FILE = os.path.expanduser('{}/telegram-upload'.format(CONFIG_DIRECTORY))
+UPLOAD_JOURNAL_DIRECTORY = os.path.expanduser('{}/telegram-upload-journal'.format(CONFIG_DIRECTORY))
+MEDIA_CACHE_FILE = os.path.expanduser('{}/telegram-upload-media.sqlite'.format(CONFIG_DIRECTORY))
+UPLOAD_INDEX_FILE = os.path.expanduser('{}/telegram-upload-index.sqlite'.format(CONFIG_DIRECTORY))
+THUMBNAILS_CACHE_DIRECTORY = os.path.expanduser('{}/telegram-upload-thumbnails'.format(CONFIG_DIRECTORY))
 
 
 def prompt_config(config_file):
@@ -1,9 +1,21 @@
+import itertools
+import logging
 import os
+import struct
 import sys
-from typing import Iterable, Iterator, Optional, BinaryIO
+import time
+from typing import Iterable, Iterator, Optional, BinaryIO, List, Tuple
 
 from telethon.tl.types import Message, DocumentAttributeFilename
 
+from telegram_upload.utils import sizeof_fmt
+
+try:
+    import fcntl
+except ImportError:
+    # Not available on Windows
+    fcntl = None
+
 
 if sys.version_info < (3, 8):
     cached_property = property
@@ -11,18 +23,87 @@ else:
     from functools import cached_property
 
 
+__log__ = logging.getLogger(__name__)
 CHUNK_FILE_SIZE = 1024 * 1024
+# Maximum bytes copied by the kernel in a single call
+COPY_FILE_SIZE = 1024 * 1024 * 1024
+# ioctl to share the data blocks of a file range with another file (Linux, btrfs and xfs among others)
+FICLONERANGE = 0x4020940d
+
+
+def reflink_file(read_fd: int, write_fd: int):
+    """Clone the rest of the read file at the current position of the write file. The data blocks are
+    shared by both files, so no data is copied. The positions must be aligned to the filesystem block size.
+    """
+    if fcntl is None or not sys.platform.startswith('linux'):
+        raise OSError('Reflinks are not supported on this system')
+    read_offset = os.lseek(read_fd, 0, os.SEEK_CUR)
+    write_offset = os.lseek(write_fd, 0, os.SEEK_CUR)
+    size = os.fstat(read_fd).st_size - read_offset
+    # struct file_clone_range. A length of 0 clones until the end of the read file.
+    fcntl.ioctl(write_fd, FICLONERANGE, struct.pack('qQQQ', read_fd, read_offset, 0, write_offset))
+    os.lseek(read_fd, 0, os.SEEK_END)
+    os.lseek(write_fd, write_offset + size, os.SEEK_SET)
+
 
+def copy_file_range(read_fd: int, write_fd: int):
+    """Copy the rest of the read file in the kernel. Some filesystems clone the data instead of copying it."""
+    while os.copy_file_range(read_fd, write_fd, COPY_FILE_SIZE):
+        pass
+
+
+def sendfile(read_fd: int, write_fd: int):
+    """Copy the rest of the read file in the kernel."""
+    while os.sendfile(write_fd, read_fd, None, COPY_FILE_SIZE):
+        pass
+
+
+COPY_FUNCTIONS = [
+    ('reflink', reflink_file),
+    ('copy_file_range', copy_file_range if hasattr(os, 'copy_file_range') else None),
+    ('sendfile', sendfile if hasattr(os, 'sendfile') else None),
+]
 
-def pipe_file(read_file_name: str, write_file: BinaryIO):
-    """Read a file by its file name and write in another file already open."""
+
+def copy_file(read_file: BinaryIO, write_file: BinaryIO) -> Optional[str]:
+    """Copy the rest of a file into another file from their current positions without reading the data into
+    Python: using a reflink, ``os.copy_file_range`` or ``os.sendfile``. Returns the name of the method used, or
+    None if the files or the system do not support any of them.
+    """
+    try:
+        read_fd, write_fd = read_file.fileno(), write_file.fileno()
+    except (AttributeError, OSError):
+        # io.UnsupportedOperation for in-memory files
+        return None
+    write_file.flush()
+    for name, copy_function in COPY_FUNCTIONS:
+        if copy_function is None:
+            continue
+        try:
+            copy_function(read_fd, write_fd)
+        except OSError:
+            # Not supported between these files (for example, on other filesystems). The copy is continued
+            # by the next method from the positions updated by the kernel.
+            continue
+        return name
+    return None
+
+
+def pipe_file(read_file_name: str, write_file: BinaryIO) -> str:
+    """Read a file by its file name and write in another file already open. Returns the name of the
+    method used to copy the file.
+    """
     with open(read_file_name, "rb") as read_file:
+        method = copy_file(read_file, write_file)
+        if method:
+            return method
         while True:
             data = read_file.read(CHUNK_FILE_SIZE)
             if data:
                 write_file.write(data)
             else:
                 break
+    return "read"
 
 
 class JoinStrategyBase:
@@ -47,10 +128,18 @@ class JoinStrategyBase:
         """Returns if this strategy is applicable to the download file."""
         raise NotImplementedError
 
-    def join_download_files(self):
-        """Join the downloaded files in the bundle."""
+    def join_download_files(self, file_name: Optional[str] = None) -> Optional[str]:
+        """Join the downloaded files in the bundle into the file name, by default the name of the bundle.
+        Returns the joined file name, or None if there are missing files.
+        """
         raise NotImplementedError
 
+    def get_joined_download_file(self) -> Optional['JoinedDownloadFile']:
+        """Returns the joined file to download the parts directly into it, if the strategy supports it and
+        the bundle is complete. Otherwise, the parts are downloaded without joining them.
+        """
+        return None
+
 
 class UnionJoinStrategy(JoinStrategyBase):
     """Join separate files without any application. These files have extension
@@ -78,19 +167,32 @@ class UnionJoinStrategy(JoinStrategyBase):
         """Returns if this strategy is applicable to the download file."""
         return download_file.file_name_extension.isdigit()
 
-    def join_download_files(self):
-        """Join the downloaded files in the bundle."""
+    def get_joined_download_file(self) -> Optional['JoinedDownloadFile']:
+        """Returns the joined file to download the parts directly into it if there are no missing parts."""
+        sorted_files = sorted(self.download_files, key=lambda x: x.file_name_extension)
+        if not sorted_files or len(sorted_files) - 1 != int(sorted_files[-1].file_name_extension):
+            return None
+        return JoinedDownloadFile(self.get_base_name(sorted_files[0]), sorted_files, self)
+
+    def join_download_files(self, file_name: Optional[str] = None) -> Optional[str]:
+        """Join the downloaded files in the bundle. Returns the joined file name."""
         download_files = self.download_files
         sorted_files = sorted(download_files, key=lambda x: x.file_name_extension)
         sorted_files = [file for file in sorted_files if os.path.lexists(file.downloaded_file_name or "")]
         if not sorted_files or len(sorted_files) - 1 != int(sorted_files[-1].file_name_extension):
             # There are parts of the file missing. Stopping...
-            return
-        with open(self.get_base_name(sorted_files[0]), "wb") as new_file:
-            for download_file in sorted_files:
-                pipe_file(download_file.downloaded_file_name, new_file)
+            return None
+        file_name = file_name or self.get_base_name(sorted_files[0])
+        start = time.monotonic()
+        with open(file_name, "wb") as new_file:
+            methods = {pipe_file(download_file.downloaded_file_name, new_file) for download_file in sorted_files}
+            size = new_file.tell()
+        elapsed = max(time.monotonic() - start, 1e-6)
+        __log__.info('Joined "%s" (%s) in %.1f seconds (%s/s) using %s', file_name, sizeof_fmt(size), elapsed,
+                     sizeof_fmt(size / elapsed), ', '.join(sorted(methods)))
         for download_file in sorted_files:
             os.remove(download_file.downloaded_file_name)
+        return file_name
 
 
 JOIN_STRATEGIES = [
@@ -153,6 +255,47 @@ class DownloadFile:
         return self.file_name == other.file_name
 
 
+class JoinedDownloadFile:
+    """File joined from the split parts. The parts are downloaded directly at their offsets in this file,
+    so they are not joined after the download. If that is not possible, the parts are downloaded to separate
+    files and joined using the join strategy.
+    """
+    downloaded_file_name: Optional[str] = None
+
+    def __init__(self, file_name: str, download_files: List[DownloadFile],
+                 join_strategy: Optional[JoinStrategyBase] = None):
+        """Creates the joined file from the parts sorted by their position."""
+        self.file_name = file_name
+        self.download_files = download_files
+        self.join_strategy = join_strategy
+
+    def set_download_file_name(self, file_name):
+        """After download the file, set the final download file name."""
+        self.downloaded_file_name = file_name
+
+    def join_download_files(self, file_name: Optional[str] = None) -> Optional[str]:
+        """Join the parts downloaded to separate files into the file name, by default the name of this file.
+        Returns the joined file name.
+        """
+        return self.join_strategy.join_download_files(file_name or self.file_name)
+
+    @property
+    def parts(self) -> List[Tuple[DownloadFile, int]]:
+        """Get the parts with their offset in the joined file."""
+        offsets = itertools.accumulate([0] + [download_file.size for download_file in self.download_files])
+        return list(zip(self.download_files, offsets))
+
+    @property
+    def messages(self) -> List[Message]:
+        """Get the messages of the parts."""
+        return [download_file.message for download_file in self.download_files]
+
+    @property
+    def size(self) -> int:
+        """Get the joined file size."""
+        return sum(download_file.size for download_file in self.download_files)
+
+
 class DownloadSplitFilesBase:
     """Iterate over complete and split files. Base class to inherit."""
     def __init__(self, messages: Iterable[Message]):
@@ -184,27 +327,35 @@ class KeepDownloadSplitFiles(DownloadSplitFilesBase):
 class JoinDownloadSplitFiles(DownloadSplitFilesBase):
     """Download split files and join it."""
     def get_iterator(self) -> Iterator[DownloadFile]:
-        """Get an iterator with the download files. This method applies the join strategy and
-        joins the files after download it.
+        """Get an iterator with the download files. This method applies the join strategy. The parts of a
+        complete bundle are returned as a single joined file. Otherwise, there are missing parts and they
+        are returned without joining them.
         """
         current_join_strategy: Optional[JoinStrategyBase] = None
         for message in self.messages:
             download_file = DownloadFile(message)
-            yield download_file
             if current_join_strategy and current_join_strategy.is_part(download_file):
                 # There is a bundle in process and the download file is part of it. Add the download
                 # file to the bundle.
                 current_join_strategy.add_download_file(download_file)
-            elif current_join_strategy and not current_join_strategy.is_part(download_file):
-                # There is a bundle in process and the download file is not part of it. Join the files
-                # in the bundle and finish it.
-                current_join_strategy.join_download_files()
-                current_join_strategy = None
-            if current_join_strategy is None:
-                # There is no bundle in process. Get the current bundle if the file has a strategy
-                # available.
-                current_join_strategy = get_join_strategy(download_file)
-        else:
-            # After finish all the files, join the latest bundle.
+                continue
             if current_join_strategy:
-                current_join_strategy.join_download_files()
+                # There is a bundle in process and the download file is not part of it. Finish the bundle.
+                yield from self.iter_bundle(current_join_strategy)
+            # Get the current bundle if the file has a strategy available.
+            current_join_strategy = get_join_strategy(download_file)
+            if not current_join_strategy:
+                yield download_file
+        # After finish all the files, the latest bundle.
+        if current_join_strategy:
+            yield from self.iter_bundle(current_join_strategy)
+
+    @staticmethod
+    def iter_bundle(join_strategy: JoinStrategyBase) -> Iterator[DownloadFile]:
+        """Get the joined file of the bundle, or its parts if the bundle cannot be joined."""
+        joined_download_file = join_strategy.get_joined_download_file()
+        if joined_download_file is not None:
+            yield joined_download_file
+        else:
+            # There are parts of the file missing. The parts are kept.
+            yield from join_strategy.download_files
@@ -62,6 +62,10 @@ class TelegramEnvironmentError(TelegramUploadError):
     error_code = 31
 
 
+class TelegramUploadIncompleteDownloadError(TelegramUploadError):
+    error_code = 32
+
+
 def catch(fn):
     def wrap(*args, **kwargs):
         try:
@@ -6,6 +6,7 @@ import os
 import click
 from telethon.tl.types import User
 
+from telegram_upload.cache import UploadIndex
 from telegram_upload.cli import show_checkboxlist, show_radiolist
 from telegram_upload.client import TelegramManagerClient, get_message_file_attribute
 from telegram_upload.config import default_config, CONFIG_FILE
@@ -135,6 +136,9 @@ class MutuallyExclusiveOption(click.Option):
 @click.option('--large-files', default='fail', type=click.Choice(list(LARGE_FILE_MODES.keys())),
               help='Defines how to process large files unsupported for Telegram. By default large files are not '
                    'accepted and will raise an error.')
+@click.option('--split-size', type=click.IntRange(min=1), default=None,
+              help='Size of the parts in MiB using "--large-files split". Smaller parts can be uploaded in '
+                   'parallel. By default and at most the maximum file size (2 GiB, or 4 GiB for premium accounts).')
 @click.option('--caption', type=str, help='Change file description. By default the file name.')
 @click.option('--no-thumbnail', is_flag=True, cls=MutuallyExclusiveOption, mutually_exclusive=["thumbnail_file"],
               help='Disable thumbnail generation. For some known file formats, Telegram may still generate a '
@@ -150,14 +154,29 @@ class MutuallyExclusiveOption(click.Option):
               help='Use interactive mode.')
 @click.option('--sort', is_flag=True,
               help='Sort files by name before upload it. Install the natsort Python package for natural sorting.')
-def upload(files, to, quchu, vif, nobar, dzffn, config, delete_on_success, print_file_id, force_file, forward, directories, large_files, caption,
-           no_thumbnail, thumbnail_file, proxy, album, interactive, sort):
+@click.option('--skip-uploaded', is_flag=True,
+              help='Skip the files already uploaded to the same destination using this option. The files are '
+                   'uploaded again if they have changed.')
+@click.option('--reuse-uploaded', is_flag=True,
+              help='Send the files with the same content as a file uploaded using this option without uploading '
+                   'them again. It cannot be used with --album.')
+def upload(files, to, quchu, vif, nobar, dzffn, config, delete_on_success, print_file_id, force_file, forward, directories, large_files, split_size,
+           caption, no_thumbnail, thumbnail_file, proxy, album, interactive, sort, skip_uploaded, reuse_uploaded):
     """Upload one or more files to Telegram using your personal account.
     The maximum file size is 2 GiB for free users and 4 GiB for premium accounts.
     By default, they will be saved in your saved messages.
     """
+    if split_size and large_files != 'split':
+        raise click.BadParameter('it can only be used with "--large-files split".', param_hint="'--split-size'")
+    if reuse_uploaded and album:
+        raise click.BadParameter('it cannot be used with "--album".', param_hint="'--reuse-uploaded'")
     client = TelegramManagerClient(config or default_config(), proxy=proxy)
     client.start()
+    upload_index = UploadIndex() if skip_uploaded or reuse_uploaded else None
+    if skip_uploaded:
+        client.upload_index = upload_index
+    if reuse_uploaded:
+        client.document_index = upload_index
     if interactive and not files:
         click.echo('Select the local files to upload:')
         click.echo('[SPACE] Select file [ENTER] Next step')
@@ -185,7 +204,11 @@ def upload(files, to, quchu, vif, nobar, dzffn, config, delete_on_success, print
     else:
         thumbnail = None
     files_cls = LARGE_FILE_MODES[large_files]
-    files = files_cls(client, files, caption=caption, thumbnail=thumbnail, force_file=force_file)
+    if split_size:
+        files = files_cls(client, files, caption=caption, thumbnail=thumbnail, force_file=force_file,
+                          split_size=split_size * 1024 * 1024)
+    else:
+        files = files_cls(client, files, caption=caption, thumbnail=thumbnail, force_file=force_file)
     if large_files == 'fail':
         # Validate now
         files = list(files)
@@ -0,0 +1,180 @@
+"""Persistent state to resume interrupted transfers."""
+import hashlib
+import json
+import os
+import struct
+import time
+from typing import Iterator, Optional, Set
+
+from telegram_upload.config import UPLOAD_JOURNAL_DIRECTORY
+from telegram_upload.utils import get_environment_integer
+
+
+PARTIAL_DOWNLOAD_SUFFIX = '.part'
+DOWNLOAD_BITMAP_SUFFIX = '.bitmap'
+# Telegram keeps the uploaded parts less than a day
+UPLOAD_JOURNAL_MAX_AGE = get_environment_integer('TELEGRAM_UPLOAD_JOURNAL_MAX_AGE', 12 * 60 * 60)
+
+
+class DownloadBitmap:
+    """Sidecar file with the chunks already written in a partial download. The file has a header that
+    identifies the download (file id, file size and chunk size) followed by one bit per chunk. If the
+    header does not match the current download, the bitmap is discarded and the download starts again.
+    """
+    header = struct.Struct('<4sBqQI')
+    magic = b'TUDB'
+    version = 1
+
+    def __init__(self, path: str, file_id: int, file_size: int, part_size: int):
+        self.path = path
+        self.file_id = file_id
+        self.file_size = file_size
+        self.part_size = part_size
+        self.part_count = (file_size + part_size - 1) // part_size
+        self.bitmap = bytearray((self.part_count + 7) // 8)
+        # The bitmap on disk belonged to this download when it was opened
+        self.resumed = False
+        self._fd: Optional[int] = None
+
+    @property
+    def header_data(self) -> bytes:
+        return self.header.pack(self.magic, self.version, self.file_id, self.file_size, self.part_size)
+
+    def is_valid(self, data: bytes) -> bool:
+        """Returns if the sidecar file data belongs to this download."""
+        return data[:self.header.size] == self.header_data and len(data) == self.header.size + len(self.bitmap)
+
+    def is_resumable(self) -> bool:
+        """Returns if the sidecar file on disk belongs to this download, without opening it for writing."""
+        try:
+            with open(self.path, 'rb') as file:
+                return self.is_valid(file.read(self.header.size + len(self.bitmap)))
+        except OSError:
+            return False
+
+    def open(self) -> 'DownloadBitmap':
+        """Open the sidecar file. The previous bitmap is loaded if it belongs to this download."""
+        self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        data = os.pread(self._fd, self.header.size + len(self.bitmap), 0)
+        self.resumed = self.is_valid(data)
+        if self.resumed:
+            self.bitmap[:] = data[self.header.size:]
+        else:
+            os.ftruncate(self._fd, 0)
+            os.pwrite(self._fd, self.header_data + bytes(self.bitmap), 0)
+        return self
+
+    def close(self):
+        """Close the sidecar file. The file is kept on disk to resume the download."""
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    def remove(self):
+        """Close and remove the sidecar file after completing the download."""
+        self.close()
+        if os.path.lexists(self.path):
+            os.remove(self.path)
+
+    def is_set(self, index: int) -> bool:
+        """Returns if the chunk is already on disk."""
+        return bool(self.bitmap[index // 8] & (1 << (index % 8)))
+
+    def set(self, index: int):
+        """Mark the chunk as written. Only the byte of the chunk is written to disk."""
+        byte_index = index // 8
+        self.bitmap[byte_index] |= 1 << (index % 8)
+        os.pwrite(self._fd, self.bitmap[byte_index:byte_index + 1], self.header.size + byte_index)
+
+    def missing_offsets(self) -> Iterator[int]:
+        """Offsets of the chunks pending to download."""
+        for index in range(self.part_count):
+            if not self.is_set(index):
+                yield index * self.part_size
+
+    @property
+    def completed_size(self) -> int:
+        """Bytes already on disk."""
+        size = 0
+        for index in range(self.part_count):
+            if self.is_set(index):
+                size += min(self.part_size, self.file_size - index * self.part_size)
+        return size
+
+    def __enter__(self) -> 'DownloadBitmap':
+        return self.open()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class UploadJournal:
+    """Journal of the parts of a big file already saved in Telegram (``SaveBigFilePartRequest``). The journal
+    is identified by the file path, size, modification time and part size. The first line has the
+    ``file_id`` used in the upload, and every following line is an acknowledged part index. If the upload is
+    retried before ``UPLOAD_JOURNAL_MAX_AGE`` seconds, only the missing parts have to be sent.
+    """
+    def __init__(self, path: str, file_size: int, mtime: int, part_size: int, name: str = '',
+                 directory: str = UPLOAD_JOURNAL_DIRECTORY):
+        self.key = [os.path.abspath(path), file_size, mtime, part_size, name]
+        self.directory = directory
+        self.file_id: Optional[int] = None
+        self.parts: Set[int] = set()
+        self._fd: Optional[int] = None
+
+    @property
+    def path(self) -> str:
+        key_hash = hashlib.sha1(json.dumps(self.key).encode('utf-8')).hexdigest()
+        return os.path.join(self.directory, '{}.journal'.format(key_hash))
+
+    def open(self, file_id: int) -> int:
+        """Open the journal. Returns the file id of the previous upload if the journal is still valid.
+        Otherwise, a new journal is started using the given file id.
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        self.remove_expired()
+        header, parts = self._read()
+        if header and header.get('key') == self.key and time.time() - header['created'] < UPLOAD_JOURNAL_MAX_AGE:
+            self.file_id = header['file_id']
+            self.parts = parts
+            self._fd = os.open(self.path, os.O_WRONLY | os.O_APPEND)
+        else:
+            self.file_id = file_id
+            self.parts = set()
+            header = {'key': self.key, 'file_id': file_id, 'created': time.time()}
+            self._fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT | os.O_TRUNC, 0o600)
+            os.write(self._fd, '{}\n'.format(json.dumps(header)).encode('utf-8'))
+        return self.file_id
+
+    def _read(self):
+        try:
+            with open(self.path) as file:
+                lines = file.read().split('\n')
+            header = json.loads(lines[0])
+        except (OSError, ValueError):
+            return None, set()
+        # The last line is empty or incomplete if the process was killed while writing it
+        return header, {int(line) for line in lines[1:-1] if line.isdigit()}
+
+    def add(self, part_index: int):
+        """Record a part acknowledged by Telegram."""
+        self.parts.add(part_index)
+        if self._fd is not None:
+            os.write(self._fd, '{}\n'.format(part_index).encode('utf-8'))
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    def remove(self):
+        """Close and remove the journal after sending the file."""
+        self.close()
+        if os.path.lexists(self.path):
+            os.remove(self.path)
+
+    def remove_expired(self):
+        """Remove the journals of other uploads that can no longer be resumed."""
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith('.journal') and time.time() - entry.stat().st_mtime > UPLOAD_JOURNAL_MAX_AGE:
+                os.remove(entry.path)
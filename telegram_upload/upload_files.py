@@ -1,22 +1,23 @@
 import datetime
+import hashlib
 import math
 import os
 import cv2
 
 import mimetypes
-from io import FileIO, SEEK_SET
-from typing import Union, TYPE_CHECKING
+from io import FileIO, SEEK_SET, SEEK_CUR, SEEK_END
+from typing import Union, Optional, Tuple, TYPE_CHECKING
 
 import click
 # from hachoir.metadata.metadata import RootMetadata
 # from hachoir.metadata.video import MP4Metadata
 from telethon.tl.types import DocumentAttributeVideo, DocumentAttributeFilename
 
-from telegram_upload.caption_formatter import CaptionFormatter, FilePath
+from telegram_upload.cache import get_media_cache
+from telegram_upload.caption_formatter import CaptionFormatter, FilePath, calculate_hash
 from telegram_upload.exceptions import TelegramInvalidFile, ThumbError
-from telegram_upload.utils import scantree, truncate
-from telegram_upload.video import get_video_thumb, video_metadata
-from .video import get_video_size
+from telegram_upload.utils import truncate, walk_files
+from telegram_upload.video import get_video_thumb, video_metadata, probe_media, MediaProbe
 def get_duration_from_cv2(filename):
     try:
         cap = cv2.VideoCapture(filename)
@@ -31,8 +32,12 @@ def get_duration_from_cv2(filename):
 mimetypes.init()
 
 
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
 if TYPE_CHECKING:
     from telegram_upload.client import TelegramManagerClient
+    from telegram_upload.resume import UploadJournal
 
 
 def is_valid_file(file, error_logger=None):
@@ -63,7 +68,7 @@ def get_file_mime(file, vif):
 #         return False
 
 
-def get_file_attributes(file, vif, dzffn):
+def get_file_attributes(file, vif, dzffn, probe: Optional[MediaProbe] = None):
     attrs = []
     mime = get_file_mime(file, vif)
     if mime == 'video':
@@ -80,8 +85,12 @@ def get_file_attributes(file, vif, dzffn):
         if True:
             # supports_streaming = isinstance(video_meta, MP4Metadata)
             supports_streaming = True
-            ratio = get_video_size(dzffn, file)
-            duration_ = int(get_duration_from_cv2(file))
+            probe = probe or probe_media(dzffn, file)
+            ratio = probe.size or [0, 0]
+            if probe.duration is not None:
+                duration_ = int(probe.duration)
+            else:
+                duration_ = int(get_duration_from_cv2(file))
             # print("ratio:{}\tduration:{}".format(ratio,duration_))
             attrs.append(DocumentAttributeVideo(
                 (0, duration_)[duration_!=-1],
@@ -100,9 +109,9 @@ def get_file_attributes(file, vif, dzffn):
     return attrs
 
 
-def get_file_thumb(dzffn, vif, file):
+def get_file_thumb(dzffn, vif, file, probe: Optional[MediaProbe] = None):
     if get_file_mime(file, vif) == 'video':
-        return get_video_thumb(dzffn, file)
+        return get_video_thumb(dzffn, file, probe=probe)
 
 
 class UploadFilesBase:
@@ -134,8 +143,8 @@ class RecursiveFiles(UploadFilesBase):
     def get_iterator(self):
         for file in self.files:
             if os.path.isdir(file):
-                yield from map(lambda file: file.path,
-                               filter(lambda x: not x.is_dir(), scantree(file, True)))
+                # The DirEntry objects are returned to reuse their stat. Empty files are not valid.
+                yield from filter(lambda entry: entry.stat().st_size, walk_files(file, True))
             else:
                 yield file
 
@@ -150,9 +159,17 @@ class NoDirectoriesFiles(UploadFilesBase):
 
 
 class LargeFilesBase(UploadFilesBase):
+    @property
+    def max_file_size(self) -> int:
+        """Files larger than this size are processed as large files."""
+        return self.client.max_file_size
+
     def get_iterator(self):
         for file in self.files:
-            if os.path.getsize(file) > self.client.max_file_size:
+            # RecursiveFiles returns DirEntry objects with the stat already obtained
+            size = file.stat().st_size if isinstance(file, os.DirEntry) else os.path.getsize(file)
+            file = os.fspath(file)
+            if size > self.max_file_size:
                 yield from self.process_large_file(file)
             else:
                 yield self.process_normal_file(file)
@@ -171,10 +188,25 @@ class NoLargeFiles(LargeFilesBase):
 
 class File(FileIO):
     force_file = False
+    upload_journal: Optional['UploadJournal'] = None
+    _media_probe: Optional[MediaProbe] = None
+    _stat: Optional[os.stat_result] = None
+    _file_attributes: Optional[list] = None
+    _file_caption: Optional[Tuple[Optional[str], str]] = None
+    _content_hash: Optional[str] = None
 
     def __init__(self, client: 'TelegramManagerClient', path: str, force_file: Union[bool, None] = None,
-                 thumbnail: Union[str, bool, None] = None, caption: Union[str, None] = None, vif = True, dzffn: str ="ffmpeg"):
-        super().__init__(path)
+                 thumbnail: Union[str, bool, None] = None, caption: Union[str, None] = None, vif = True, dzffn: str ="ffmpeg",
+                 fd: Optional[int] = None):
+        if fd is None:
+            super().__init__(path)
+        else:
+            # Use an already open descriptor of the path. It is not closed with the file.
+            super().__init__(fd, closefd=False)
+            self.name = path
+        if fd is None and hasattr(os, 'posix_fadvise'):
+            # The file is read once from start to end. Ask the kernel for a larger read-ahead.
+            os.posix_fadvise(self.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
         self.client = client
         self.path = path
         self.dzffn = dzffn
@@ -187,14 +219,50 @@ class File(FileIO):
     def file_name(self):
         return os.path.basename(self.path)
 
+    @property
+    def stat(self) -> os.stat_result:
+        """Stat of the file, obtained only once. The file is not expected to change while it is uploaded."""
+        if self._stat is None:
+            self._stat = os.fstat(self.fileno())
+        return self._stat
+
     @property
     def file_size(self):
-        return os.path.getsize(self.path)
+        return self.stat.st_size
+
+    @property
+    def content_range(self) -> Tuple[int, Optional[int]]:
+        """Offset and length of the content of the file. The length is None until the end of the file."""
+        return 0, None
+
+    @property
+    def content_hash(self) -> str:
+        """SHA-256 of the content of the file. The file is read only the first time."""
+        if self._content_hash is None:
+            offset, length = self.content_range
+            self._content_hash = calculate_hash(self.path, hashlib.sha256(), offset, length, HASH_CHUNK_SIZE)
+        return self._content_hash
 
     @property
     def short_name(self):
         return '.'.join(self.file_name.split('.')[:-1])
 
+    @property
+    def is_video(self) -> bool:
+        return get_file_mime(self.path, self.vif) == 'video'
+
+    @property
+    def media_probe(self) -> Optional[MediaProbe]:
+        """Media information of the video file. The file is probed only once for the thumbnail and the attributes."""
+        if self._media_probe is None and self.is_video:
+            media_cache = get_media_cache()
+            self._media_probe = media_cache.get_probe(self.path, self.stat) if media_cache else None
+            if self._media_probe is None:
+                self._media_probe = probe_media(self.dzffn, self.path)
+                if media_cache:
+                    media_cache.set_probe(self.path, self._media_probe, self.stat)
+        return self._media_probe
+
     @property
     def is_custom_thumbnail(self):
         return self._thumbnail is not False and self._thumbnail is not None
@@ -204,19 +272,24 @@ class File(FileIO):
         """Get file caption. If caption parameter is not set, return file name.
         If caption is set, format it with CaptionFormatter.
         Anyways, truncate caption to max_caption_length.
+        The caption is generated only once for each caption parameter.
         """
+        if self._file_caption is not None and self._file_caption[0] == self._caption:
+            return self._file_caption[1]
         if self._caption is not None:
             formatter = CaptionFormatter()
             caption = formatter.format(self._caption, file=FilePath(self.path), now=datetime.datetime.now())
         else:
             caption = self.short_name
-        return truncate(caption, self.client.max_caption_length)
+        caption = truncate(caption, self.client.max_caption_length)
+        self._file_caption = (self._caption, caption)
+        return caption
 
     def get_thumbnail(self):
         thumb = None
         if self._thumbnail is None and not self.force_file:
             try:
-                thumb = get_file_thumb(self.dzffn, self.vif, self.path)
+                thumb = self._get_generated_thumbnail()
             except ThumbError as e:
                 pass
                 # click.echo('{}'.format(e), err=True)
@@ -230,35 +303,94 @@ class File(FileIO):
             thumb = self._thumbnail
         return thumb
 
+    def prepare(self) -> Optional[str]:
+        """Probe the file and get its thumbnail before the upload. The next files are prepared in threads while
+        the current file is uploaded. Returns the thumbnail, like ``get_thumbnail``.
+        """
+        if not self.force_file:
+            # The probe is reused by file_attributes
+            self.media_probe
+        return self.get_thumbnail()
+
+    def _get_generated_thumbnail(self) -> Optional[str]:
+        """Get the thumbnail from the media cache or generate it with ffmpeg."""
+        media_cache = get_media_cache()
+        thumb = media_cache.get_thumbnail(self.path, self.stat) if media_cache else None
+        if thumb is None:
+            thumb = get_file_thumb(self.dzffn, self.vif, self.path, self.media_probe)
+            if thumb and media_cache:
+                media_cache.set_thumbnail(self.path, thumb, self.stat)
+        return thumb
+
+    def remove_upload_journal(self):
+        """Remove the journal of the parts uploaded. Used after sending the file or after an error."""
+        if self.upload_journal is not None:
+            self.upload_journal.remove()
+            self.upload_journal = None
+
     @property
     def file_attributes(self):
-        if self.force_file:
-            return [DocumentAttributeFilename(self.file_name)]
-        else:
-            return get_file_attributes(self.path, self.vif, self.dzffn)
+        if self._file_attributes is None and self.force_file:
+            self._file_attributes = [DocumentAttributeFilename(self.file_name)]
+        elif self._file_attributes is None:
+            self._file_attributes = get_file_attributes(self.path, self.vif, self.dzffn, self.media_probe)
+        return self._file_attributes
 
 
 class SplitFile(File, FileIO):
+    """Part of a large file. The parts of a file share the descriptor of the source file and read it using
+    ``pread``, so each part has its own position and several parts can be uploaded at the same time.
+    The position of the part (``seek`` and ``tell``) is relative to the start of the part.
+    """
     force_file = True
-
-    def __init__(self, client: 'TelegramManagerClient', file: Union[str, bytes, int], max_read_size: int, name: str):
-        super().__init__(client, file)
+    split_offset = 0
+
+    def __init__(self, client: 'TelegramManagerClient', file: Union[str, bytes, int], max_read_size: int, name: str,
+                 split_offset: int = 0, source: Optional[FileIO] = None):
+        # A shared source is closed when all its parts are released. Otherwise the part owns its source.
+        self._owns_source = source is None
+        self.source = FileIO(file) if source is None else source
+        super().__init__(client, file, fd=self.source.fileno())
         self.max_read_size = max_read_size
-        self.remaining_size = max_read_size
+        self.split_offset = split_offset
+        self.position = 0
         self._name = name
 
+    @property
+    def remaining_size(self) -> int:
+        return max(0, self.max_read_size - self.position)
+
     def read(self, size: int = -1) -> bytes:
-        if size == -1:
+        if size is None or size < 0 or size > self.remaining_size:
             size = self.remaining_size
-        if not self.remaining_size:
+        if not size:
             return b''
-        size = min(self.remaining_size, size)
-        self.remaining_size -= size
-        return super().read(size)
+        data = os.pread(self.fileno(), size, self.split_offset + self.position)
+        self.position += len(data)
+        return data
+
+    def readinto(self, buffer) -> int:
+        """Read into a preallocated buffer without exceeding the split size."""
+        view = memoryview(buffer).cast('B')[:self.remaining_size]
+        if not len(view):
+            return 0
+        if hasattr(os, 'preadv'):
+            size = os.preadv(self.fileno(), [view], self.split_offset + self.position)
+        else:
+            data = os.pread(self.fileno(), len(view), self.split_offset + self.position)
+            size = len(data)
+            view[:size] = data
+        self.position += size
+        return size
 
     def readall(self) -> bytes:
         return self.read()
 
+    def close(self) -> None:
+        super().close()
+        if self._owns_source:
+            self.source.close()
+
     @property
     def file_name(self):
         return self._name
@@ -268,9 +400,27 @@ class SplitFile(File, FileIO):
         return self.max_read_size
 
     def seek(self, offset: int, whence: int = SEEK_SET, split_seek: bool = False) -> int:
-        if not split_seek:
-            self.remaining_size += self.tell() - offset
-        return super().seek(offset, whence)
+        if split_seek:
+            # Move the start of the part in the source file
+            self.split_offset = offset
+            self.position = 0
+        elif whence == SEEK_SET:
+            self.position = offset
+        elif whence == SEEK_CUR:
+            self.position += offset
+        elif whence == SEEK_END:
+            self.position = self.max_read_size + offset
+        else:
+            raise ValueError('Invalid whence ({})'.format(whence))
+        self.position = max(0, self.position)
+        return self.position
+
+    def tell(self) -> int:
+        return self.position
+
+    @property
+    def content_range(self) -> Tuple[int, Optional[int]]:
+        return self.split_offset, self.max_read_size
 
     @property
     def short_name(self):
@@ -278,13 +428,32 @@ class SplitFile(File, FileIO):
 
 
 class SplitFiles(LargeFilesBase):
+    def __init__(self, *args, split_size: Optional[int] = None, **kwargs):
+        """Split the files larger than the split size.
+
+        :param split_size: size of the parts. By default and at most the maximum file size of the account.
+        """
+        super().__init__(*args, **kwargs)
+        self.split_size = split_size
+
+    @property
+    def max_file_size(self) -> int:
+        if self.split_size:
+            return min(self.split_size, self.client.max_file_size)
+        return self.client.max_file_size
+
     def process_large_file(self, file):
         file_name = os.path.basename(file)
         total_size = os.path.getsize(file)
-        parts = math.ceil(total_size / self.client.max_file_size)
-        zfill = int(math.log10(10)) + 1
+        part_size = self.max_file_size
+        parts = math.ceil(total_size / part_size)
+        # All the parts have the same number of digits, so they are sorted by name. At least 2 digits.
+        zfill = max(2, len(str(parts - 1)))
+        # The file is opened once for all the parts
+        source = FileIO(file)
+        if hasattr(os, 'posix_fadvise'):
+            os.posix_fadvise(source.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
         for part in range(parts):
-            size = total_size - (part * self.client.max_file_size) if part >= parts - 1 else self.client.max_file_size
-            splitted_file = SplitFile(self.client, file, size, '{}.{}'.format(file_name, str(part).zfill(zfill)))
-            splitted_file.seek(self.client.max_file_size * part, split_seek=True)
-            yield splitted_file
+            size = total_size - (part * part_size) if part >= parts - 1 else part_size
+            yield SplitFile(self.client, file, size, '{}.{}'.format(file_name, str(part).zfill(zfill)),
+                            split_offset=part_size * part, source=source)
@@ -1,7 +1,10 @@
 import asyncio
+import errno
 import itertools
 import os
 import shutil
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from typing import Iterator, Optional
 from telegram_upload._compat import scandir
 from telegram_upload.exceptions import TelegramEnvironmentError
 
@@ -10,6 +13,20 @@ def free_disk_usage(directory='.'):
     return shutil.disk_usage(directory)[2]
 
 
+def preallocate_file(fd: int, size: int):
+    """Reserve the disk space of a file opened for writing. The file size is set to the given size."""
+    try:
+        os.posix_fallocate(fd, 0, size)
+    except AttributeError:
+        # posix_fallocate is not available on all systems
+        os.ftruncate(fd, size)
+    except OSError as e:
+        # Some filesystems do not support it. Other errors (like a full disk) are raised.
+        if e.errno not in (errno.EOPNOTSUPP, errno.EINVAL):
+            raise
+        os.ftruncate(fd, size)
+
+
 def truncate(text, max_length):
     return (text[:max_length - 3] + '...') if len(text) > max_length else text
 
@@ -40,6 +57,42 @@ def scantree(path, follow_symlinks=False):
             yield entry
 
 
+def walk_files(path, follow_symlinks=False, workers: Optional[int] = None) -> Iterator[os.DirEntry]:
+    """Yield the DirEntry objects of the files in the directory tree. The directories are read by a pool of
+    ``workers`` threads (``TELEGRAM_UPLOAD_SCAN_WORKERS``, 4 by default) and the files are yielded as soon as their
+    directory is read, so the consumer can start before the walk finishes. The pending directories are kept in
+    a stack instead of recursion. The order of the files is not guaranteed.
+    """
+    workers = workers or get_environment_integer('TELEGRAM_UPLOAD_SCAN_WORKERS', 4)
+    stack = [path]
+    visited = set()
+
+    def read_directory(directory):
+        with scandir(directory) as entries:
+            return list(entries)
+
+    with ThreadPoolExecutor(workers, thread_name_prefix='telegram-upload-scan') as executor:
+        pending = set()
+        try:
+            while stack or pending:
+                while stack and len(pending) < workers:
+                    pending.add(executor.submit(read_directory, stack.pop()))
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    for entry in future.result():
+                        if not entry.is_dir(follow_symlinks=follow_symlinks):
+                            yield entry
+                        elif not follow_symlinks or not entry.is_symlink():
+                            stack.append(entry.path)
+                        elif (entry.stat().st_dev, entry.stat().st_ino) not in visited:
+                            # Do not follow the links to directories twice (symlink loops)
+                            visited.add((entry.stat().st_dev, entry.stat().st_ino))
+                            stack.append(entry.path)
+        finally:
+            for future in pending:
+                future.cancel()
+
+
 def async_to_sync(coro):
     loop = asyncio.get_event_loop()
     if loop.is_running():
@@ -48,6 +101,37 @@ def async_to_sync(coro):
         return loop.run_until_complete(coro)
 
 
+class TransferBudget:
+    """Limit the transfers running at the same time by number and by total size. A transfer larger than
+    the size budget is allowed when no other transfer is running.
+    """
+    def __init__(self, max_size: int, max_transfers: int):
+        self.max_size = max_size
+        self.max_transfers = max_transfers
+        self.size = 0
+        self.transfers = 0
+        self._condition = asyncio.Condition()
+
+    def _is_available(self, size: int) -> bool:
+        if not self.transfers:
+            return True
+        return self.transfers < self.max_transfers and self.size + size <= self.max_size
+
+    async def acquire(self, size: int):
+        """Wait until the transfer fits in the budget."""
+        async with self._condition:
+            await self._condition.wait_for(lambda: self._is_available(size))
+            self.size += size
+            self.transfers += 1
+
+    async def release(self, size: int):
+        """Return the size of a finished transfer to the budget."""
+        async with self._condition:
+            self.size -= size
+            self.transfers -= 1
+            self._condition.notify_all()
+
+
 async def aislice(iterator, limit):
     items = []
     i = 0
@@ -1,3 +1,4 @@
+import json
 import platform
 import re
 import subprocess
@@ -9,6 +10,8 @@ __log__ = logging.getLogger(__name__)
 # from hachoir.parser import createParser
 # from hachoir.core import config as hachoir_config
 
+from typing import List, Optional
+
 from telegram_upload.exceptions import ThumbVideoError
 
 
@@ -34,12 +37,70 @@ def get_ffmpeg_command(dzffn):
                           '{}.exe'.format(dzffn) if platform.system() == 'Windows' else '{}'.format(dzffn))
 
 
-def get_video_size(dzffn, file):
-    p = call_ffmpeg(dzffn, [
-        '-i', file,
-    ])
+def get_ffprobe_command(dzffn):
+    # ffprobe is distributed with ffmpeg, so it is in the same location
+    ffprobe = os.path.join(os.path.dirname(get_ffmpeg_command(dzffn)), 'ffprobe')
+    return os.environ.get('FFPROBE_COMMAND',
+                          '{}.exe'.format(ffprobe) if platform.system() == 'Windows' else ffprobe)
+
+
+class MediaProbe:
+    """Media information of a file: size and duration of the first video stream and all the streams."""
+    def __init__(self, width: Optional[int] = None, height: Optional[int] = None,
+                 duration: Optional[float] = None, streams: Optional[List[dict]] = None):
+        self.width = width
+        self.height = height
+        self.duration = duration
+        self.streams = streams or []
+
+    @property
+    def size(self) -> Optional[List[int]]:
+        """Video size as [width, height]. None if the file has no video stream."""
+        if self.width and self.height:
+            return [self.width, self.height]
+
+    def as_dict(self) -> dict:
+        return {'width': self.width, 'height': self.height, 'duration': self.duration, 'streams': self.streams}
+
+    @classmethod
+    def from_ffprobe(cls, data: dict) -> 'MediaProbe':
+        streams = data.get('streams', [])
+        video = next((stream for stream in streams if stream.get('codec_type') == 'video'), {})
+        duration = data.get('format', {}).get('duration') or video.get('duration')
+        return cls(video.get('width'), video.get('height'), float(duration) if duration else None, streams)
+
+    @classmethod
+    def from_ffmpeg_output(cls, output: str) -> 'MediaProbe':
+        size = parse_video_size(output) or [None, None]
+        duration = re.search(r'Duration: (\d+):(\d{2}):(\d{2}(?:\.\d+)?)', output)
+        if duration:
+            duration = int(duration.group(1)) * 3600 + int(duration.group(2)) * 60 + float(duration.group(3))
+        return cls(size[0], size[1], duration)
+
+
+def probe_media(dzffn, file) -> MediaProbe:
+    """Get the media information using a single ffprobe call. If ffprobe is not available, the output of
+    ``ffmpeg -i`` is used. Returns an empty probe if neither is available.
+    """
+    try:
+        p = subprocess.Popen([get_ffprobe_command(dzffn), '-v', 'error', '-print_format', 'json',
+                              '-show_format', '-show_streams', file],
+                             stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        stdout, stderr = p.communicate()
+        if not p.returncode:
+            return MediaProbe.from_ffprobe(json.loads(stdout.decode('utf-8')))
+    except (FileNotFoundError, ValueError):
+        pass
+    try:
+        p = call_ffmpeg(dzffn, ['-i', file])
+    except ThumbVideoError:
+        return MediaProbe()
     stdout, stderr = p.communicate()
-    video_lines = re.findall(': Video: ([^\n]+)', stderr.decode('utf-8'))
+    return MediaProbe.from_ffmpeg_output(stderr.decode('utf-8', errors='replace'))
+
+
+def parse_video_size(output: str) -> Optional[List[int]]:
+    video_lines = re.findall(': Video: ([^\n]+)', output)
     if not video_lines:
         return
     matchs = re.findall("(\d{2,6})x(\d{2,6})", video_lines[0])
@@ -47,16 +108,20 @@ def get_video_size(dzffn, file):
         return [int(x) for x in matchs[0]]
 
 
-def get_video_thumb(dzffn, file, output=None, size=200):
+def get_video_size(dzffn, file):
+    p = call_ffmpeg(dzffn, [
+        '-i', file,
+    ])
+    stdout, stderr = p.communicate()
+    return parse_video_size(stderr.decode('utf-8'))
+
+
+def get_video_thumb(dzffn, file, output=None, size=200, probe: Optional[MediaProbe] = None):
     # print('get_video_thumb')
     output = output or tempfile.NamedTemporaryFile(suffix='.jpg').name
-    metadata = video_metadata(file)
-    # metadata = None
-    if metadata is None:
-        return
-    # duration = metadata.get('duration').seconds if metadata.has('duration') else 0
-    duration = 0
-    ratio = get_video_size(dzffn, file)
+    probe = probe or probe_media(dzffn, file)
+    duration = probe.duration or 0
+    ratio = probe.size
     if ratio is None:
         raise ThumbVideoError('Video ratio is not available.')
     if ratio[0] / ratio[1] > 1:
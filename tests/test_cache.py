@@ -0,0 +1,89 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from telethon.tl.types import Document, InputDocument
+
+from telegram_upload.cache import MediaCache, UploadIndex
+from telegram_upload.video import MediaProbe
+
+
+class TestMediaCache(unittest.TestCase):
+    def setUp(self) -> None:
+        self.directory = tempfile.mkdtemp()
+        self.cache = MediaCache(os.path.join(self.directory, 'media.sqlite'),
+                                os.path.join(self.directory, 'thumbnails'))
+        self.file = os.path.join(self.directory, 'video.mp4')
+        with open(self.file, 'wb') as file:
+            file.write(b'video')
+
+    def tearDown(self) -> None:
+        self.cache.close()
+        shutil.rmtree(self.directory)
+
+    def test_probe(self):
+        self.assertIsNone(self.cache.get_probe(self.file))
+        self.cache.set_probe(self.file, MediaProbe(1920, 1080, 10.5, [{'codec_type': 'video'}]))
+        probe = self.cache.get_probe(self.file)
+        self.assertEqual([1920, 1080], probe.size)
+        self.assertEqual(10.5, probe.duration)
+        self.assertEqual([{'codec_type': 'video'}], probe.streams)
+
+    def test_file_changed(self):
+        self.cache.set_probe(self.file, MediaProbe(1920, 1080, 10.5))
+        with open(self.file, 'ab') as file:
+            file.write(b'changed')
+        self.assertIsNone(self.cache.get_probe(self.file))
+
+    def test_thumbnail(self):
+        thumbnail = os.path.join(self.directory, 'thumb.jpg')
+        with open(thumbnail, 'wb') as file:
+            file.write(b'thumb')
+        self.cache.set_probe(self.file, MediaProbe(1920, 1080, 10.5))
+        self.cache.set_thumbnail(self.file, thumbnail)
+        os.remove(thumbnail)
+        copy = self.cache.get_thumbnail(self.file)
+        with open(copy, 'rb') as file:
+            self.assertEqual(b'thumb', file.read())
+        os.remove(copy)
+        # The probe is kept after saving the thumbnail
+        self.assertIsNotNone(self.cache.get_probe(self.file))
+
+    def test_missing_file(self):
+        self.cache.set_probe('missing.mp4', MediaProbe())
+        self.assertIsNone(self.cache.get_probe('missing.mp4'))
+        self.assertIsNone(self.cache.get_thumbnail('missing.mp4'))
+
+
+class TestUploadIndex(unittest.TestCase):
+    def setUp(self) -> None:
+        self.directory = tempfile.mkdtemp()
+        self.index = UploadIndex(os.path.join(self.directory, 'index.sqlite'))
+        self.file = os.path.join(self.directory, 'file.txt')
+        with open(self.file, 'wb') as file:
+            file.write(b'file')
+
+    def tearDown(self) -> None:
+        self.index.close()
+        shutil.rmtree(self.directory)
+
+    def test_uploaded(self):
+        self.assertFalse(self.index.is_uploaded(self.file, 'file.txt', 'me', os.stat(self.file)))
+        self.index.add(self.file, 'file.txt', 'me', os.stat(self.file), 10)
+        self.assertTrue(self.index.is_uploaded(self.file, 'file.txt', 'me', os.stat(self.file)))
+        with self.subTest("Test other destination"):
+            self.assertFalse(self.index.is_uploaded(self.file, 'file.txt', 1234, os.stat(self.file)))
+        with self.subTest("Test file changed"):
+            with open(self.file, 'ab') as file:
+                file.write(b'changed')
+            self.assertFalse(self.index.is_uploaded(self.file, 'file.txt', 'me', os.stat(self.file)))
+
+    def test_documents(self):
+        document = Document(1, 2, b'reference', None, 'video/mp4', 100, 4, [])
+        self.assertIsNone(self.index.get_document('hash', 100))
+        self.index.add_document('hash', 100, document)
+        self.assertEqual(InputDocument(1, 2, b'reference'), self.index.get_document('hash', 100))
+        self.assertIsNone(self.index.get_document('hash', 200))
+        self.index.remove_document('hash', 100)
+        self.assertIsNone(self.index.get_document('hash', 100))
@@ -0,0 +1,152 @@
+import asyncio
+import unittest
+from unittest.mock import patch
+
+from telegram_upload.client.concurrency import AdaptiveUploadWindow, UploadSession, FloodWaitGate, \
+    RateLimiter, backoff_delay
+
+
+class TestAdaptiveUploadWindow(unittest.TestCase):
+    def test_acquire(self):
+        async def upload_parts():
+            window = AdaptiveUploadWindow(2)
+            await window.acquire()
+            await window.acquire()
+            waiter = asyncio.create_task(window.acquire())
+            await asyncio.sleep(0)
+            self.assertFalse(waiter.done())
+            window.release()
+            await asyncio.sleep(0)
+            self.assertTrue(waiter.done())
+            self.assertEqual(2, window.in_flight)
+
+        asyncio.run(upload_parts())
+
+    def test_additive_increase(self):
+        window = AdaptiveUploadWindow(2, maximum=4)
+        for _ in range(4):
+            window.in_flight += 1
+            window.release(1.0)
+        self.assertEqual(3, window.size)
+        for _ in range(100):
+            window.in_flight += 1
+            window.release(1.0)
+        self.assertEqual(4, window.size)
+
+    def test_delayed_parts(self):
+        window = AdaptiveUploadWindow(2)
+        window.in_flight += 1
+        window.release(1.0)
+        window_size = window.window
+        for _ in range(10):
+            window.in_flight += 1
+            window.release(3.0)
+        self.assertEqual(window_size, window.window)
+
+    def test_multiplicative_decrease(self):
+        window = AdaptiveUploadWindow(8)
+        window.decrease()
+        self.assertEqual(4, window.size)
+        # Several errors in the same round trip only decrease the window once
+        window.decrease()
+        self.assertEqual(4, window.size)
+        with patch("telegram_upload.client.concurrency.time.monotonic", return_value=10 ** 9):
+            window.decrease()
+        self.assertEqual(2, window.size)
+
+    def test_minimum(self):
+        window = AdaptiveUploadWindow(1)
+        window.decrease()
+        self.assertEqual(1, window.size)
+
+
+class TestUploadSession(unittest.TestCase):
+    def test_wait_own_tasks(self):
+        async def upload_parts():
+            other = asyncio.create_task(asyncio.sleep(10))
+            async with UploadSession() as session:
+                task = session.create_task(asyncio.sleep(0), name='part')
+            self.assertTrue(task.done())
+            self.assertFalse(other.done())
+            self.assertEqual(set(), session.tasks)
+            other.cancel()
+
+        asyncio.run(upload_parts())
+
+    def test_part_error(self):
+        async def fail():
+            raise RuntimeError('part failed')
+
+        async def upload_parts():
+            with self.assertRaises(RuntimeError):
+                async with UploadSession() as session:
+                    slow = session.create_task(asyncio.sleep(10))
+                    await asyncio.wait([session.create_task(fail())])
+                    await asyncio.sleep(0)
+                    with self.assertRaises(RuntimeError):
+                        session.raise_for_error()
+            self.assertTrue(slow.cancelled())
+
+        asyncio.run(upload_parts())
+
+    def test_exit_with_error(self):
+        async def upload_parts():
+            with self.assertRaises(ValueError):
+                async with UploadSession() as session:
+                    task = session.create_task(asyncio.sleep(10))
+                    raise ValueError
+            self.assertTrue(task.cancelled())
+
+        asyncio.run(upload_parts())
+
+
+class TestBackoffDelay(unittest.TestCase):
+    def test_delay(self):
+        for retry, expected in [(0, 2), (1, 4), (2, 8), (10, 60)]:
+            with self.subTest(retry=retry):
+                delay = backoff_delay(retry, 2, 60)
+                self.assertGreaterEqual(delay, expected / 2)
+                self.assertLessEqual(delay, expected)
+
+
+class TestFloodWaitGate(unittest.TestCase):
+    def test_close(self):
+        gate = FloodWaitGate()
+        gate.close(2, 10)
+        gate.close(2, 5)
+        self.assertGreater(gate.remaining(2), 5)
+        self.assertEqual(0, gate.remaining(4))
+
+    def test_wait(self):
+        async def wait():
+            gate = FloodWaitGate()
+            gate.close(2, 0.01)
+            other_dc = asyncio.create_task(gate.wait(4))
+            await asyncio.sleep(0)
+            self.assertTrue(other_dc.done())
+            await gate.wait(2)
+            self.assertEqual(0, gate.remaining(2))
+
+        asyncio.run(wait())
+
+
+class TestRateLimiter(unittest.TestCase):
+    def test_burst(self):
+        async def acquire():
+            limiter = RateLimiter(100, 3)
+            for _ in range(3):
+                await limiter.acquire()
+            self.assertLess(limiter.tokens, 1)
+
+        asyncio.run(acquire())
+
+    def test_wait(self):
+        async def acquire():
+            limiter = RateLimiter(100, 1)
+            await limiter.acquire()
+            with patch('telegram_upload.client.concurrency.asyncio.sleep', wraps=asyncio.sleep) as mock_sleep:
+                await limiter.acquire()
+            mock_sleep.assert_called()
+            self.assertLessEqual(mock_sleep.call_args[0][0], 0.01)
+
+        asyncio.run(acquire())
@@ -0,0 +1,83 @@
+import asyncio
+import unittest
+from unittest.mock import patch, MagicMock, AsyncMock
+
+from telegram_upload.client.senders import SenderPool
+
+
+class TestSenderPool(unittest.TestCase):
+    def setUp(self) -> None:
+        self.mock_client = MagicMock(**{"session.dc_id": 2, "_get_dc": AsyncMock(), "_call": AsyncMock()})
+
+    @patch("telegram_upload.client.senders.MTProtoSender")
+    def test_same_dc(self, mock_sender_cls: MagicMock):
+        mock_sender_cls.return_value.connect = AsyncMock()
+        pool = SenderPool(self.mock_client, 2, 3)
+        asyncio.run(pool.connect())
+        self.assertEqual(3, len(pool.senders))
+        mock_sender_cls.assert_called_with(self.mock_client.session.auth_key, loggers=self.mock_client._log)
+        self.mock_client.assert_not_called()
+
+    @patch("telegram_upload.client.senders.MTProtoSender")
+    def test_other_dc(self, mock_sender_cls: MagicMock):
+        senders = [MagicMock(connect=AsyncMock(), send=AsyncMock()) for _ in range(2)]
+        mock_sender_cls.side_effect = senders
+        self.mock_client.side_effect = AsyncMock()
+        pool = SenderPool(self.mock_client, 4, 2)
+        asyncio.run(pool.connect())
+        # The authorization is only exported for the first sender
+        self.mock_client.assert_called_once()
+        senders[0].send.assert_awaited_once()
+        senders[1].send.assert_not_awaited()
+        self.assertEqual(senders[0].auth_key, mock_sender_cls.call_args[0][0])
+
+    @patch("telegram_upload.client.senders.MTProtoSender")
+    def test_round_robin(self, mock_sender_cls: MagicMock):
+        senders = [MagicMock(connect=AsyncMock()) for _ in range(2)]
+        mock_sender_cls.side_effect = senders
+        pool = SenderPool(self.mock_client, 2, 2)
+        self.assertIsNone(pool.get())
+        asyncio.run(pool.connect())
+        self.assertEqual([senders[0], senders[1], senders[0]], [pool.get() for _ in range(3)])
+        mock_request = MagicMock()
+        asyncio.run(pool.send(mock_request))
+        self.mock_client._call.assert_awaited_once_with(senders[1], mock_request)
+
+    @patch("telegram_upload.client.senders.MTProtoSender")
+    def test_send_disconnected_sender(self, mock_sender_cls: MagicMock):
+        senders = [MagicMock(connect=AsyncMock(), disconnect=AsyncMock()) for _ in range(3)]
+        mock_sender_cls.side_effect = senders
+        self.mock_client._call.side_effect = [ConnectionError, "result"]
+        pool = SenderPool(self.mock_client, 2, 2)
+        asyncio.run(pool.connect())
+        mock_request = MagicMock()
+        self.assertEqual("result", asyncio.run(pool.send(mock_request)))
+        # The disconnected sender is replaced and the request is sent again
+        self.assertEqual([senders[2], senders[1]], pool.senders)
+        senders[0].disconnect.assert_awaited_once()
+        self.mock_client._call.assert_awaited_with(senders[2], mock_request)
+
+    @patch("telegram_upload.client.senders.MTProtoSender")
+    def test_send_replace_sender_error(self, mock_sender_cls: MagicMock):
+        senders = [MagicMock(connect=AsyncMock(), disconnect=AsyncMock()) for _ in range(2)]
+        senders[1].connect.side_effect = ConnectionError
+        mock_sender_cls.side_effect = senders
+        self.mock_client._call.side_effect = ConnectionError
+        pool = SenderPool(self.mock_client, 2, 1)
+        asyncio.run(pool.connect())
+        with self.assertRaises(ConnectionError):
+            asyncio.run(pool.send(MagicMock()))
+        # The sender is replaced in the next request
+        self.assertEqual([senders[0]], pool.senders)
+        senders[0].disconnect.assert_not_awaited()
+
+    @patch("telegram_upload.client.senders.MTProtoSender")
+    def test_disconnect(self, mock_sender_cls: MagicMock):
+        mock_sender_cls.return_value.connect = AsyncMock()
+        mock_sender_cls.return_value.disconnect = AsyncMock()
+        pool = SenderPool(self.mock_client, 2, 2)
+        asyncio.run(pool.connect())
+        asyncio.run(pool.disconnect())
+        self.assertEqual([], pool.senders)
+        self.assertIsNone(pool.get())
+        self.assertEqual(2, mock_sender_cls.return_value.disconnect.await_count)
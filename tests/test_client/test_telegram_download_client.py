@@ -1,13 +1,20 @@
 import asyncio
 import json
+import os
 import sys
+import tempfile
 import unittest
-from unittest.mock import patch, mock_open, Mock, MagicMock, call
+from unittest.mock import patch, mock_open, Mock, MagicMock, call, AsyncMock
 
-from telethon.tl.types import DocumentAttributeFilename
+from telethon.errors import FileMigrateError, TimedOutError
+from telethon.tl.types import DocumentAttributeFilename, Document
+from telethon.tl.types.upload import FileCdnRedirect
 
 from telegram_upload.client.telegram_download_client import TelegramDownloadClient
-from telegram_upload.exceptions import TelegramUploadNoSpaceError
+from telegram_upload.download_files import DownloadFile, JoinedDownloadFile, JoinDownloadSplitFiles
+from telegram_upload.exceptions import TelegramUploadNoSpaceError, TelegramUploadIncompleteDownloadError, \
+    TelegramUploadError
+from telegram_upload.resume import DownloadBitmap
 
 CONFIG_DATA = {'api_hash': '', 'api_id': ''}
 
@@ -60,15 +67,280 @@ class TestTelegramDownloadClient(unittest.TestCase):
             mock_input_location, mock_file, file_size=file_size, part_size_kb=part_size,
             progress_callback=mock_progress_callback,
         )
-        mock_file.write.assert_called_once_with(b"foo0foo1")
+        mock_file.write.assert_has_calls([call(b"foo0"), call(b"foo1")])
         mock_iter_download_chunk_tasks.assert_called_once_with(
             mock_input_location, part_size * 1024, None, None, file_size,
         )
-        mock_wait.assert_called_once_with(mock_iter_download_chunk_tasks.return_value)
+        mock_wait.assert_has_calls([call([task]) for task in mock_iter_download_chunk_tasks.return_value])
+
+    @patch("telegram_upload.client.telegram_download_client.PARALLEL_DOWNLOAD_BLOCKS", 2)
+    @patch("telegram_upload.client.telegram_download_client.asyncio.wait")
+    @unittest.skipIf(sys.version_info < (3, 8), "object MagicMock can't be used in 'await' expression")
+    def test_write_download_chunks(self, mock_wait: MagicMock):
+        started = []
+
+        def iter_tasks():
+            for i in range(4):
+                started.append(i)
+                yield MagicMock(**{"result.return_value": f"foo{i}".encode("utf-8") if i < 3 else b""})
+
+        def write(chunk):
+            # The window keeps two requests in flight
+            self.assertEqual(int(chunk[-1:]) + 2, len(started))
+
+        mock_file = MagicMock(**{"write.side_effect": write})
+        tasks = iter_tasks()
+        asyncio.run(self.client._write_download_chunks(mock_file, tasks, 1024, 4096))
+        mock_file.write.assert_has_calls([call(b"foo0"), call(b"foo1"), call(b"foo2")])
+        self.assertEqual(3, mock_file.write.call_count)
+
+    @patch("telegram_upload.client.telegram_download_client.DOWNLOAD_BUFFER_SIZE", 1024)
+    @patch("telegram_upload.client.telegram_download_client.asyncio.wait")
+    @unittest.skipIf(sys.version_info < (3, 8), "object MagicMock can't be used in 'await' expression")
+    def test_write_download_chunks_buffer_size(self, mock_wait: MagicMock):
+        mock_tasks = [MagicMock(**{"result.return_value": b"foo"}), MagicMock(**{"result.return_value": b""}),
+                      MagicMock()]
+        mock_file = MagicMock()
+        asyncio.run(self.client._write_download_chunks(mock_file, iter(mock_tasks), 1024, 4096))
+        mock_file.write.assert_called_once_with(b"foo")
+        # The buffer only allows one chunk, so the third request is never launched
+        mock_wait.assert_has_calls([call([mock_tasks[0]]), call([mock_tasks[1]])])
+        mock_tasks[2].cancel.assert_not_called()
+
+    @staticmethod
+    async def mark_download_chunks(fd, chunk_tasks, part_size, file_size, progress_callback=None, bitmap=None,
+                                   base_offset=0):
+        """Mock of _write_download_chunks_at_offsets. The chunks are marked as written without writing them."""
+        for offset, _ in chunk_tasks:
+            bitmap.set(offset // part_size)
+
+    def test_write_download_chunks_at_offsets(self):
+        async def chunk(data: bytes, delay: float):
+            await asyncio.sleep(delay)
+            return data
+
+        async def write_chunks(fd: int):
+            # The first chunk is the slowest one
+            chunk_tasks = [
+                (0, asyncio.create_task(chunk(b"foo", 0.02))),
+                (3, asyncio.create_task(chunk(b"bar", 0))),
+                (6, asyncio.create_task(chunk(b"baz", 0.01))),
+            ]
+            await self.client._write_download_chunks_at_offsets(
+                fd, iter(chunk_tasks), 1024, 9, mock_progress_callback
+            )
+
+        mock_progress_callback = Mock()
+        with tempfile.TemporaryFile() as file:
+            file.truncate(9)
+            asyncio.run(write_chunks(file.fileno()))
+            file.seek(0)
+            self.assertEqual(b"foobarbaz", file.read())
+        mock_progress_callback.assert_has_calls([call(3, 9), call(6, 9), call(9, 9)])
+
+    @patch("telegram_upload.client.telegram_download_client.TelegramDownloadClient._write_download_chunks_at_offsets")
+    @patch("telegram_upload.client.telegram_download_client.TelegramDownloadClient._iter_download_chunk_tasks")
+    def test_download_file_positional(self, mock_iter_download_chunk_tasks: MagicMock,
+                                      mock_write_download_chunks_at_offsets: MagicMock):
+        file_size = 8192
+        mock_input_location = MagicMock(id=1)
+        mock_iter_download_chunk_tasks.side_effect = lambda *args: [MagicMock(), MagicMock()]
+        mock_write_download_chunks_at_offsets.side_effect = self.mark_download_chunks
+        with tempfile.TemporaryDirectory() as directory:
+            file_name = os.path.join(directory, "download.bin")
+            asyncio.run(self.client._download_file(mock_input_location, file_name, file_size=file_size,
+                                                   part_size_kb=4))
+            self.assertEqual(file_size, os.path.getsize(file_name))
+            self.assertEqual([file_name], [os.path.join(directory, name) for name in os.listdir(directory)])
+        mock_iter_download_chunk_tasks.assert_called_once_with(
+            mock_input_location, 4096, None, None, file_size, [0, 4096]
+        )
+        mock_write_download_chunks_at_offsets.assert_called_once()
+
+    @patch("telegram_upload.client.telegram_download_client.TelegramDownloadClient._write_download_chunks_at_offsets")
+    @patch("telegram_upload.client.telegram_download_client.TelegramDownloadClient._iter_download_chunk_tasks")
+    def test_download_file_incomplete(self, mock_iter_download_chunk_tasks: MagicMock,
+                                      mock_write_download_chunks_at_offsets: MagicMock):
+        mock_input_location = MagicMock(id=1)
+        # The chunks are not written, like empty chunks
+        with tempfile.TemporaryDirectory() as directory:
+            file_name = os.path.join(directory, "download.bin")
+            with self.assertRaises(TelegramUploadIncompleteDownloadError):
+                asyncio.run(self.client._download_file(mock_input_location, file_name, file_size=8192,
+                                                       part_size_kb=4))
+            self.assertEqual(["download.bin.part", "download.bin.part.bitmap"], sorted(os.listdir(directory)))
+
+    @patch("telegram_upload.client.telegram_download_client.TelegramDownloadClient._write_download_chunks_at_offsets")
+    @patch("telegram_upload.client.telegram_download_client.TelegramDownloadClient._iter_download_chunk_tasks")
+    def test_download_file_resume(self, mock_iter_download_chunk_tasks: MagicMock,
+                                  mock_write_download_chunks_at_offsets: MagicMock):
+        file_size = 8192
+        mock_input_location = MagicMock(id=1)
+        mock_write_download_chunks_at_offsets.side_effect = ConnectionError
+        with tempfile.TemporaryDirectory() as directory:
+            file_name = os.path.join(directory, "download.bin")
+            with DownloadBitmap(file_name + ".part.bitmap", 1, file_size, 4096) as bitmap:
+                bitmap.set(0)
+            with self.assertRaises(ConnectionError):
+                asyncio.run(self.client._download_file(mock_input_location, file_name, file_size=file_size,
+                                                       part_size_kb=4))
+            self.assertEqual(["download.bin.part", "download.bin.part.bitmap"], sorted(os.listdir(directory)))
+        mock_iter_download_chunk_tasks.assert_called_once_with(
+            mock_input_location, 4096, None, None, file_size, [4096]
+        )
+
+    @patch("telegram_upload.client.telegram_download_client.TelegramDownloadClient._write_download_chunks_at_offsets")
+    @patch("telegram_upload.client.telegram_download_client.TelegramDownloadClient._iter_download_chunk_tasks")
+    def test_download_file_bigger_partial_file(self, mock_iter_download_chunk_tasks: MagicMock,
+                                               mock_write_download_chunks_at_offsets: MagicMock):
+        file_size = 8192
+        mock_input_location = MagicMock(id=1)
+        mock_iter_download_chunk_tasks.side_effect = lambda *args: [MagicMock(), MagicMock()]
+        mock_write_download_chunks_at_offsets.side_effect = self.mark_download_chunks
+        with tempfile.TemporaryDirectory() as directory:
+            file_name = os.path.join(directory, "download.bin")
+            # Partial file of another download with the same name
+            with open(file_name + ".part", "wb") as file:
+                file.write(b"x" * file_size * 2)
+            asyncio.run(self.client._download_file(mock_input_location, file_name, file_size=file_size,
+                                                   part_size_kb=4))
+            self.assertEqual(file_size, os.path.getsize(file_name))
+            with open(file_name, "rb") as file:
+                self.assertEqual(bytes(file_size), file.read())
+
+    @patch("telegram_upload.client.telegram_download_client.TelegramDownloadClient._iter_download_chunk_tasks")
+    def test_download_joined_file(self, mock_iter_download_chunk_tasks: MagicMock):
+        async def chunk(data: bytes):
+            return data
+
+        parts = {1: b"foobar", 2: b"baz"}
+        mock_iter_download_chunk_tasks.side_effect = lambda input_location, *args: [
+            asyncio.ensure_future(chunk(parts[input_location.id]))
+        ]
+        download_files = [
+            DownloadFile(MagicMock(**{"document.id": document_id, "document.size": len(data),
+                                      "document.file_reference": b"", "document.access_hash": 0,
+                                      "document.attributes": [DocumentAttributeFilename(f"file.0{i}")]}))
+            for i, (document_id, data) in enumerate(parts.items())
+        ]
+        mock_progress_callback = Mock()
+        with tempfile.TemporaryDirectory() as directory:
+            file_name = os.path.join(directory, "file")
+            with open(file_name + ".part", "wb") as file:
+                file.write(b"x" * 20)
+            joined_file = JoinedDownloadFile(file_name, download_files)
+            self.assertEqual(file_name, asyncio.run(self.client._download_joined_file(
+                joined_file, mock_progress_callback
+            )))
+            self.assertEqual(["file"], os.listdir(directory))
+            with open(file_name, "rb") as file:
+                self.assertEqual(b"foobarbaz", file.read())
+        mock_progress_callback.assert_called_with(9, 9)
+
+    @patch("telegram_upload.client.telegram_download_client.DOWNLOAD_JOIN_IN_PLACE", 0)
+    def test_download_files_join_parts(self):
+        async def download_media(message, file, progress_callback=None):
+            data = parts[message.document.attributes[0].file_name]
+            with open(file, "wb") as f:
+                f.write(data)
+            progress_callback(len(data), len(data))
+            return file
+
+        parts = {"file.00": b"foo" * 4096, "file.01": b"bar"}
+        messages = [
+            MagicMock(**{"document.id": i, "document.size": len(data),
+                         "document.attributes": [DocumentAttributeFilename(file_name)]})
+            for i, (file_name, data) in enumerate(parts.items())
+        ]
+        self.client.download_media = download_media
+        cwd = os.getcwd()
+        with tempfile.TemporaryDirectory() as directory:
+            os.chdir(directory)
+            try:
+                with self.assertLogs("telegram_upload.download_files", "INFO") as logs:
+                    self.client.download_files("foo", JoinDownloadSplitFiles(messages))
+                self.assertEqual(["file"], os.listdir(directory))
+                with open("file", "rb") as file:
+                    self.assertEqual(b"foo" * 4096 + b"bar", file.read())
+            finally:
+                os.chdir(cwd)
+        self.assertIn('Joined "file" (12.0KiB)', logs.output[0])
+
+    def test_download_files_joined(self):
+        mock_joined_file = MagicMock(spec=JoinedDownloadFile, size=0, file_name="file", messages=["message"],
+                                     download_files=[])
+        self.client._download_joined_file = MagicMock()
+        self.client.delete_messages = MagicMock()
+        with patch("telegram_upload.client.telegram_download_client.async_to_sync") as mock_async_to_sync:
+            self.client.download_files("foo", [mock_joined_file], delete_on_success=True)
+        mock_joined_file.set_download_file_name.assert_called_once_with(mock_async_to_sync.return_value)
+        self.client.delete_messages.assert_called_once_with("foo", ["message"])
+
+    def test_download_files_delete_on_success(self):
+        download_files = [MagicMock(size=0) for _ in range(3)]
+        self.client.download_media = MagicMock()
+        self.client.delete_messages = MagicMock()
+        with patch("telegram_upload.client.telegram_download_client.DELETE_MESSAGES_BATCH", 2):
+            self.client.download_files("foo", download_files, delete_on_success=True)
+        self.client.delete_messages.assert_has_calls([
+            call("foo", [download_files[0].message, download_files[1].message]),
+            call("foo", [download_files[2].message]),
+        ])
+
+    @patch("telegram_upload.client.telegram_download_client.PARALLEL_DOWNLOAD_FILES", 3)
+    def test_download_files_concurrently(self):
+        async def download_media(message, file, progress_callback=None):
+            if message == download_files[0].message:
+                # The first file is the slowest one
+                await asyncio.sleep(0.01)
+            running.append(message)
+            return file
+
+        running = []
+        download_files = [MagicMock(size=10, file_name=f"file{i}.bin") for i in range(3)]
+        self.client.download_media = download_media
+        self.client.delete_messages = MagicMock(side_effect=lambda *args: asyncio.sleep(0))
+        self.client.download_files("foo", download_files, delete_on_success=True)
+        self.assertEqual(download_files[0].message, running[-1])
+        for i, download_file in enumerate(download_files):
+            download_file.set_download_file_name.assert_called_once_with(f"file{i}.bin")
+        self.client.delete_messages.assert_called_once()
+        self.assertEqual({f.message for f in download_files}, set(self.client.delete_messages.call_args[0][1]))
+
+    @patch("telegram_upload.client.telegram_download_client.PARALLEL_DOWNLOAD_FILES", 3)
+    def test_download_files_concurrently_same_name(self):
+        async def download_media(message, file, progress_callback=None):
+            downloading.append(file)
+            await asyncio.sleep(0.01)
+            return file
+
+        downloading = []
+        download_files = [MagicMock(size=10, file_name="file.bin") for _ in range(3)]
+        self.client.download_media = download_media
+        with tempfile.TemporaryDirectory() as directory:
+            open(os.path.join(directory, "file.bin"), "w").close()
+            cwd = os.getcwd()
+            os.chdir(directory)
+            try:
+                self.client.download_files("foo", download_files)
+            finally:
+                os.chdir(cwd)
+        # The existing file and the downloads in progress are not overwritten
+        self.assertEqual(["file (1).bin", "file (2).bin", "file (3).bin"], sorted(downloading))
+        self.assertEqual(set(), self.client.downloading_file_names)
+
+    @patch("telegram_upload.client.telegram_download_client.PARALLEL_DOWNLOAD_FILES", 3)
+    def test_download_files_concurrently_error(self):
+        download_files = [MagicMock(size=10) for _ in range(2)]
+        self.client.download_media = MagicMock(side_effect=[asyncio.sleep(0, "file0"), ConnectionError])
+        self.client.delete_messages = MagicMock(side_effect=lambda *args: asyncio.sleep(0))
+        with self.assertRaises(ConnectionError):
+            self.client.download_files("foo", download_files, delete_on_success=True)
+        self.client.delete_messages.assert_called_once_with("foo", [download_files[0].message])
 
     @patch("telegram_upload.client.telegram_download_client.TelegramDownloadClient.loop")
-    @patch("telegram_upload.client.telegram_download_client.TelegramDownloadClient._iter_download")
-    def test_iter_download_chunk_tasks(self, mock_iter_download: MagicMock, mock_loop: MagicMock):
+    @patch("telegram_upload.client.telegram_download_client.TelegramDownloadClient._download_chunk")
+    def test_iter_download_chunk_tasks(self, mock_download_chunk: MagicMock, mock_loop: MagicMock):
         mock_input_location = MagicMock()
         part_size = 1024
         dc_id = 1
@@ -78,7 +350,88 @@ class TestTelegramDownloadClient(unittest.TestCase):
             mock_input_location, part_size, dc_id, msg_data, file_size
         ))
         self.assertEqual([mock_loop.create_task.return_value] * 2, tasks)
-        mock_iter_download.assert_has_calls([
-            call(mock_input_location, offset=0, request_size=part_size, dc_id=dc_id, msg_data=msg_data),
-            call(mock_input_location, offset=1024, request_size=part_size, dc_id=dc_id, msg_data=msg_data),
+        mock_download_chunk.assert_has_calls([
+            call(mock_input_location, 0, part_size, dc_id, msg_data),
+            call(mock_input_location, 1024, part_size, dc_id, msg_data),
         ], any_order=True)
+
+    def test_download_chunk_session_dc(self):
+        self.client.session = Mock(dc_id=2)
+        mock_call = AsyncMock(return_value=MagicMock(bytes=b"foo"))
+        with patch.object(TelegramDownloadClient, "__call__", mock_call):
+            self.assertEqual(b"foo", asyncio.run(self.client._download_chunk(MagicMock(id=1), 0, 1024, None, None)))
+        mock_call.assert_awaited_once()
+        self.assertEqual({}, self.client.download_sender_pools)
+
+    @patch("telegram_upload.client.telegram_download_client.SenderPool")
+    def test_download_chunk_other_dc(self, mock_sender_pool_cls: MagicMock):
+        self.client.session = Mock(dc_id=2)
+        mock_pool = mock_sender_pool_cls.return_value
+        mock_pool.connect = AsyncMock()
+        mock_pool.send = AsyncMock(return_value=MagicMock(bytes=b"foo"))
+        self.client.document_dc_ids[1] = 4
+
+        async def download_chunks():
+            return await asyncio.gather(*[
+                self.client._download_chunk(MagicMock(id=1), offset, 1024, None, None) for offset in (0, 1024)
+            ])
+
+        self.assertEqual([b"foo", b"foo"], asyncio.run(download_chunks()))
+        # The connections to the DC are created once and reused
+        mock_sender_pool_cls.assert_called_once_with(self.client, 4, 1)
+        mock_pool.connect.assert_awaited_once()
+        self.assertEqual(2, mock_pool.send.await_count)
+        self.assertEqual({4: mock_pool}, self.client.download_sender_pools)
+
+    @patch("telegram_upload.client.telegram_download_client.SenderPool")
+    def test_download_chunk_file_migrate(self, mock_sender_pool_cls: MagicMock):
+        self.client.session = Mock(dc_id=2)
+        mock_sender_pool_cls.return_value.connect = AsyncMock()
+        mock_sender_pool_cls.return_value.send = AsyncMock(return_value=MagicMock(bytes=b"foo"))
+        mock_call = AsyncMock(side_effect=FileMigrateError(None, 4))
+        with patch.object(TelegramDownloadClient, "__call__", mock_call):
+            self.assertEqual(b"foo", asyncio.run(self.client._download_chunk(MagicMock(id=1), 0, 1024, None, None)))
+        self.assertEqual({1: 4}, self.client.document_dc_ids)
+        mock_sender_pool_cls.assert_called_once_with(self.client, 4, 1)
+
+    @patch("telegram_upload.client.telegram_download_client.asyncio.sleep", new_callable=AsyncMock)
+    def test_download_chunk_timed_out(self, mock_sleep: AsyncMock):
+        self.client.session = Mock(dc_id=2)
+        self.client._log = MagicMock()
+        mock_call = AsyncMock(side_effect=[TimedOutError(None, "Timeout"), MagicMock(bytes=b"foo")])
+        with patch.object(TelegramDownloadClient, "__call__", mock_call):
+            self.assertEqual(b"foo", asyncio.run(self.client._download_chunk(MagicMock(id=1), 0, 1024, None, None)))
+        self.assertEqual(2, mock_call.await_count)
+        mock_sleep.assert_awaited_once()
+
+    @patch("telegram_upload.client.telegram_download_client.asyncio.sleep", new_callable=AsyncMock)
+    def test_download_chunk_timed_out_twice(self, mock_sleep: AsyncMock):
+        self.client.session = Mock(dc_id=2)
+        self.client._log = MagicMock()
+        mock_call = AsyncMock(side_effect=TimedOutError(None, "Timeout"))
+        with patch.object(TelegramDownloadClient, "__call__", mock_call), self.assertRaises(TimedOutError):
+            asyncio.run(self.client._download_chunk(MagicMock(id=1), 0, 1024, None, None))
+        self.assertEqual(2, mock_call.await_count)
+
+    def test_download_chunk_cdn_redirect(self):
+        self.client.session = Mock(dc_id=2)
+        result = FileCdnRedirect(dc_id=203, file_token=b"", encryption_key=b"", encryption_iv=b"", file_hashes=[])
+        with patch.object(TelegramDownloadClient, "__call__", AsyncMock(return_value=result)), \
+                self.assertRaises(TelegramUploadError):
+            asyncio.run(self.client._download_chunk(MagicMock(id=1), 0, 1024, None, None))
+
+    def test_add_document_dc_ids(self):
+        document = Document(id=1, access_hash=0, file_reference=b"", date=None, mime_type="", size=1, dc_id=4,
+                            attributes=[])
+        self.client._add_document_dc_ids(DownloadFile(MagicMock(document=document)))
+        self.assertEqual({1: 4}, self.client.document_dc_ids)
+
+    def test_disconnect(self):
+        mock_pool = MagicMock(disconnect=AsyncMock())
+        self.client.download_sender_pools = {4: mock_pool}
+        with patch("telegram_upload.client.telegram_download_client.TelegramClient._disconnect_coro",
+                   AsyncMock()) as mock_disconnect_coro:
+            asyncio.run(self.client._disconnect_coro())
+        mock_pool.disconnect.assert_awaited_once()
+        mock_disconnect_coro.assert_awaited_once()
+        self.assertEqual({}, self.client.download_sender_pools)
@@ -1,3 +1,6 @@
+import asyncio
+import hashlib
+import io
 import json
 import os
 import sys
@@ -37,18 +40,44 @@ class TestTelegramUploadClient(IsolatedAsyncioTestCase):
     def setUp(self, m1) -> None:
         self.upload_file_path = os.path.abspath(os.path.join(directory, 'logo.png'))
         self.client = TelegramUploadClient(Mock(), Mock(), Mock())
+        self.client.session = Mock(dc_id=2)
+        self.client._log = MagicMock()
         self.client.send_file = Mock()
         self.client.send_file.return_value.media.document.size = os.path.getsize(self.upload_file_path)
 
-    @patch("telegram_upload.client.telegram_upload_client.TelegramUploadClient.forward_messages")
-    def test_forward_to(self, mock_forward_messages: MagicMock):
+    @patch("telegram_upload.client.telegram_upload_client.TelegramUploadClient.forward_messages",
+           new_callable=AsyncMock)
+    def test_forward_to(self, mock_forward_messages: AsyncMock):
         mock_message = MagicMock()
         mock_destinations = [MagicMock(), MagicMock()]
-        self.client.forward_to(mock_message, mock_destinations)
-        mock_forward_messages.assert_has_calls([
+        results = self.client.forward_to(mock_message, mock_destinations)
+        mock_forward_messages.assert_has_awaits([
             call(mock_destinations[0], [mock_message]),
             call(mock_destinations[1], [mock_message]),
-        ])
+        ], any_order=True)
+        self.assertEqual({destination: mock_forward_messages.return_value for destination in mock_destinations},
+                         results)
+
+    @patch("telegram_upload.client.telegram_upload_client.TelegramUploadClient.forward_messages",
+           new_callable=AsyncMock)
+    def test_forward_to_errors(self, mock_forward_messages: AsyncMock):
+        messages = [MagicMock(), MagicMock()]
+        error = RPCError(None, "CHAT_WRITE_FORBIDDEN")
+        mock_forward_messages.side_effect = lambda destination, messages: {"error": error}.get(destination, messages)
+        results = self.client.forward_to(messages, ["error", "channel"])
+        self.assertEqual({"error": error, "channel": messages}, results)
+        mock_forward_messages.assert_any_await("channel", messages)
+        self.client._log[__name__].warning.assert_called_once()
+
+    @patch("telegram_upload.client.telegram_upload_client.TelegramUploadClient.forward_messages",
+           new_callable=AsyncMock)
+    def test_forward_to_flood_wait(self, mock_forward_messages: AsyncMock):
+        mock_message = MagicMock()
+        mock_forward_messages.side_effect = [FloodWaitError(None, 0), [mock_message]]
+        with patch.object(self.client.flood_wait_gate, 'close') as mock_close:
+            results = self.client.forward_to(mock_message, ["channel"])
+        mock_close.assert_called_once_with(2, 0)
+        self.assertEqual({"channel": [mock_message]}, results)
 
     async def test_send_album_media(self):
         self.client.get_input_entity = AsyncMock()
@@ -64,17 +93,70 @@ class TestTelegramUploadClient(IsolatedAsyncioTestCase):
             self.client.get_input_entity.return_value,
         )
 
-    @patch('telegram_upload.client.telegram_upload_client.TelegramUploadClient.send_files')
-    @patch('telegram_upload.client.telegram_upload_client.TelegramUploadClient._send_album_media')
-    @unittest.skipIf(sys.version_info < (3, 8), "TypeError: An asyncio.Future, a coroutine or an awaitable is required")
-    def test_send_files_as_album(self, mock_send_album_media: MagicMock, mock_send_files: MagicMock):
+    @patch('telegram_upload.client.telegram_upload_client.TelegramUploadClient._send_albums')
+    def test_send_files_as_album(self, mock_send_albums: MagicMock):
         entity = "entity"
         mock_files = [MagicMock(), MagicMock()]
-        self.client.send_files_as_album(entity, mock_files)
-        mock_send_files.assert_called_once_with(
-            entity, tuple(mock_files), False, False, (), send_as_media=True
-        )
-        mock_send_album_media.assert_called_once_with(entity, mock_send_files.return_value)
+        with patch('telegram_upload.client.telegram_upload_client.async_to_sync') as mock_async_to_sync:
+            messages = self.client.send_files_as_album(entity, False, False, mock_files, forward=["forward"])
+        self.assertEqual(mock_async_to_sync.return_value, messages)
+        files = mock_send_albums.call_args[0][1]
+        mock_send_albums.assert_called_once_with(entity, files, False, ["forward"])
+        self.assertEqual(mock_files, list(files))
+
+    async def test_send_albums(self):
+        files = [MagicMock(name=f"file{i}") for i in range(12)]
+        self.client._send_media = AsyncMock(side_effect=lambda entity, file, progress: f"media-{files.index(file)}")
+        self.client._send_album_media = AsyncMock(side_effect=lambda entity, media: [MagicMock() for _ in media])
+        self.client.forward_messages = AsyncMock()
+        messages = await self.client._send_albums("entity", files, forward=["forward"])
+        self.assertEqual(12, len(messages))
+        self.client._send_album_media.assert_has_awaits([
+            call("entity", [f"media-{i}" for i in range(10)]),
+            call("entity", ["media-10", "media-11"]),
+        ])
+        self.client.forward_messages.assert_has_awaits([
+            call("forward", messages[:10]), call("forward", messages[10:]),
+        ])
+        for file in files:
+            file.remove_upload_journal.assert_called_once_with()
+
+    async def test_send_albums_upload_error(self):
+        files = [MagicMock(), MagicMock()]
+        self.client._send_media = AsyncMock(side_effect=[RuntimeError, "media"])
+        self.client._send_album_media = AsyncMock(return_value=[MagicMock()])
+        messages = await self.client._send_albums("entity", files)
+        self.assertEqual(self.client._send_album_media.return_value, messages)
+        self.client._send_album_media.assert_awaited_once_with("entity", ["media"])
+        files[0].remove_upload_journal.assert_not_called()
+        files[1].remove_upload_journal.assert_called_once_with()
+        self.client._log[__name__].warning.assert_called_once()
+
+    async def test_send_albums_unexpected_error(self):
+        async def send_media(entity, file, progress):
+            if file is files[0]:
+                await asyncio.sleep(0)
+                raise OSError
+            try:
+                await asyncio.Event().wait()
+            except asyncio.CancelledError:
+                cancelled.append(file)
+                raise
+
+        cancelled = []
+        files = [MagicMock(), MagicMock()]
+        self.client._send_media = send_media
+        with self.assertRaises(OSError):
+            await self.client._send_albums("entity", files)
+        self.assertEqual([files[1]], cancelled)
+        self.assertEqual({asyncio.current_task()}, asyncio.all_tasks())
+
+    async def test_upload_album_media_flood_wait(self):
+        file = MagicMock()
+        self.client._send_media = AsyncMock(side_effect=[FloodWaitError(None, 0), "media"])
+        with patch.object(self.client.flood_wait_gate, 'close') as mock_close:
+            self.assertEqual("media", await self.client._upload_album_media("entity", file))
+        mock_close.assert_called_once_with(2, 0)
 
     @patch('telegram_upload.management.default_config')
     def test_missing_file(self, m1):
@@ -91,7 +173,8 @@ class TestTelegramUploadClient(IsolatedAsyncioTestCase):
                 progress_callback=AnyArg(), attributes=[]
             )
         original_send_file_message = self.client._send_file_message
-        with self.subTest("Test send one file with one flood retry"), patch('time.sleep') as mock_sleep:
+        with self.subTest("Test send one file with one flood retry"), \
+                patch.object(self.client.flood_wait_gate, 'close') as mock_close:
             wait = 1
 
             self.client._send_file_message = MagicMock()
@@ -100,7 +183,7 @@ class TestTelegramUploadClient(IsolatedAsyncioTestCase):
             file = File(MagicMock(), self.upload_file_path)
             self.client.send_one_file(entity, file, False, None)
             self.client._send_file_message.assert_has_calls([call(entity, file, None, AnyArg())] * 2)
-            mock_sleep.assert_called_once_with(wait)
+            mock_close.assert_called_once_with(2, wait)
         with self.subTest("Test send one file with rpcError"):
             self.client._send_file_message = MagicMock()
             self.client._send_file_message.side_effect = [RPCError(None, "")] * 4
@@ -142,6 +225,62 @@ class TestTelegramUploadClient(IsolatedAsyncioTestCase):
             )
             mock_remove.assert_called_once_with(self.upload_file_path)
 
+    @patch('telegram_upload.client.telegram_upload_client.PREPARE_FILES_AHEAD', 2)
+    def test_iter_prepared_files(self):
+        files = [MagicMock(is_custom_thumbnail=False, **{"prepare.return_value": f"thumb{i}.jpg"}) for i in range(4)]
+        prepared = self.client._iter_prepared_files(files)
+        self.assertEqual((files[0], "thumb0.jpg"), next(prepared))
+        # The next files are prepared while the first file is uploaded
+        for file in files[:3]:
+            file.prepare.assert_called_once_with()
+        files[3].prepare.assert_not_called()
+        with patch('telegram_upload.client.telegram_upload_client.os') as mock_os:
+            mock_os.path.lexists.return_value = True
+            prepared.close()
+        mock_os.remove.assert_has_calls([call("thumb1.jpg"), call("thumb2.jpg")])
+
+    def test_iter_not_uploaded_files(self):
+        files = [MagicMock(path=f"file{i}", file_name=f"file{i}") for i in range(3)]
+        with self.subTest("Test without upload index"):
+            self.assertEqual(files, list(self.client._iter_not_uploaded_files("me", files)))
+        with self.subTest("Test with upload index"):
+            self.client.upload_index = Mock(**{"is_uploaded.side_effect": [False, True, False]})
+            self.assertEqual([files[0], files[2]], list(self.client._iter_not_uploaded_files("me", files)))
+            self.client.upload_index.is_uploaded.assert_any_call("file1", "file1", "me", files[1].stat)
+
+    def test_add_to_upload_index(self):
+        file = MagicMock(path="file", file_name="file")
+        self.client.upload_index = Mock()
+        self.client._add_to_upload_index("me", file, Mock(id=10))
+        self.client.upload_index.add.assert_called_once_with("file", "file", "me", file.stat, 10)
+
+    def test_send_uploaded_document(self):
+        file = MagicMock(content_hash="hash", file_size=100, file_caption="caption", force_file=False)
+        with self.subTest("Test without document index"):
+            self.assertIsNone(self.client._send_uploaded_document("me", file))
+        self.client.document_index = Mock()
+        with self.subTest("Test uploaded document"):
+            message = self.client._send_uploaded_document("me", file)
+            self.assertEqual(self.client.send_file.return_value, message)
+            self.client.send_file.assert_called_once_with(
+                "me", self.client.document_index.get_document.return_value, caption="caption", force_document=False
+            )
+        with self.subTest("Test expired document"):
+            self.client.send_file.side_effect = RPCError(None, "FILE_REFERENCE_EXPIRED")
+            self.assertIsNone(self.client._send_uploaded_document("me", file))
+            self.client.document_index.remove_document.assert_called_once_with("hash", 100)
+
+    def test_send_file_message_reused_document(self):
+        file = MagicMock(content_hash="hash", file_size=100)
+        self.client.document_index = Mock()
+        self.client._check_data_loss = Mock()
+        document = types.Document(1, 2, b"new_reference", None, "", 100, 2, [])
+        self.client.send_file.return_value = MagicMock(media=types.MessageMediaDocument(document=document))
+        self.client._send_file_message("me", False, True, file, None, None)
+        self.client.send_file.assert_called_once()
+        # The document is saved with the file reference of the new message
+        self.client.document_index.add_document.assert_called_once_with("hash", 100, document)
+
     def test_send_files_data_loss(self):
         mock_client = MagicMock(max_caption_length=200)
         file = File(mock_client, self.upload_file_path)
@@ -149,6 +288,128 @@ class TestTelegramUploadClient(IsolatedAsyncioTestCase):
         with self.assertRaises(TelegramUploadDataLoss):
             self.client.send_files('foo', [file])
 
+    @patch('telegram_upload.client.telegram_upload_client.PARALLEL_UPLOAD_FILES', 3)
+    async def test_send_files_concurrently(self):
+        uploaded = []
+        others_uploaded = asyncio.Event()
+
+        async def upload_file(file, file_size):
+            # The first file is the slowest one
+            if file is files[0]:
+                await others_uploaded.wait()
+            uploaded.append(file)
+            if len(uploaded) == 2:
+                others_uploaded.set()
+            return file.input_file
+
+        files = [MagicMock(file_size=10, input_file=f"input_file{i}", force_file=False, is_custom_thumbnail=False,
+                           **{"get_thumbnail.return_value": None}) for i in range(3)]
+        self.client.upload_file = upload_file
+        self.client.send_file = AsyncMock(side_effect=lambda entity, file, **kwargs: MagicMock(media=None, file=file))
+        self.client.forward_messages = AsyncMock()
+        messages = await self.client._send_files_concurrently("entity", False, files, forward=["forward"])
+        # The thumbnails are obtained in threads, so the other files can be uploaded in any order
+        self.assertEqual(files[0], uploaded[-1])
+        self.assertEqual(["input_file0", "input_file1", "input_file2"], [message.file for message in messages])
+        self.client.forward_messages.assert_awaited_once_with("forward", messages)
+        for file in files:
+            file.remove_upload_journal.assert_called_once_with()
+
+    @patch('telegram_upload.client.telegram_upload_client.PARALLEL_UPLOAD_FILES', 3)
+    async def test_send_files_concurrently_upload_error(self):
+        files = [MagicMock(file_size=10, is_custom_thumbnail=False, **{"get_thumbnail.return_value": None})
+                 for _ in range(2)]
+        self.client.upload_file = AsyncMock(side_effect=[RuntimeError, "input_file"])
+        self.client.send_file = AsyncMock(return_value=MagicMock(media=None))
+        messages = await self.client._send_files_concurrently("entity", False, files)
+        self.assertEqual([self.client.send_file.return_value], messages)
+        self.client.send_file.assert_awaited_once()
+        self.client._log[__name__].warning.assert_called_once()
+
+    @patch('telegram_upload.client.telegram_upload_client.PARALLEL_UPLOAD_FILES', 3)
+    async def test_send_files_concurrently_reuse_uploaded(self):
+        files = [MagicMock(file_size=10, content_hash=f"hash{i}", is_custom_thumbnail=False,
+                           **{"get_thumbnail.return_value": None}) for i in range(3)]
+        documents = {"hash0": types.InputDocument(1, 2, b"expired"), "hash1": types.InputDocument(3, 4, b"")}
+        self.client.document_index = Mock(**{"get_document.side_effect": lambda content_hash, size:
+                                             documents.get(content_hash)})
+        self.client.upload_file = AsyncMock(return_value="input_file")
+
+        async def send_file(entity, file, **kwargs):
+            if file == documents["hash0"]:
+                raise RPCError(None, "FILE_REFERENCE_EXPIRED")
+            return MagicMock(media=None, file=file)
+
+        self.client.send_file = send_file
+        messages = await self.client._send_files_concurrently("entity", False, files)
+        self.assertEqual(["input_file", documents["hash1"], "input_file"], [message.file for message in messages])
+        # The expired document is uploaded again
+        self.client.document_index.remove_document.assert_called_once_with("hash0", 10)
+        self.assertCountEqual([call(files[0], file_size=10), call(files[2], file_size=10)],
+                              self.client.upload_file.await_args_list)
+
+    @patch('telegram_upload.client.telegram_upload_client.PARALLEL_UPLOAD_FILES', 3)
+    @patch('telegram_upload.client.telegram_upload_client.TelegramUploadClient._remove_thumbnail')
+    async def test_send_files_concurrently_unexpected_error(self, mock_remove_thumbnail: MagicMock):
+        cancelled = []
+
+        async def upload_file(file, file_size):
+            if file is files[0]:
+                await asyncio.sleep(0.01)
+                raise OSError
+            if file is files[1]:
+                try:
+                    await asyncio.Event().wait()
+                except asyncio.CancelledError:
+                    cancelled.append(file)
+                    raise
+            return "input_file"
+
+        files = [MagicMock(file_size=10, is_custom_thumbnail=False, **{"get_thumbnail.return_value": f"thumb{i}"})
+                 for i in range(3)]
+        self.client.upload_file = upload_file
+        with self.assertRaises(OSError):
+            await self.client._send_files_concurrently("entity", False, files)
+        self.assertEqual([files[1]], cancelled)
+        # The thumbnails of the failed, cancelled and uploaded but not sent files are removed
+        self.assertEqual({(file, f"thumb{i}") for i, file in enumerate(files)},
+                         {c.args for c in mock_remove_thumbnail.call_args_list})
+        self.assertEqual({asyncio.current_task()}, asyncio.all_tasks())
+
+    @patch('telegram_upload.client.telegram_upload_client.UPLOAD_CONNECTIONS', 2)
+    @patch('telegram_upload.client.telegram_upload_client.SenderPool')
+    async def test_connect_upload_sender_pool_concurrently(self, mock_sender_pool: MagicMock):
+        async def connect():
+            await asyncio.sleep(0)
+            return mock_sender_pool.return_value
+
+        mock_sender_pool.return_value.connect.side_effect = connect
+        await asyncio.gather(*[self.client._connect_upload_sender_pool() for _ in range(3)])
+        mock_sender_pool.assert_called_once()
+        self.assertEqual(mock_sender_pool.return_value, self.client.upload_sender_pool)
+
+    async def test_upload_file_error_closes_journal(self):
+        mock_journal = MagicMock(file_id=1, parts=set())
+        self.client._open_upload_journal = MagicMock(return_value=mock_journal)
+        self.client._connect_upload_sender_pool = AsyncMock(side_effect=ConnectionError)
+        with self.assertRaises(ConnectionError):
+            await self.client.upload_file(bytes(11 * 1024 * 1024), file_name="file.bin")
+        mock_journal.close.assert_called_once_with()
+
+    @patch('telegram_upload.client.telegram_upload_client.UPLOAD_PREFETCH_PARTS', 2)
+    async def test_iter_upload_parts(self):
+        stream = io.BytesIO(b'0123456789')
+        hash_md5 = hashlib.md5()
+        parts = [part async for part in self.client._iter_upload_parts(stream, True, 4, 3, 10, {1},
+                                                                        hash_md5=hash_md5)]
+        self.assertEqual([(0, 4, b'0123'), (2, 10, b'89')], parts)
+        self.assertEqual(hashlib.md5(b'012389').digest(), hash_md5.digest())
+
+    async def test_iter_upload_parts_error(self):
+        stream = io.BytesIO(b'0123')
+        with self.assertRaises(ValueError):
+            [part async for part in self.client._iter_upload_parts(stream, False, 4, 3, 10, set())]
+
     @patch('telegram_upload.client.telegram_upload_client.utils')
     @unittest.skipIf(sys.version_info < (3, 8), "TypeError: Cannot cast AsyncMock to any kind of InputMedia.")
     async def test_send_media(self, mock_utils: MagicMock):
@@ -1,4 +1,6 @@
+import os
 import sys
+import tempfile
 import unittest
 from io import BytesIO
 from unittest.mock import patch, MagicMock, call
@@ -6,7 +8,7 @@ from unittest.mock import patch, MagicMock, call
 from telethon.tl.types import DocumentAttributeFilename
 
 from telegram_upload.download_files import pipe_file, CHUNK_FILE_SIZE, JoinStrategyBase, UnionJoinStrategy, \
-    get_join_strategy, DownloadFile, KeepDownloadSplitFiles, JoinDownloadSplitFiles
+    get_join_strategy, DownloadFile, KeepDownloadSplitFiles, JoinDownloadSplitFiles, JoinedDownloadFile, copy_file
 
 
 class TestPipeFile(unittest.TestCase):
@@ -15,13 +17,51 @@ class TestPipeFile(unittest.TestCase):
         mock_open.return_value.__enter__.return_value.read.side_effect = [b"foo", b"bar", b""]
         read_file_name = "read_file_name"
         write_file = BytesIO()
-        pipe_file(read_file_name, write_file)
+        self.assertEqual("read", pipe_file(read_file_name, write_file))
         write_file.seek(0)
         self.assertEqual(b"foobar", write_file.read())
         mock_open.assert_called_once_with(read_file_name, "rb")
         mock_open.return_value.__enter__.return_value.read.assert_has_calls([call(CHUNK_FILE_SIZE)] * 3)
 
 
+    def test_pipe_files(self):
+        with tempfile.TemporaryDirectory() as directory:
+            file_names = [os.path.join(directory, f"file.0{i}") for i in range(2)]
+            for file_name, data in zip(file_names, [b"foo" * 4096, b"bar"]):
+                with open(file_name, "wb") as file:
+                    file.write(data)
+            with open(os.path.join(directory, "file"), "wb") as write_file:
+                for file_name in file_names:
+                    pipe_file(file_name, write_file)
+            with open(os.path.join(directory, "file"), "rb") as file:
+                self.assertEqual(b"foo" * 4096 + b"bar", file.read())
+
+
+class TestCopyFile(unittest.TestCase):
+    def test_copy(self):
+        with tempfile.TemporaryFile() as read_file, tempfile.TemporaryFile() as write_file:
+            read_file.write(b"foobar")
+            read_file.seek(3)
+            write_file.write(b"baz")
+            self.assertIn(copy_file(read_file, write_file), ["reflink", "copy_file_range", "sendfile"])
+            write_file.seek(0)
+            self.assertEqual(b"bazbar", write_file.read())
+
+    def test_in_memory(self):
+        with tempfile.TemporaryFile() as read_file:
+            self.assertIsNone(copy_file(read_file, BytesIO()))
+
+    @patch('telegram_upload.download_files.COPY_FUNCTIONS')
+    def test_fallback(self, mock_copy_functions: MagicMock):
+        mock_reflink = MagicMock(side_effect=OSError)
+        mock_copy_file_range = MagicMock()
+        mock_copy_functions.__iter__.return_value = [("reflink", mock_reflink), ("sendfile", None),
+                                                     ("copy_file_range", mock_copy_file_range)]
+        with tempfile.TemporaryFile() as read_file, tempfile.TemporaryFile() as write_file:
+            self.assertEqual("copy_file_range", copy_file(read_file, write_file))
+            mock_copy_file_range.assert_called_once_with(read_file.fileno(), write_file.fileno())
+
+
 class TestJoinStrategyBase(unittest.TestCase):
     def test_add_download_file(self):
         strategy = JoinStrategyBase()
@@ -78,8 +118,12 @@ class TestUnionJoinStrategy(unittest.TestCase):
             MagicMock(file_name="file.00", downloaded_file_name="file.00", file_name_extension="00"),
         ]
         strategy.download_files = list(download_files)
-        with self.subTest("Test successful join"):
-            strategy.join_download_files()
+        mock_open.return_value.__enter__.return_value.tell.return_value = 1024
+        mock_pipe_file.return_value = "copy_file_range"
+        with self.subTest("Test successful join"), self.assertLogs('telegram_upload.download_files', 'INFO') as logs:
+            self.assertEqual("file", strategy.join_download_files())
+            self.assertIn('Joined "file" (1.0KiB)', logs.output[0])
+            self.assertIn('using copy_file_range', logs.output[0])
             mock_pipe_file.assert_has_calls([
                 call("file.00", mock_open.return_value.__enter__.return_value),
                 call("file.01", mock_open.return_value.__enter__.return_value),
@@ -90,10 +134,45 @@ class TestUnionJoinStrategy(unittest.TestCase):
         with self.subTest("Test join with missing files"):
             strategy.download_files = [download_files[0]]
             mock_open.reset_mock()
-            strategy.join_download_files()
+            self.assertIsNone(strategy.join_download_files())
             mock_open.assert_not_called()
 
 
+    def test_get_joined_download_file(self):
+        strategy = UnionJoinStrategy()
+        download_files = [
+            MagicMock(file_name="file.01", file_name_extension="01"),
+            MagicMock(file_name="file.00", file_name_extension="00"),
+        ]
+        with self.subTest("Test complete bundle"):
+            strategy.download_files = list(download_files)
+            joined_download_file = strategy.get_joined_download_file()
+            self.assertEqual("file", joined_download_file.file_name)
+            self.assertEqual(download_files[::-1], joined_download_file.download_files)
+            self.assertEqual(strategy, joined_download_file.join_strategy)
+        with self.subTest("Test bundle with missing files"):
+            strategy.download_files = [download_files[0]]
+            self.assertIsNone(strategy.get_joined_download_file())
+
+
+class TestJoinedDownloadFile(unittest.TestCase):
+    def test_parts(self):
+        download_files = [MagicMock(size=10), MagicMock(size=4)]
+        joined_download_file = JoinedDownloadFile("file", download_files)
+        self.assertEqual([(download_files[0], 0), (download_files[1], 10)], joined_download_file.parts)
+        self.assertEqual(14, joined_download_file.size)
+        self.assertEqual([download_file.message for download_file in download_files],
+                         joined_download_file.messages)
+
+    def test_join_download_files(self):
+        mock_strategy = MagicMock()
+        joined_download_file = JoinedDownloadFile("file", [MagicMock()], mock_strategy)
+        self.assertEqual(mock_strategy.join_download_files.return_value, joined_download_file.join_download_files())
+        mock_strategy.join_download_files.assert_called_once_with("file")
+        joined_download_file.join_download_files("file (1)")
+        mock_strategy.join_download_files.assert_called_with("file (1)")
+
+
 class TestGetJoinStrategy(unittest.TestCase):
     def test_get_join_strategy(self):
         mock_download_file = MagicMock()
@@ -171,6 +250,26 @@ class TestKeepDownloadSplitFiles(unittest.TestCase):
 
 
 class TestJoinDownloadSplitFiles(unittest.TestCase):
+    @staticmethod
+    def mock_join_strategy() -> MagicMock:
+        """Join strategy without a joined file. The parts are downloaded without joining them."""
+        mock_strategy = MagicMock(download_files=[])
+        mock_strategy.get_joined_download_file.return_value = None
+        mock_strategy.add_download_file.side_effect = mock_strategy.download_files.append
+        return mock_strategy
+
+    @staticmethod
+    def get_join_strategy_side_effect(strategies: list):
+        """Return the strategies in order, adding the first file like get_join_strategy."""
+        strategies = iter(strategies)
+
+        def get_join_strategy(download_file):
+            strategy = next(strategies)
+            if strategy:
+                strategy.download_files.append(download_file)
+            return strategy
+        return get_join_strategy
+
     @patch("telegram_upload.download_files.get_join_strategy")
     def test_get_iterator_without_strategy(self, mock_get_join_strategy: MagicMock):
         """Test a download file without a valid strategy. The file is outside the supported
@@ -187,14 +286,14 @@ class TestJoinDownloadSplitFiles(unittest.TestCase):
     def test_get_iterator_with_strategy(self, mock_get_join_strategy: MagicMock):
         """Test two related download files with a valid strategy. The files are unzipped."""
         mock_messages = [MagicMock(), MagicMock()]
-        mock_strategy = MagicMock()
-        mock_get_join_strategy.return_value = mock_strategy
+        mock_strategy = self.mock_join_strategy()
+        mock_get_join_strategy.side_effect = self.get_join_strategy_side_effect([mock_strategy])
         join_download_split_files = JoinDownloadSplitFiles(mock_messages)
         download_files = list(join_download_split_files)
         self.assertIsInstance(download_files[0], DownloadFile)
         self.assertEqual(mock_messages[0], download_files[0].message)
         mock_strategy.add_download_file.assert_called_once_with(download_files[1])
-        mock_strategy.join_download_files.assert_called_once()
+        mock_strategy.join_download_files.assert_not_called()
 
     @patch("telegram_upload.download_files.get_join_strategy")
     def test_get_iterator_with_strategy_and_other_file(self, mock_get_join_strategy: MagicMock):
@@ -202,12 +301,24 @@ class TestJoinDownloadSplitFiles(unittest.TestCase):
         Unzip the latest download file after detect an unsupported file.
         """
         mock_messages = [MagicMock(), MagicMock(), MagicMock()]
-        mock_strategy = MagicMock()
+        mock_strategy = self.mock_join_strategy()
         mock_strategy.is_part.side_effect = [True, False, False]
-        mock_get_join_strategy.side_effect = [mock_strategy, False]
+        mock_get_join_strategy.side_effect = self.get_join_strategy_side_effect([mock_strategy, False])
         join_download_split_files = JoinDownloadSplitFiles(mock_messages)
         download_files = list(join_download_split_files)
         self.assertIsInstance(download_files[0], DownloadFile)
         self.assertEqual(mock_messages[0], download_files[0].message)
         mock_strategy.add_download_file.assert_called_once_with(download_files[1])
-        mock_strategy.join_download_files.assert_called_once()
+        mock_strategy.join_download_files.assert_not_called()
+
+    @patch("telegram_upload.download_files.get_join_strategy")
+    def test_get_iterator_joined(self, mock_get_join_strategy: MagicMock):
+        """Test two related download files with a joined file. The joined file is returned instead
+        of the parts and the parts are not joined after the download.
+        """
+        mock_messages = [MagicMock(), MagicMock()]
+        mock_strategy = MagicMock()
+        mock_get_join_strategy.return_value = mock_strategy
+        download_files = list(JoinDownloadSplitFiles(mock_messages))
+        self.assertEqual([mock_strategy.get_joined_download_file.return_value], download_files)
+        mock_strategy.join_download_files.assert_not_called()
@@ -1,5 +1,7 @@
+import hashlib
 import os
 import unittest
+from io import FileIO
 from unittest.mock import patch, Mock, MagicMock
 
 from telegram_upload.client.telegram_manager_client import USER_MAX_FILE_SIZE
@@ -27,25 +29,25 @@ class TestGetFileAttributes(unittest.TestCase):
 
 
 class TestRecursiveFiles(unittest.TestCase):
-    @patch('telegram_upload.upload_files.scantree', return_value=[])
+    @patch('telegram_upload.upload_files.walk_files', return_value=[])
     @patch('telegram_upload.upload_files.os.path.isdir', return_value=False)
     def test_one_file(self, m1, m2):
         self.assertEqual(list(RecursiveFiles(MagicMock(), ['foo'])), ['foo'])
 
-    @patch('telegram_upload.upload_files.scantree')
+    @patch('telegram_upload.upload_files.walk_files')
     @patch('telegram_upload.upload_files.os.path.isdir', return_value=True)
     def test_directory(self, m1, m2):
-        directory = Mock()
-        directory.is_dir.side_effect = [True, False]
         file = Mock()
-        file.is_dir.return_value = False
-        side_effect = [file] * 3
-        m2.return_value = side_effect
-        self.assertEqual(list(RecursiveFiles(MagicMock(), ['foo'])), [x.path for x in side_effect])
+        file.stat.return_value.st_size = 10
+        empty_file = Mock()
+        empty_file.stat.return_value.st_size = 0
+        m2.return_value = [file, empty_file, file]
+        self.assertEqual(list(RecursiveFiles(MagicMock(), ['foo'])), [file, file])
+        m2.assert_called_once_with('foo', True)
 
 
 class TestNoDirectoriesFiles(unittest.TestCase):
-    @patch('telegram_upload.upload_files.scantree', return_value=[])
+    @patch('telegram_upload.upload_files.walk_files', return_value=[])
     @patch('telegram_upload.upload_files.os.path.isdir', return_value=False)
     def test_one_file(self, m1, m2):
         self.assertEqual(list(NoDirectoriesFiles(MagicMock(), ['foo'])), ['foo'])
@@ -83,6 +85,50 @@ class TestSplitFile(unittest.TestCase):
         file0.close()
         file1.close()
 
+    def test_content_hash(self):
+        this_file = os.path.abspath(__file__)
+        file = SplitFile(MagicMock(), this_file, 100, 'test.py.01')
+        file.seek(50, split_seek=True)
+        with open(this_file, 'rb') as f:
+            f.seek(50)
+            self.assertEqual(hashlib.sha256(f.read(100)).hexdigest(), file.content_hash)
+        file.close()
+
+    def test_readinto(self):
+        this_file = os.path.abspath(__file__)
+        file = SplitFile(MagicMock(), this_file, 100, 'test.py.00')
+        file.seek(10, split_seek=True)
+        buffer = bytearray(64)
+        self.assertEqual(file.readinto(buffer), 64)
+        self.assertEqual(file.readinto(buffer), 36)
+        self.assertEqual(file.readinto(buffer), 0)
+        with open(this_file, 'rb') as f:
+            f.seek(74)
+            self.assertEqual(bytes(buffer[:36]), f.read(36))
+        file.close()
+        self.assertTrue(file.source.closed)
+
+    def test_shared_source(self):
+        this_file = os.path.abspath(__file__)
+        source = FileIO(this_file)
+        file0 = SplitFile(MagicMock(), this_file, 100, 'test.py.00', source=source)
+        file1 = SplitFile(MagicMock(), this_file, 100, 'test.py.01', split_offset=100, source=source)
+        self.assertEqual(file0.fileno(), file1.fileno())
+        self.assertEqual(this_file, file1.name)
+        # The parts have their own positions
+        part1 = file1.read(60)
+        part0 = file0.read()
+        file1.seek(-40, os.SEEK_END)
+        part1 += file1.read()
+        self.assertEqual(100, file1.tell())
+        file0.close()
+        with open(this_file, 'rb') as f:
+            self.assertEqual(f.read(200), part0 + part1)
+        # The source is not closed by its parts
+        file1.close()
+        self.assertFalse(source.closed)
+        source.close()
+
 
 class TestSplitFiles(unittest.TestCase):
     @patch('telegram_upload.upload_files.os.path.getsize', return_value=USER_MAX_FILE_SIZE - 1)
@@ -92,10 +138,34 @@ class TestSplitFiles(unittest.TestCase):
 
     @patch('telegram_upload.upload_files.os.path.getsize', return_value=USER_MAX_FILE_SIZE + 1000)
     @patch('telegram_upload.upload_files.SplitFile.__init__', return_value=None)
-    @patch('telegram_upload.upload_files.SplitFile.seek')
-    def test_big_file(self, m_getsize, m_init, m_seek):
+    @patch('telegram_upload.upload_files.FileIO')
+    def test_big_file(self, m_file_io, m_init, m_getsize):
         mock_client = MagicMock(max_file_size=USER_MAX_FILE_SIZE)
         files = list(SplitFiles(mock_client, ['foo']))
         self.assertEqual(len(files), 2)
         self.assertEqual(m_init.call_args_list[0][0], (mock_client, 'foo', USER_MAX_FILE_SIZE, 'foo.00'))
         self.assertEqual(m_init.call_args_list[1][0], (mock_client, 'foo', 1000, 'foo.01'))
+        self.assertEqual(m_init.call_args_list[1][1], {'split_offset': USER_MAX_FILE_SIZE,
+                                                       'source': m_file_io.return_value})
+        m_file_io.assert_called_once_with('foo')
+
+    @patch('telegram_upload.upload_files.os.path.getsize', return_value=2500)
+    @patch('telegram_upload.upload_files.SplitFile.__init__', return_value=None)
+    @patch('telegram_upload.upload_files.FileIO')
+    def test_split_size(self, m_file_io, m_init, m_getsize):
+        mock_client = MagicMock(max_file_size=USER_MAX_FILE_SIZE)
+        files = list(SplitFiles(mock_client, ['foo'], split_size=1000))
+        self.assertEqual(len(files), 3)
+        self.assertEqual([1000, 1000, 500], [call[0][2] for call in m_init.call_args_list])
+        self.assertEqual([0, 1000, 2000], [call[1]['split_offset'] for call in m_init.call_args_list])
+
+    @patch('telegram_upload.upload_files.os.path.getsize', return_value=101)
+    @patch('telegram_upload.upload_files.SplitFile.__init__', return_value=None)
+    @patch('telegram_upload.upload_files.FileIO')
+    def test_many_parts(self, m_file_io, m_init, m_getsize):
+        mock_client = MagicMock(max_file_size=USER_MAX_FILE_SIZE)
+        files = list(SplitFiles(mock_client, ['foo'], split_size=1))
+        self.assertEqual(len(files), 101)
+        names = [call[0][3] for call in m_init.call_args_list]
+        self.assertEqual(['foo.000', 'foo.001', 'foo.100'], [names[0], names[1], names[-1]])
+        self.assertEqual(names, sorted(names))
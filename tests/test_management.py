@@ -41,6 +41,50 @@ class TestUpload(unittest.TestCase):
         mock_client.assert_called_once()
         mock_client.return_value.send_files.assert_called_once()
 
+    @patch('telegram_upload.management.UploadIndex')
+    @patch('telegram_upload.management.default_config')
+    @patch('telegram_upload.management.TelegramManagerClient')
+    def test_skip_uploaded(self, mock_client: MagicMock, _: MagicMock, mock_upload_index: MagicMock):
+        mock_client.return_value.max_caption_length = 200
+        mock_client.return_value.max_file_size = 1024 * 1024 * 1024
+        test_file = os.path.join(directory, 'test_management.py')
+        runner = CliRunner()
+        result = runner.invoke(upload, [test_file, '--skip-uploaded'])
+        self.assertEqual(result.exit_code, 0)
+        self.assertEqual(mock_upload_index.return_value, mock_client.return_value.upload_index)
+
+    @patch('telegram_upload.management.default_config')
+    @patch('telegram_upload.management.TelegramManagerClient')
+    def test_split_size(self, mock_client: MagicMock, _: MagicMock):
+        mock_client.return_value.max_caption_length = 200
+        mock_client.return_value.max_file_size = 1024 * 1024 * 1024
+        test_file = os.path.join(directory, 'test_management.py')
+        runner = CliRunner()
+        result = runner.invoke(upload, [test_file, '--large-files', 'split', '--split-size', '2'])
+        self.assertEqual(result.exit_code, 0)
+        files = mock_client.return_value.send_files.call_args[0][3]
+        self.assertEqual(2 * 1024 * 1024, files.split_size)
+
+    @patch('telegram_upload.management.default_config')
+    @patch('telegram_upload.management.TelegramManagerClient')
+    def test_reuse_uploaded_album(self, mock_client: MagicMock, _: MagicMock):
+        test_file = os.path.join(directory, 'test_management.py')
+        runner = CliRunner()
+        result = runner.invoke(upload, [test_file, '--reuse-uploaded', '--album'])
+        self.assertEqual(result.exit_code, 2)
+        self.assertIn('--reuse-uploaded', result.output)
+        mock_client.assert_not_called()
+
+    @patch('telegram_upload.management.default_config')
+    @patch('telegram_upload.management.TelegramManagerClient')
+    def test_split_size_without_split(self, mock_client: MagicMock, _: MagicMock):
+        test_file = os.path.join(directory, 'test_management.py')
+        runner = CliRunner()
+        result = runner.invoke(upload, [test_file, '--split-size', '2'])
+        self.assertEqual(result.exit_code, 2)
+        self.assertIn('--split-size', result.output)
+        mock_client.assert_not_called()
+
     @patch('telegram_upload.management.default_config')
     @patch('telegram_upload.management.TelegramManagerClient')
     def test_exclusive(self, m1, m2):
@@ -0,0 +1,114 @@
+import os
+import tempfile
+import unittest
+from unittest.mock import patch
+
+from telegram_upload.resume import DownloadBitmap, UploadJournal
+
+
+class TestDownloadBitmap(unittest.TestCase):
+    def setUp(self) -> None:
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "file.part.bitmap")
+
+    def tearDown(self) -> None:
+        self.directory.cleanup()
+
+    def test_new_bitmap(self):
+        with DownloadBitmap(self.path, 1, 10000, 1024) as bitmap:
+            self.assertEqual(10, bitmap.part_count)
+            self.assertEqual(list(range(0, 10000, 1024)), list(bitmap.missing_offsets()))
+            self.assertEqual(0, bitmap.completed_size)
+
+    def test_resume_bitmap(self):
+        with DownloadBitmap(self.path, 1, 10000, 1024) as bitmap:
+            bitmap.set(0)
+            bitmap.set(9)
+        with DownloadBitmap(self.path, 1, 10000, 1024) as bitmap:
+            self.assertTrue(bitmap.is_set(0))
+            self.assertTrue(bitmap.is_set(9))
+            self.assertEqual(list(range(1024, 9216, 1024)), list(bitmap.missing_offsets()))
+            self.assertEqual(1024 + 10000 - 9216, bitmap.completed_size)
+            self.assertTrue(bitmap.resumed)
+
+    def test_other_download(self):
+        with DownloadBitmap(self.path, 1, 10000, 1024) as bitmap:
+            bitmap.set(0)
+        self.assertFalse(DownloadBitmap(self.path, 2, 10000, 1024).is_resumable())
+        with DownloadBitmap(self.path, 2, 10000, 1024) as bitmap:
+            self.assertFalse(bitmap.is_set(0))
+            self.assertFalse(bitmap.resumed)
+        with DownloadBitmap(self.path, 2, 10000, 1024) as bitmap:
+            self.assertEqual(10, len(list(bitmap.missing_offsets())))
+
+    def test_remove(self):
+        bitmap = DownloadBitmap(self.path, 1, 10000, 1024).open()
+        bitmap.remove()
+        self.assertFalse(os.path.lexists(self.path))
+
+
+class TestUploadJournal(unittest.TestCase):
+    def setUp(self) -> None:
+        self.directory = tempfile.TemporaryDirectory()
+
+    def tearDown(self) -> None:
+        self.directory.cleanup()
+
+    def get_journal(self, mtime: int = 1) -> UploadJournal:
+        return UploadJournal("file.bin", 2048, mtime, 1024, "file.bin", directory=self.directory.name)
+
+    def test_new_journal(self):
+        journal = self.get_journal()
+        self.assertEqual(10, journal.open(10))
+        self.assertEqual(set(), journal.parts)
+        journal.close()
+
+    def test_resume_journal(self):
+        journal = self.get_journal()
+        journal.open(10)
+        journal.add(0)
+        journal.add(2)
+        journal.close()
+        journal = self.get_journal()
+        self.assertEqual(10, journal.open(20))
+        self.assertEqual({0, 2}, journal.parts)
+        journal.close()
+
+    def test_incomplete_line(self):
+        journal = self.get_journal()
+        journal.open(10)
+        journal.add(0)
+        journal.close()
+        with open(journal.path, "a") as file:
+            file.write("1")
+        journal = self.get_journal()
+        journal.open(20)
+        self.assertEqual({0}, journal.parts)
+        journal.close()
+
+    def test_modified_file(self):
+        journal = self.get_journal()
+        journal.open(10)
+        journal.add(0)
+        journal.close()
+        journal = self.get_journal(mtime=2)
+        self.assertEqual(20, journal.open(20))
+        self.assertEqual(set(), journal.parts)
+        journal.close()
+
+    def test_expired_journal(self):
+        journal = self.get_journal()
+        journal.open(10)
+        journal.add(0)
+        journal.close()
+        journal = self.get_journal()
+        with patch("telegram_upload.resume.UPLOAD_JOURNAL_MAX_AGE", -1):
+            self.assertEqual(20, journal.open(20))
+        self.assertEqual(set(), journal.parts)
+        journal.close()
+
+    def test_remove(self):
+        journal = self.get_journal()
+        journal.open(10)
+        journal.remove()
+        self.assertFalse(os.path.lexists(journal.path))
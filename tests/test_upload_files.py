@@ -28,3 +28,48 @@ class TestFile(unittest.TestCase):
             self.file._caption = "a" * (self.max_caption_length + 1)
             self.assertEqual(self.max_caption_length, len(self.file.file_caption))
             self.assertTrue(self.file.file_caption.endswith("..."))
+
+    @patch("telegram_upload.upload_files.get_media_cache", return_value=None)
+    @patch("telegram_upload.upload_files.probe_media")
+    def test_media_probe(self, mock_probe_media: MagicMock, _):
+        """Test media_probe property is only probed once."""
+        self.file.vif = False
+        self.file.dzffn = "ffmpeg"
+        self.file.path = "path/to/video.mp4"
+        self.assertEqual(mock_probe_media.return_value, self.file.media_probe)
+        self.assertEqual(mock_probe_media.return_value, self.file.media_probe)
+        mock_probe_media.assert_called_once_with("ffmpeg", "path/to/video.mp4")
+        with self.subTest("Test media_probe for other files"):
+            self.file.path = "path/to/file.txt"
+            self.file._media_probe = None
+            self.assertIsNone(self.file.media_probe)
+
+    @patch("telegram_upload.upload_files.get_media_cache")
+    @patch("telegram_upload.upload_files.probe_media")
+    def test_media_probe_cache(self, mock_probe_media: MagicMock, mock_get_media_cache: MagicMock):
+        """Test media_probe property uses the media cache."""
+        self.file.vif = False
+        self.file.path = "path/to/video.mp4"
+        self.file._stat = MagicMock()
+        self.assertEqual(mock_get_media_cache.return_value.get_probe.return_value, self.file.media_probe)
+        mock_get_media_cache.return_value.get_probe.assert_called_once_with("path/to/video.mp4", self.file._stat)
+        mock_probe_media.assert_not_called()
+
+    @patch("telegram_upload.upload_files.os.fstat")
+    def test_file_size(self, mock_fstat: MagicMock):
+        """Test file_size property stats the file only once."""
+        mock_fstat.return_value.st_size = 1024
+        with patch.object(File, "fileno", return_value=3):
+            self.assertEqual(1024, self.file.file_size)
+            self.assertEqual(1024, self.file.file_size)
+        mock_fstat.assert_called_once_with(3)
+
+    @patch("telegram_upload.upload_files.get_file_attributes")
+    def test_file_attributes(self, mock_get_file_attributes: MagicMock):
+        """Test file_attributes property is only obtained once."""
+        self.file.force_file = False
+        self.file.vif = False
+        self.file.dzffn = "ffmpeg"
+        self.assertEqual(mock_get_file_attributes.return_value, self.file.file_attributes)
+        self.assertEqual(mock_get_file_attributes.return_value, self.file.file_attributes)
+        mock_get_file_attributes.assert_called_once_with("path/to/file.txt", False, "ffmpeg", None)
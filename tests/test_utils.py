@@ -1,7 +1,11 @@
+import asyncio
+import errno
+import os
+import tempfile
 import unittest
 from unittest.mock import patch, Mock
 
-from telegram_upload.utils import sizeof_fmt, scantree
+from telegram_upload.utils import sizeof_fmt, scantree, preallocate_file, TransferBudget, walk_files
 
 
 class TestSizeOfFmt(unittest.TestCase):
@@ -36,3 +40,80 @@ class TestScanTree(unittest.TestCase):
         side_effect = [[directory], [file] * 3]
         m.side_effect = side_effect
         self.assertEqual(list(scantree('foo')), side_effect[-1])
+
+
+class TestWalkFiles(unittest.TestCase):
+    def test_walk(self):
+        with tempfile.TemporaryDirectory() as directory:
+            expected = []
+            for path in ['a', 'b/c', 'b/d/e', 'b/d/f', 'g/h']:
+                path = os.path.join(directory, path)
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                open(path, 'w').close()
+                expected.append(path)
+            os.makedirs(os.path.join(directory, 'empty'))
+            self.assertEqual(sorted(expected), sorted(entry.path for entry in walk_files(directory, workers=2)))
+
+    def test_symlink_loop(self):
+        with tempfile.TemporaryDirectory() as directory:
+            open(os.path.join(directory, 'a'), 'w').close()
+            os.symlink(directory, os.path.join(directory, 'loop'))
+            entries = list(walk_files(directory, follow_symlinks=True))
+            self.assertLessEqual(len(entries), 2)
+
+
+class TestPreallocateFile(unittest.TestCase):
+    def test_preallocate(self):
+        with tempfile.TemporaryFile() as file:
+            preallocate_file(file.fileno(), 1024)
+            self.assertEqual(1024, os.fstat(file.fileno()).st_size)
+
+    @patch('telegram_upload.utils.os.posix_fallocate', side_effect=OSError(errno.EOPNOTSUPP, 'Not supported'))
+    def test_unsupported_fallocate(self, m):
+        with tempfile.TemporaryFile() as file:
+            preallocate_file(file.fileno(), 1024)
+            self.assertEqual(1024, os.fstat(file.fileno()).st_size)
+
+    @patch('telegram_upload.utils.os.posix_fallocate', side_effect=OSError(errno.ENOSPC, 'No space left'))
+    def test_no_space(self, m):
+        with tempfile.TemporaryFile() as file:
+            with self.assertRaises(OSError):
+                preallocate_file(file.fileno(), 1024)
+            self.assertEqual(0, os.fstat(file.fileno()).st_size)
+
+
+class TestTransferBudget(unittest.TestCase):
+    def test_max_transfers(self):
+        async def transfers():
+            budget = TransferBudget(100, 2)
+            await budget.acquire(1)
+            await budget.acquire(1)
+            waiter = asyncio.create_task(budget.acquire(1))
+            await asyncio.sleep(0)
+            self.assertFalse(waiter.done())
+            await budget.release(1)
+            await waiter
+            self.assertEqual(2, budget.transfers)
+
+        asyncio.run(transfers())
+
+    def test_max_size(self):
+        async def transfers():
+            budget = TransferBudget(100, 10)
+            await budget.acquire(60)
+            waiter = asyncio.create_task(budget.acquire(60))
+            await asyncio.sleep(0)
+            self.assertFalse(waiter.done())
+            await budget.release(60)
+            await waiter
+            self.assertEqual(60, budget.size)
+
+        asyncio.run(transfers())
+
+    def test_larger_than_budget(self):
+        async def transfers():
+            budget = TransferBudget(100, 10)
+            await budget.acquire(1000)
+            self.assertEqual(1000, budget.size)
+
+        asyncio.run(transfers())
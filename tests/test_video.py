@@ -1,8 +1,10 @@
 import unittest
-from unittest.mock import patch
+from unittest.mock import patch, Mock
 
 from telegram_upload.exceptions import ThumbVideoError
-from telegram_upload.video import call_ffmpeg, get_video_size, get_video_thumb
+import json
+
+from telegram_upload.video import call_ffmpeg, get_video_size, get_video_thumb, probe_media, MediaProbe
 
 
 class TestcallFfmpeg(unittest.TestCase):
@@ -35,3 +37,38 @@ class TestGetVideoThumb(unittest.TestCase):
     def test_no_ratio(self, m):
         with self.assertRaises(ThumbVideoError):
             get_video_thumb('foo')
+
+
+class TestProbeMedia(unittest.TestCase):
+    @patch('telegram_upload.video.call_ffmpeg')
+    @patch('telegram_upload.video.subprocess.Popen')
+    def test_ffprobe(self, m_popen, m_call_ffmpeg):
+        data = {
+            'streams': [{'codec_type': 'audio'}, {'codec_type': 'video', 'width': 1920, 'height': 1080}],
+            'format': {'duration': '62.5'},
+        }
+        m_popen.return_value = Mock(returncode=0, **{'communicate.return_value': (json.dumps(data).encode(), b'')})
+        probe = probe_media('ffmpeg', 'foo.mp4')
+        self.assertEqual([1920, 1080], probe.size)
+        self.assertEqual(62.5, probe.duration)
+        self.assertEqual(2, len(probe.streams))
+        self.assertEqual('ffprobe', m_popen.call_args[0][0][0])
+        m_call_ffmpeg.assert_not_called()
+
+    @patch('telegram_upload.video.call_ffmpeg')
+    @patch('telegram_upload.video.subprocess.Popen', side_effect=FileNotFoundError)
+    def test_ffmpeg_fallback(self, m_popen, m_call_ffmpeg):
+        m_call_ffmpeg.return_value.communicate.return_value = (
+            b'', b'  Duration: 01:00:02.50, start: 0.000000\n  Stream #0:0: Video: h264, 1280x720'
+        )
+        probe = probe_media('ffmpeg', 'foo.mp4')
+        self.assertEqual([1280, 720], probe.size)
+        self.assertEqual(3602.5, probe.duration)
+
+    @patch('telegram_upload.video.call_ffmpeg')
+    def test_thumb_reuses_probe(self, m_call_ffmpeg):
+        m_call_ffmpeg.return_value.returncode = 0
+        m_call_ffmpeg.return_value.communicate.return_value = (b'', b'')
+        get_video_thumb('ffmpeg', __file__, 'thumb.jpg', probe=MediaProbe(1920, 1080, 10))
+        m_call_ffmpeg.assert_called_once()
+        self.assertEqual(['-ss', '5'], m_call_ffmpeg.call_args[0][1][:2])